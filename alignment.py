@@ -0,0 +1,235 @@
+import math
+import functools
+import unicodedata
+from collections import namedtuple
+
+
+# Characters ElevenLabs rewrites when building normalizedAlignment
+SPECIAL_CHARS = {
+    "‘": "'",  # Left single quotation mark
+    "’": "'",  # Right single quotation mark
+    "“": '"',  # Left double quotation mark
+    "”": '"',  # Right double quotation mark
+    "–": "-",  # En dash
+    "—": "-",  # Em dash
+    "…": "...",  # Horizontal ellipsis
+    "•": "*",  # Bullet
+    "£": "GBP",  # Pound sign
+    "€": "EUR",  # Euro sign
+    "×": "x",  # Multiplication sign
+    "÷": "/",  # Division sign
+    # Add more special characters as needed
+}
+
+# Default half-width of the alignment band, i.e. the largest drift between the two texts that can be recovered
+DEFAULT_BAND = 16
+
+# Exact matches at least this long are skipped in one step instead of being aligned char by char
+MIN_SNAKE = 4
+
+# Furthest a resumed response is moved back from the continue point to start at a clause or word boundary
+DEFAULT_MAX_REWIND = 40
+
+# Punctuation that ends a clause, when followed by whitespace
+CLAUSE_END = ",;:.!?"
+
+Alignment = namedtuple('Alignment', ['continue_point', 'confidence', 'cost', 'matched_chars'])
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_char(char):
+    """Normalizes a char the way ElevenLabs does: special punctuation replaced, accents stripped, whitespace to a space."""
+    if char.isspace():
+        return " "
+    char = SPECIAL_CHARS.get(char, char)
+    return ''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
+
+
+def normalize(chars):
+    """
+    Normalizes a sequence of chars, collapsing whitespace runs into a single space.
+
+    Returns:
+        tuple[str, list[int]]: The normalized text, and for each of its chars the index of the source char.
+    """
+    text = []
+    origin = []
+    for i, char in enumerate(chars):
+        for c in normalize_char(char):
+            if c == " " and text and text[-1] == " ":
+                continue
+            text.append(c)
+            origin.append(i)
+    return ''.join(text), origin
+
+
+def snake_length(a, i, b, j):
+    """Returns the length of the common prefix of a[i:] and b[j:]."""
+    length = 0
+    step = 64
+    while step:
+        if a[i + length:i + length + step] == b[j + length:j + length + step] and i + length + step <= len(a) \
+                and j + length + step <= len(b):
+            length += step
+        else:
+            step //= 2
+    return length
+
+
+class AlignmentTracker:
+    """
+    Incrementally aligns normalizedAlignment chars from ElevenLabs against the chars sent, as they arrive.
+
+    Banded edit distance between the received text and a prefix of the sent text: each received char is aligned
+    against at most 2 * band + 1 sent chars around the best alignment so far, and exact runs are skipped in one step,
+    so the cost is O(n * band) worst case and close to O(n) for normal responses. Received chars are held back until
+    the sent text covers their whole band, so the result doesn't depend on how the input was batched. Never raises
+    on divergence; confidence drops instead.
+
+    Args:
+        chars_to_send (list[str]): Chars sent to ElevenLabs. May keep growing while the tracker is used.
+        band (int): Largest drift between the two texts that can be recovered.
+        start (int): Index in chars_to_send the received chars start at, e.g. the continue point of a resumed response.
+    """
+
+    def __init__(self, chars_to_send, band=DEFAULT_BAND, start=0):
+        self.chars_to_send = chars_to_send
+        self.band = band
+
+        # Normalized sent text, and the index in chars_to_send each of its chars came from
+        self.sent = ""
+        self.origin = []
+        self.normalized_upto = start
+
+        # costs[c] is the edit distance between the received chars aligned so far and sent[:lo + c]
+        self.lo = 0
+        self.costs = list(range(band + 1))
+        self.received_count = 0
+        self.backlog = ""   # Normalized received chars not aligned yet
+
+    def sync_sent(self):
+        """Normalizes chars appended to chars_to_send since the last call."""
+        if self.normalized_upto == len(self.chars_to_send):
+            return
+        text, origin = normalize(self.chars_to_send[self.normalized_upto:])
+        if text.startswith(" ") and (not self.sent or self.sent.endswith(" ")):
+            text, origin = text[1:], origin[1:]     # Leading whitespace, or a run spanning two calls
+        self.sent += text
+        self.origin.extend(i + self.normalized_upto for i in origin)
+        self.normalized_upto = len(self.chars_to_send)
+
+    def feed(self, chars):
+        """Consumes a batch of received chars and advances the alignment as far as the sent text allows."""
+        text = normalize(chars)[0]
+        if (not self.received_count and not self.backlog) or self.backlog.endswith(" "):
+            text = text.lstrip(" ")     # ElevenLabs prefixes the first generation with a space
+        self.backlog += text
+
+        self.sync_sent()
+        # A trailing space is only aligned once the next word arrives, since the next sent char may not be a space
+        pending = self.backlog.rstrip(" ")
+        self.lo, self.costs, consumed = self.advance(self.lo, self.costs, pending, final=False)
+        self.backlog = self.backlog[consumed:]
+        self.received_count += consumed
+
+    def advance(self, lo, costs, received, final):
+        """Aligns received against the band (lo, costs). Returns the new band and how many chars were aligned."""
+        sent, band = self.sent, self.band
+        n, m = len(sent), len(received)
+        j = 0
+        while j < m:
+            best = min(range(len(costs)), key=costs.__getitem__)
+            column, cost = lo + best, costs[best]
+            if not final and column + band + MIN_SNAKE > n:
+                break   # Wait for more sent text
+
+            # Skip an exact run from the best cell, then re-centre the band on where it ends
+            run = snake_length(sent, column, received, j)
+            if run >= MIN_SNAKE or (final and j + run == m):
+                j += run
+                column += run
+                lo = max(0, column - band)
+                costs = [cost + abs(i - column) for i in range(lo, min(n, column + band) + 1)]
+                continue
+
+            # Advance one row, with the band centred one column right of the best cell
+            char = received[j]
+            new_lo = max(0, column + 1 - band)
+            new_hi = min(n, column + 1 + band)
+            new_costs = []
+            for i in range(new_lo, new_hi + 1):
+                above = costs[i - lo] + 1 if lo <= i < lo + len(costs) else math.inf
+                diagonal = costs[i - 1 - lo] + (sent[i - 1] != char) if i > lo and i - 1 < lo + len(costs) else math.inf
+                left = new_costs[-1] + 1 if new_costs else math.inf
+                new_costs.append(min(above, diagonal, left))
+            lo, costs = new_lo, new_costs
+            j += 1
+        return lo, costs, j
+
+    def result(self):
+        """Returns the Alignment of everything received so far. Doesn't change the tracker's state."""
+        self.sync_sent()
+        lo, costs, consumed = self.advance(self.lo, self.costs, self.backlog.rstrip(" "), final=True)
+        best = min(range(len(costs)), key=costs.__getitem__)    # Ties resolve to the earliest column, re-sending more
+        column, cost = lo + best, costs[best]
+        received_count = self.received_count + consumed
+
+        sent = self.sent
+        if self.backlog.endswith(" ") and column < len(sent) and sent[column] == " ":
+            column += 1
+        if column >= len(sent) or not sent[column:].strip(" "):
+            continue_point = len(self.chars_to_send)
+        else:
+            continue_point = self.origin[column]
+        confidence = max(0.0, 1 - cost / received_count) if received_count else 1.0
+        return Alignment(continue_point, confidence, cost, column)
+
+    @property
+    def aligned_upto(self):
+        """Index in chars_to_send the alignment has safely passed. Trails the continue point by up to band chars, but is O(1)."""
+        return self.origin[self.lo] if self.lo < len(self.origin) else self.normalized_upto
+
+    @property
+    def continue_point(self):
+        """Index in chars_to_send of the first char not spoken yet."""
+        return self.result().continue_point
+
+
+def align(chars_to_send, chars_received, band=DEFAULT_BAND):
+    """
+    Aligns all chars ElevenLabs reported as spoken against the chars sent, and finds where to continue.
+
+    Args:
+        chars_to_send (list[str]): Chars sent to ElevenLabs, as received from OpenAI.
+        chars_received (list[str]): normalizedAlignment chars received from ElevenLabs.
+        band (int): Largest drift between the two texts that can be recovered.
+
+    Returns:
+        Alignment: continue_point is the index in chars_to_send of the first char not spoken. confidence is the
+        fraction of received chars aligned without edits.
+    """
+    tracker = AlignmentTracker(chars_to_send, band)
+    tracker.feed(chars_received)
+    return tracker.result()
+
+
+def resume_point(chars_to_send, continue_point, max_rewind=DEFAULT_MAX_REWIND):
+    """
+    Moves a continue_point that falls mid-word back to where the resumed response is better started: the start of
+    its clause if it is within max_rewind chars, else the start of the word. Text resumed mid-word is mispronounced,
+    and mid-clause loses its intonation. The audio of the chars between the two points is synthesized again, and has
+    to be dropped.
+
+    Returns:
+        int: Index in chars_to_send, at most continue_point.
+    """
+    chars = chars_to_send
+    if not 0 < continue_point < len(chars) or chars[continue_point - 1].isspace() or chars[continue_point].isspace():
+        return continue_point   # Already between words
+    word_start = None
+    for i in range(continue_point - 1, max(0, continue_point - max_rewind) - 1, -1):
+        if i == 0 or chars[i - 1].isspace():
+            word_start = i if word_start is None else word_start
+            if i == 0 or (i >= 2 and chars[i - 2] in CLAUSE_END):
+                return i
+    return word_start if word_start is not None else continue_point
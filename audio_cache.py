@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import collections
+
+import metrics
+import alignment
+
+
+# Default size limit of the cache directory: ~10 minutes of mp3_44100_128 audio
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+
+# Responses with more audio than this (~1 minute) aren't recorded, so recording holds a bounded amount in memory
+DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024
+
+
+def normalize_text(text):
+    """Normalizes text for cache keys the way ElevenLabs normalizes it for speech, so equivalent text shares audio."""
+    return alignment.normalize(text)[0].strip(" ")
+
+
+def cache_key(voice_id, model_id, voice_settings, text):
+    """Returns the content address of text spoken with the given voice, model and voice settings."""
+    identity = json.dumps([voice_id, model_id, voice_settings, normalize_text(text)], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+class Recorder:
+    """Collects the frames of a response for the cache. Gives up once they add up to more than limit bytes."""
+
+    def __init__(self, limit=DEFAULT_MAX_ENTRY_BYTES):
+        self.limit = limit
+        self.chunks = []
+        self.frames = []
+        self.size = 0
+        self.overflowed = False
+
+    def add(self, audio, normalized_alignment):
+        if self.overflowed:
+            return
+        self.size += len(audio)
+        if self.size > self.limit:
+            self.overflowed = True
+            self.chunks, self.frames = [], []
+            return
+        self.chunks.append(audio)
+        self.frames.append({'audio_bytes': len(audio), 'normalizedAlignment': normalized_alignment})
+
+    def audio(self):
+        return b''.join(self.chunks)
+
+
+class AudioCache:
+    """
+    On-disk cache of synthesized audio, keyed by cache_key().
+
+    Each entry is <key>.mp3 with the audio and <key>.json with the text and the frames it arrived in: the audio bytes
+    and normalizedAlignment of each frame, so a hit can be played (and aligned) like a live response. Entries are
+    evicted least recently used first once the directory grows past max_bytes. Recency is kept in file mtimes, so it
+    survives restarts.
+
+    Args:
+        path (str): Cache directory. Created if missing.
+        max_bytes (int): Largest total size of the entries.
+        max_entry_bytes (int): Largest audio recorded for one entry. See Recorder.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.logger = logging.getLogger('audio_cache')
+        os.makedirs(path, exist_ok=True)
+
+        # key -> entry size in bytes, least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.clock = 0      # Latest mtime given to an entry, in ns
+        found = []
+        for name in os.listdir(path):
+            key, ext = os.path.splitext(name)
+            if ext == '.mp3' and os.path.exists(self.file(key, '.json')):
+                found.append((os.stat(self.file(key, '.mp3')).st_mtime_ns, key))
+        for mtime, key in sorted(found):
+            self.entries[key] = self.entry_size(key)
+            self.size += self.entries[key]
+            self.clock = mtime
+
+    def file(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def touch(self, key):
+        """Marks key as the most recently used. mtimes strictly increase, since uses can be closer than the clock resolution."""
+        self.clock = max(time.time_ns(), self.clock + 1000)
+        os.utime(self.file(key, '.mp3'), ns=(self.clock, self.clock))
+
+    def entry_size(self, key):
+        return os.path.getsize(self.file(key, '.mp3')) + os.path.getsize(self.file(key, '.json'))
+
+    def recorder(self):
+        """Returns a Recorder for a response to be stored with put()."""
+        return Recorder(self.max_entry_bytes)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns (audio, frames) for key, or None on a miss. frames is a list of {'audio_bytes', 'normalizedAlignment'}."""
+        start = time.perf_counter()
+        if key not in self.entries:
+            metrics.count('audio_cache_miss')
+            return None
+        try:
+            with open(self.file(key, '.mp3'), 'rb') as f:
+                audio = f.read()
+            with open(self.file(key, '.json'), 'r') as f:
+                frames = json.load(f)['frames']
+            self.touch(key)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+            self.remove(key)
+            metrics.count('audio_cache_miss')
+            return None
+        self.entries.move_to_end(key)
+        metrics.count('audio_cache_hit')
+        metrics.observe('audio_cache.get_ms', (time.perf_counter() - start) * 1000)
+        return audio, frames
+
+    def put(self, key, text, audio, frames):
+        """Stores audio and its frames under key, then evicts the least recently used entries over max_bytes."""
+        if key in self.entries:
+            self.remove(key)
+        metadata = {'text': text, 'frames': frames}
+        for ext, data in (('.json', json.dumps(metadata, ensure_ascii=False).encode()), ('.mp3', audio)):
+            temp = self.file(key, ext + '.tmp')
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, self.file(key, ext))   # The .mp3 is written last, so a listed entry is complete
+        self.touch(key)
+        self.entries[key] = self.entry_size(key)
+        self.size += self.entries[key]
+        metrics.count('audio_cache_store')
+
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self.remove(next(iter(self.entries)))
+            metrics.count('audio_cache_evict')
+
+    def remove(self, key):
+        self.size -= self.entries.pop(key, 0)
+        for ext in ('.mp3', '.json'):
+            try:
+                os.remove(self.file(key, ext))
+            except FileNotFoundError:
+                pass
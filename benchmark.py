@@ -0,0 +1,502 @@
+import io
+import ast
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import difflib
+import logging
+import asyncio
+import argparse
+import contextlib
+
+import sinks
+import metrics
+import sandbox
+import chunking
+import queues
+import alignment
+import simulation
+import connection_pool
+from fake_openai import FakeOpenAIServer, load_openai_fixtures, synthetic_tokens
+from fake_elevenlabs import FakeElevenLabsServer, Fault, normalize_text, read_labelled_audio
+
+
+# Prompts from the comments of sandbox.main()
+PROMPTS = {
+    'quote': "Hello, can you give me an inspirational quote from someone famous? I'm feeling a little tired but I want to get inspired to work hard today.",
+    'story_100': "Hello, tell me a short story in 100 words or less and in spanish?",
+    'story_500': "Hello, can you tell me a story that is exactly 500 words long?",
+}
+
+# Stage boundaries reported by the ttfa benchmark, in pipeline order
+TTFA_EVENTS = ['websocket_ready', 'first_token', 'first_chunk', 'first_audio_frame', 'first_playback']
+
+# Faults the recovery benchmark draws from, see fake_elevenlabs.Fault
+FAULT_KINDS = ['close_after_chars', 'close_after_ms', 'frame_delay', 'drop_alignment', 'oversized_frame']
+
+# Player process that discards audio. Keeps the pipe and process costs of mpv, for machines without it
+NULL_PLAYER_COMMAND = [sys.executable, "-c", "import sys, shutil, os; shutil.copyfileobj(sys.stdin.buffer, open(os.devnull, 'wb'))"]
+
+
+def make_sink(args):
+    """
+    Returns (sink, player name) for the benchmark. 'null' discards audio in process, 'null-process' pipes it to
+    NULL_PLAYER_COMMAND, and 'mpv' plays it (falling back to null-process when mpv is not installed).
+    """
+    player = args.player
+    if player == 'mpv' and shutil.which(sandbox.AUDIO_PLAYER_COMMAND[0]) is None:
+        player = 'null-process'
+    if player == 'null':
+        sink = sinks.NullSink()
+    else:
+        if player == 'null-process':
+            sandbox.AUDIO_PLAYER_COMMAND = NULL_PLAYER_COMMAND
+            sandbox.AUDIO_BYTES_PER_SECOND = None   # Discards audio instantly, nothing to wait for
+        sink = sinks.PlayerSink(sandbox.MPVProcessSingleton(), persistent=args.player_mode == 'persistent')
+    if args.save_audio:
+        sink = sinks.TeeSink(sink, sinks.FileSink(args.save_audio))
+    return sink, player
+
+
+async def bench_ttfa(args):
+    """Runs main()-style turns against the local stand-ins and reports per-stage time-to-first percentiles."""
+    openai_server = FakeOpenAIServer(ttft_ms=args.ttft_ms, token_interval_ms=args.token_interval_ms,
+                                     fixtures=load_openai_fixtures())
+    elevenlabs_server = FakeElevenLabsServer(char_delay_ms=args.char_delay_ms, first_audio_delay_ms=args.first_audio_delay_ms,
+                                             handshake_delay_ms=args.handshake_delay_ms)
+    sink, player = make_sink(args)
+    sandbox.CHUNK_SCHEDULE = args.chunk_schedule
+    sandbox.CHUNK_IDLE_TIMEOUT = args.idle_timeout
+
+    results = {}
+    async with openai_server, elevenlabs_server:
+        client = openai_server.client()
+        uri = elevenlabs_server.uri(sandbox.VOICE_ID, sandbox.MODEL_ID)
+        pool = connection_pool.ConnectionPool(lambda: sandbox.connect_tts(uri)) if args.warm_connections else None
+
+        for name in args.prompts:
+            metrics.reset()
+            samples = {event: [] for event in TTFA_EVENTS}
+            for _ in range(args.turns):
+                if pool is not None:
+                    pool.warm()
+                    await asyncio.sleep(args.handshake_delay_ms / 1000 * 2)    # The user speaking
+                messages = [{'role': 'user', 'content': PROMPTS[name]}]
+                with contextlib.redirect_stdout(io.StringIO()):    # chat_completion prints every token
+                    await sandbox.run_turn(messages, client=client, uri=uri, pool=pool, sink=sink)
+
+                turn = metrics.current_turn.get()
+                for event in TTFA_EVENTS:
+                    if event in turn.events:
+                        samples[event].append(turn.events[event])
+
+            results[name] = {f"time_to_{event}_ms": metrics.summarize(values) for event, values in samples.items()}
+            results[name]['histograms'] = metrics.snapshot()
+
+        if pool is not None:
+            await pool.close()
+    sink.close()
+
+    return {
+        'benchmark': 'ttfa',
+        'config': {k: v for k, v in vars(args).items() if k not in ('func', 'out')} | {'player': player},
+        'results': results,
+    }
+
+
+def synthetic_transcript(n_chars, edit_rate, rng):
+    """Returns (chars_to_send, chars_received) where ElevenLabs spoke ~90% of n_chars with random normalization edits."""
+    words = PROMPTS['story_500'].split() + "The Tarnished’s “journey” — résumé… done.".split()
+    text = []
+    while len(text) < n_chars:
+        text.extend(rng.choice(words) + rng.choice([" ", " ", " ", "\n\n"]))
+    chars_to_send = text[:n_chars]
+
+    spoken, _ = alignment.normalize(chars_to_send[:int(n_chars * 0.9)])
+    chars_received = [" "]
+    for char in spoken:
+        roll = rng.random()
+        if roll < edit_rate / 3:
+            continue                                    # Dropped
+        elif roll < edit_rate * 2 / 3:
+            chars_received.extend([char, " "])          # Inserted
+        elif roll < edit_rate:
+            chars_received.append(rng.choice("xyz"))    # Substituted
+        else:
+            chars_received.append(char)
+    return chars_to_send, chars_received
+
+
+def bench_alignment(args):
+    """Times alignment.align on the recorded get_remaining_chars fixtures and on synthetic transcripts."""
+    fixtures = {}
+    for path in sorted(glob.glob('tests/*/get_remaining_chars/inputs/0*/chars_received.json')):
+        folder = path.rsplit('/', 1)[0]
+        with open(f"{folder}/chars_to_send.json") as f:
+            chars_to_send = json.load(f)
+        with open(path) as f:
+            chars_received = json.load(f)
+        with open(f"{folder}/remaining_chars.json") as f:
+            remaining_chars = json.load(f)
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = alignment.align(chars_to_send, chars_received, band=args.band)
+            timings.append((time.perf_counter() - start) * 1000)
+        fixtures[folder] = {
+            'chars': len(chars_to_send),
+            'correct': chars_to_send[result.continue_point:] == remaining_chars,
+            'confidence': round(result.confidence, 4),
+            'time_ms': metrics.summarize(timings),
+        }
+
+    rng = random.Random(args.seed)
+    synthetic = {}
+    for n_chars in args.sizes:
+        for edit_rate in args.edit_rates:
+            chars_to_send, chars_received = synthetic_transcript(n_chars, edit_rate, rng)
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                result = alignment.align(chars_to_send, chars_received, band=args.band)
+                timings.append((time.perf_counter() - start) * 1000)
+            synthetic[f"{n_chars}_chars_{edit_rate}_edits"] = {
+                'continue_point': result.continue_point,
+                'expected_continue_point': int(n_chars * 0.9),
+                'confidence': round(result.confidence, 4),
+                'time_ms': metrics.summarize(timings),
+            }
+
+    return {
+        'benchmark': 'alignment',
+        'config': {k: v for k, v in vars(args).items() if k not in ('func', 'out')},
+        'results': {'fixtures': fixtures, 'synthetic': synthetic},
+    }
+
+
+# Chunkers to compare against sandbox.text_chunker. The per-char word chunker sandbox.py used to have is kept
+# verbatim in the multilingual text_chunker test.
+LEGACY_CHUNKERS = {
+    'main.py': 'main.py',
+    'monolingual_old.py': 'monolingual_old.py',
+    'sandbox.py (per-char)': 'tests/multilingual/text_chunker/test_text_chunker.py',
+}
+
+
+class CaptureSink(sinks.NullSink):
+    """Keeps the audio written, to read back the chars heard from labelled audio."""
+
+    def __init__(self):
+        super().__init__()
+        self.audio = bytearray()
+
+    def write(self, chunk):
+        super().write(chunk)
+        self.audio += chunk
+
+
+def random_fault(kinds, n_chars, rng):
+    """Returns (kind, Fault) of a kind drawn from kinds, with random parameters for a response of n_chars."""
+    kind = rng.choice(kinds)
+    if kind == 'close_after_chars':
+        fault = Fault(close_after_chars=rng.randrange(n_chars))
+    elif kind == 'close_after_ms':
+        fault = Fault(close_after_ms=rng.uniform(0, 100))
+    elif kind == 'frame_delay':
+        fault = Fault(frame_delay_ms=rng.uniform(0, 20), close_after_chars=rng.randrange(n_chars))
+    elif kind == 'drop_alignment':
+        fault = Fault(drop_alignment=rng.uniform(0.1, 0.5), close_after_chars=rng.randrange(n_chars),
+                      seed=rng.randrange(2 ** 32))
+    else:
+        fault = Fault(oversized_after_chars=rng.randrange(n_chars))
+    return kind, fault
+
+
+async def feed_text(tokens, text_queue, chars_to_send, interval_ms):
+    """Streams tokens into text_queue the way chat_completion does."""
+    for token in tokens:
+        await asyncio.sleep(interval_ms / 1000)
+        chars_to_send.extend(token)
+        await text_queue.put(token)
+    await text_queue.put(None)
+
+
+def heard_errors(text, heard):
+    """Returns (chars missing, chars duplicated) of the chars heard against the spoken chars of text."""
+    expected = normalize_text(text).replace(" ", "")
+    heard = ''.join(heard).replace(" ", "")
+    matcher = difflib.SequenceMatcher(None, expected, heard, autojunk=False)
+    matched = sum(block.size for block in matcher.get_matching_blocks())
+    return len(expected) - matched, len(heard) - matched
+
+
+async def run_recovery_scenario(server, tokens, faults, args):
+    """Speaks tokens through text_to_speech_input_streaming with faults injected. Returns the scenario's outcome."""
+    server.faults = faults
+    server.stats['connections'] = 0
+    metrics.reset()
+    metrics.start_turn()
+    sink = CaptureSink()
+    text_queue = queues.BoundedQueue('text_queue')
+    chars_to_send = []
+
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        await asyncio.wait_for(asyncio.gather(
+            feed_text(tokens, text_queue, chars_to_send, args.token_interval_ms),
+            sandbox.text_to_speech_input_streaming(sandbox.VOICE_ID, text_queue, chars_to_send,
+                                                   uri=server.uri(sandbox.VOICE_ID), sink=sink, cache=None)
+        ), args.timeout)
+    except asyncio.TimeoutError:
+        status = 'timeout'
+    except Exception:
+        status = 'error'
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    missing, duplicated = heard_errors(''.join(tokens), read_labelled_audio(bytes(sink.audio), server.ms_per_char))
+    recovery = metrics.histograms.get('resume.latency_ms')
+    return {
+        'status': status,
+        'time_ms': elapsed_ms,
+        'connections': server.stats['connections'],
+        'missing_chars': missing,
+        'duplicated_chars': duplicated,
+        'recovery_ms': recovery.max if recovery is not None and recovery.count else None,
+    }
+
+
+async def bench_recovery(args):
+    """
+    Runs text_to_speech_input_streaming's retry loop against randomized faults injected by the ElevenLabs stand-in,
+    and reports recovery time and the chars heard twice or not at all. Results are grouped by the kind of fault
+    injected into the first connection; later connections may fail differently.
+    """
+    if not args.logging:
+        logging.disable(logging.CRITICAL)
+    sandbox.RESUME_MAX_REWIND = args.max_rewind
+    rng = random.Random(args.seed)
+    server = FakeElevenLabsServer(char_delay_ms=args.char_delay_ms, first_audio_delay_ms=args.first_audio_delay_ms,
+                                  generation_threshold=args.generation_threshold, labelled=True)
+
+    outcomes = {}
+    async with server:
+        for _ in range(args.scenarios):
+            tokens = synthetic_tokens(rng.randint(*args.words))
+            n_chars = len(''.join(tokens))
+            drawn = [random_fault(args.faults, n_chars, rng) for _ in range(rng.randint(1, args.max_faulted_connections))]
+            outcome = await run_recovery_scenario(server, tokens, [fault for _, fault in drawn], args)
+            outcomes.setdefault(drawn[0][0], []).append(outcome)
+
+    def summarize(samples):
+        recovered = [s for s in samples if s['recovery_ms'] is not None]
+        return {
+            'scenarios': len(samples),
+            'status': {status: sum(s['status'] == status for s in samples) for status in ('ok', 'error', 'timeout')},
+            'exact': sum(not s['missing_chars'] and not s['duplicated_chars'] for s in samples),
+            'recovery_ms': metrics.summarize([s['recovery_ms'] for s in recovered]),
+            'missing_chars': metrics.summarize([s['missing_chars'] for s in samples]),
+            'duplicated_chars': metrics.summarize([s['duplicated_chars'] for s in samples]),
+            'connections': metrics.summarize([s['connections'] for s in samples]),
+            'time_ms': metrics.summarize([s['time_ms'] for s in samples]),
+        }
+
+    results = {kind: summarize(samples) for kind, samples in sorted(outcomes.items())}
+    results['all'] = summarize([s for samples in outcomes.values() for s in samples])
+    logging.disable(logging.NOTSET)
+    return {
+        'benchmark': 'recovery',
+        'config': {k: v for k, v in vars(args).items() if k not in ('func', 'out')},
+        'results': results,
+    }
+
+
+def bench_simulate(args):
+    """
+    Runs a turn per prompt in virtual time on the in-memory stand-ins (see simulation), and reports its stage timings.
+    They don't depend on the machine or its load, so reports from before and after a change can be diffed.
+    """
+    if not args.logging:
+        logging.disable(logging.CRITICAL)
+    sandbox.CHUNK_SCHEDULE = args.chunk_schedule
+    sandbox.CHUNK_IDLE_TIMEOUT = args.idle_timeout
+
+    results = {}
+    for name in args.prompts:
+        metrics.reset()
+        openai = simulation.SimulatedOpenAI(
+            FakeOpenAIServer(ttft_ms=args.ttft_ms, token_interval_ms=args.token_interval_ms,
+                             fixtures=load_openai_fixtures()), args.latency_ms)
+        elevenlabs = simulation.SimulatedElevenLabs(
+            FakeElevenLabsServer(char_delay_ms=args.char_delay_ms, first_audio_delay_ms=args.first_audio_delay_ms,
+                                 handshake_delay_ms=args.handshake_delay_ms), args.latency_ms)
+        sink = simulation.SimulatedSink()
+        messages = [{'role': 'user', 'content': PROMPTS[name]}]
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):    # chat_completion prints every token
+            _, turn = simulation.run(simulation.simulate_turn(messages, openai, elevenlabs, sink))
+        results[name] = {
+            'events_ms': {event: round(value, 3) for event, value in turn.events.items()},
+            'duration_ms': round(metrics.histograms['turn.duration_ms'].max, 3),
+            'playback_gaps_ms': metrics.summarize(sink.gaps),
+            'counts': {counter: round(value, 3) for counter, value in turn.counts.items()},
+            'wall_ms': (time.perf_counter() - start) * 1000,
+        }
+
+    logging.disable(logging.NOTSET)
+    return {
+        'benchmark': 'simulate',
+        'config': {k: v for k, v in vars(args).items() if k not in ('func', 'out')},
+        'results': results,
+    }
+
+
+def load_legacy_chunker(path):
+    """Compiles text_chunker from path without importing the module (and running its setup code)."""
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    node = next(n for n in tree.body if isinstance(n, ast.AsyncFunctionDef) and n.name == 'text_chunker')
+    namespace = {'asyncio': asyncio, 'logging': logging, 'logger': logging.getLogger(), 'multi_log': sandbox.multi_log}
+    exec(compile(ast.Module(body=[node], type_ignores=[]), path, 'exec'), namespace)
+    return namespace['text_chunker']
+
+
+async def run_chunker(chunker, texts):
+    """Runs an async chunker over texts. Returns the number of chunks emitted."""
+    input_queue = asyncio.Queue()
+    output_queue = asyncio.Queue()
+    for text in texts:
+        input_queue.put_nowait(text)
+    input_queue.put_nowait(None)
+    await chunker(input_queue, output_queue)
+    return output_queue.qsize() - 1
+
+
+async def bench_chunker(args):
+    """Compares sandbox.text_chunker against the legacy chunkers on the recorded multilingual deltas."""
+    with open(args.input) as f:
+        texts = json.load(f) * args.scale
+    if not args.logging:
+        logging.disable(logging.CRITICAL)
+
+    chunkers = {'sandbox.py': sandbox.text_chunker}
+    chunkers.update({name: load_legacy_chunker(path) for name, path in LEGACY_CHUNKERS.items()})
+
+    results = {}
+    for name, chunker in chunkers.items():
+        await run_chunker(chunker, texts)  # Warm up
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            chunks = await run_chunker(chunker, texts)
+            timings.append((time.perf_counter() - start) * 1000)
+        results[name] = {'chunks': chunks, 'time_ms': metrics.summarize(timings)}
+
+    # The chunking engine alone, without queues
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        chunker = chunking.WordChunker()
+        chunks = sum(len(chunker.feed(text)) for text in texts) + bool(chunker.flush())
+        timings.append((time.perf_counter() - start) * 1000)
+    results['chunking.WordChunker (engine only)'] = {'chunks': chunks, 'time_ms': metrics.summarize(timings)}
+
+    logging.disable(logging.NOTSET)
+    return {
+        'benchmark': 'chunker',
+        'config': {k: v for k, v in vars(args).items() if k not in ('func', 'out')} | {'deltas': len(texts)},
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency benchmarks for the MaleniaGPT pipeline.")
+    subparsers = parser.add_subparsers(required=True)
+
+    ttfa = subparsers.add_parser('ttfa', help="End-to-end time-to-first-audio against local API stand-ins.")
+    ttfa.add_argument('--turns', type=int, default=20, help="Turns per prompt")
+    ttfa.add_argument('--prompts', nargs='+', choices=PROMPTS.keys(), default=list(PROMPTS.keys()))
+    ttfa.add_argument('--ttft-ms', type=float, default=300.0)
+    ttfa.add_argument('--token-interval-ms', type=float, default=30.0)
+    ttfa.add_argument('--char-delay-ms', type=float, default=2.0)
+    ttfa.add_argument('--first-audio-delay-ms', type=float, default=150.0)
+    ttfa.add_argument('--player', choices=['mpv', 'null-process', 'null'], default='null-process')
+    ttfa.add_argument('--player-mode', choices=['persistent', 'per-turn'], default='persistent')
+    ttfa.add_argument('--save-audio', default=None, help="Also write each turn's audio to this path, e.g. out/{turn}.mp3")
+    ttfa.add_argument('--chunk-schedule', nargs='+', type=int, default=None,
+                      help="Adaptive chunk sizes in chars, e.g. 20 60 120 200. Default sends every word")
+    ttfa.add_argument('--idle-timeout', type=float, default=chunking.DEFAULT_IDLE_TIMEOUT)
+    ttfa.add_argument('--handshake-delay-ms', type=float, default=150.0, help="Simulated TCP/TLS setup per connection")
+    ttfa.add_argument('--warm-connections', action='store_true', help="Open the next websocket before each turn")
+    ttfa.set_defaults(func=bench_ttfa)
+
+    align = subparsers.add_parser('alignment', help="Continue point alignment on fixtures and synthetic transcripts.")
+    align.add_argument('--sizes', nargs='+', type=int, default=[10_000, 100_000])
+    align.add_argument('--edit-rates', nargs='+', type=float, default=[0.0, 0.01, 0.05])
+    align.add_argument('--band', type=int, default=alignment.DEFAULT_BAND)
+    align.add_argument('--repeat', type=int, default=5)
+    align.add_argument('--seed', type=int, default=0)
+    align.set_defaults(func=bench_alignment)
+
+    chunk = subparsers.add_parser('chunker', help="Text chunker microbenchmark.")
+    chunk.add_argument('--input', default='tests/multilingual/text_chunker/inputs/01.json')
+    chunk.add_argument('--scale', type=int, default=20, help="Times to repeat the input deltas per run")
+    chunk.add_argument('--repeat', type=int, default=20)
+    chunk.add_argument('--logging', action='store_true', help="Keep the chunkers' DEBUG file logging enabled")
+    chunk.set_defaults(func=bench_chunker)
+
+    recovery = subparsers.add_parser('recovery', help="Reconnect recovery under injected TTS faults.")
+    recovery.add_argument('--scenarios', type=int, default=2000)
+    recovery.add_argument('--faults', nargs='+', choices=FAULT_KINDS, default=FAULT_KINDS)
+    recovery.add_argument('--max-faulted-connections', type=int, default=2,
+                          help="Faults are injected into up to this many connections of a turn, in a row")
+    recovery.add_argument('--words', nargs=2, type=int, default=[20, 80], help="Range of response lengths")
+    recovery.add_argument('--token-interval-ms', type=float, default=0.0)
+    recovery.add_argument('--char-delay-ms', type=float, default=0.05)
+    recovery.add_argument('--first-audio-delay-ms', type=float, default=5.0)
+    recovery.add_argument('--generation-threshold', type=int, default=40)
+    recovery.add_argument('--max-rewind', type=int, default=alignment.DEFAULT_MAX_REWIND,
+                          help="sandbox.RESUME_MAX_REWIND. 0 resumes at the continue point")
+    recovery.add_argument('--timeout', type=float, default=10.0, help="Seconds before a scenario counts as hung")
+    recovery.add_argument('--seed', type=int, default=0)
+    recovery.add_argument('--logging', action='store_true', help="Keep the pipeline's DEBUG file logging enabled")
+    recovery.set_defaults(func=bench_recovery)
+
+    simulate = subparsers.add_parser('simulate', help="Stage timings of a turn in virtual time, reproducible across runs.")
+    simulate.add_argument('--prompts', nargs='+', choices=PROMPTS.keys(), default=list(PROMPTS.keys()))
+    simulate.add_argument('--ttft-ms', type=float, default=300.0)
+    simulate.add_argument('--token-interval-ms', type=float, default=30.0)
+    simulate.add_argument('--char-delay-ms', type=float, default=2.0)
+    simulate.add_argument('--first-audio-delay-ms', type=float, default=150.0)
+    simulate.add_argument('--handshake-delay-ms', type=float, default=150.0)
+    simulate.add_argument('--latency-ms', type=float, default=20.0, help="One-way network latency to both APIs")
+    simulate.add_argument('--chunk-schedule', nargs='+', type=int, default=None,
+                          help="Adaptive chunk sizes in chars, e.g. 20 60 120 200. Default sends every word")
+    simulate.add_argument('--idle-timeout', type=float, default=chunking.DEFAULT_IDLE_TIMEOUT)
+    simulate.add_argument('--logging', action='store_true', help="Keep the pipeline's DEBUG file logging enabled")
+    simulate.set_defaults(func=bench_simulate)
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--out', default=None, help="Write JSON results to this file instead of stdout")
+
+    args = parser.parse_args()
+    report = args.func(args)
+    if asyncio.iscoroutine(report):
+        report = asyncio.run(report)
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+# Main execution
+if __name__ == "__main__":
+    main()
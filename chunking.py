@@ -0,0 +1,111 @@
+# Chars that end a clause. The first adaptive chunk is cut at the first word ending with one of these.
+CLAUSE_ENDINGS = (".", ",", "?", "!", ";", ":", "—", ")")
+
+# Adaptive chunk sizes in chars. The first chunk is cut at a clause boundary or after schedule[0] chars, chunk i at
+# the first word boundary after schedule[i] chars. The last size repeats.
+DEFAULT_SCHEDULE = (20, 60, 120, 200)
+
+# Seconds without new text after which buffered words are sent anyway
+DEFAULT_IDLE_TIMEOUT = 0.25
+
+
+class Flush(str):
+    """A chunk that should be synthesized right away instead of waiting for more text."""
+
+
+class WordChunker:
+    """
+    Splits streamed text into words, each followed by a single space.
+
+    Same output as the original per-char loop in sandbox.text_chunker: only " " ends a word, runs of spaces don't
+    produce empty chunks, and newlines/tabs stay inside the word. Each delta is split once with str.split (C speed);
+    a word spanning several deltas is kept as a list of slices and joined once when it completes.
+    """
+
+    try_trigger_generation = False
+
+    def __init__(self):
+        self.partial = []   # Slices of the word currently being streamed
+
+    def feed(self, text):
+        """Consumes a delta. Returns the chunks it completed."""
+        if " " not in text:
+            if text:
+                self.partial.append(text)
+            return []
+
+        words = text.split(" ")
+        last = words.pop()
+        if self.partial:
+            self.partial.append(words[0])
+            words[0] = ''.join(self.partial)
+            self.partial = []
+        if last:
+            self.partial.append(last)
+        return [word + " " for word in words if word]
+
+    def flush(self):
+        """Returns the final chunk at end of input, if any."""
+        if not self.partial:
+            return None
+        word = ''.join(self.partial)
+        self.partial = []
+        return word + " "
+
+
+class AdaptiveChunker:
+    """
+    Groups words into chunks that grow on a schedule.
+
+    A tiny first chunk gets audio started as soon as possible; larger later chunks give ElevenLabs more context per
+    generation and need fewer frames. The first chunk and idle flushes are returned as Flush chunks.
+
+    Args:
+        schedule (tuple[int]): Chunk sizes in chars. See DEFAULT_SCHEDULE.
+        idle_timeout (float): Seconds without input after which buffered words are flushed. None disables it.
+    """
+
+    try_trigger_generation = True
+
+    def __init__(self, schedule=DEFAULT_SCHEDULE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        if not schedule or min(schedule) < 1:
+            raise ValueError(f"Chunk schedule must be a non-empty list of positive sizes, got {schedule!r}")
+        self.schedule = tuple(schedule)
+        self.idle_timeout = idle_timeout
+        self.words = WordChunker()
+        self.buffer = []    # Complete words not emitted yet
+        self.size = 0
+        self.emitted = 0
+
+    def feed(self, text):
+        """Consumes a delta. Returns the chunks it completed."""
+        chunks = []
+        for word in self.words.feed(text):
+            self.buffer.append(word)
+            self.size += len(word)
+            target = self.schedule[min(self.emitted, len(self.schedule) - 1)]
+            if self.size >= target or (not self.emitted and word[:-1].endswith(CLAUSE_ENDINGS)):
+                chunks.append(self.emit(Flush if not self.emitted else str))
+        return chunks
+
+    def pending(self):
+        """Whether complete words are waiting for the chunk to fill up."""
+        return bool(self.buffer)
+
+    def flush_idle(self):
+        """Returns the buffered words as a Flush chunk, or None. The word being streamed stays buffered."""
+        return self.emit(Flush) if self.buffer else None
+
+    def flush(self):
+        """Returns the final chunk at end of input, if any."""
+        word = self.words.flush()
+        if word:
+            self.buffer.append(word)
+        return self.emit(str) if self.buffer else None
+
+    def emit(self, kind):
+        chunk = kind(''.join(self.buffer))
+        self.buffer = []
+        self.size = 0
+        self.emitted += 1
+        return chunk
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import collections
+
+import metrics
+
+
+# Default size limit of the cache directory
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+
+# Default age in seconds after which an entry is no longer replayed: one week
+DEFAULT_TTL = 7 * 24 * 3600
+
+# Replay paces: 'original' waits out the recorded delay before each delta, 'instant' puts them all at once
+PACES = ('original', 'instant')
+
+
+def cache_key(model, temperature, messages):
+    """Returns a stable hash of a chat completion request: the model, temperature and the full messages list."""
+    identity = json.dumps([model, temperature, messages], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+class Recording:
+    """Collects the content deltas of a streamed response, with their time in ms since the request was sent."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.deltas = []
+
+    def add(self, content):
+        self.deltas.append([round((time.perf_counter() - self.start) * 1000, 1), content])
+
+    def entry(self, role):
+        """Returns the cache entry for the finished response."""
+        return {'role': role, 'deltas': self.deltas, 'end_ms': round((time.perf_counter() - self.start) * 1000, 1)}
+
+
+async def replay(entry, pace='original'):
+    """Yields the content deltas of a cache entry, at their recorded times or all at once."""
+    if pace not in PACES:
+        raise ValueError(f"Unknown replay pace {pace!r}. Expected one of {PACES}")
+    start = time.perf_counter()
+    for offset_ms, content in entry['deltas']:
+        if pace == 'original':
+            await asyncio.sleep(max(0.0, start + offset_ms / 1000 - time.perf_counter()))
+        yield content
+    if pace == 'original':
+        await asyncio.sleep(max(0.0, start + entry['end_ms'] / 1000 - time.perf_counter()))
+
+
+class CompletionCache:
+    """
+    On-disk cache of streamed chat completions, keyed by cache_key().
+
+    Each entry is <key>.json with the role, the content deltas and the time each arrived at, so a hit can be replayed
+    at the original pace (see replay()). Entries older than ttl seconds are dropped when looked up, and entries are
+    evicted least recently used first once the directory grows past max_bytes. Recency is kept in file mtimes, so it
+    survives restarts.
+
+    Args:
+        path (str): Cache directory. Created if missing.
+        max_bytes (int): Largest total size of the entries.
+        ttl (float): Largest age in seconds of an entry that is replayed. None never expires entries.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.logger = logging.getLogger('completion_cache')
+        os.makedirs(path, exist_ok=True)
+
+        # key -> entry size in bytes, least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.clock = 0      # Latest mtime given to an entry, in ns
+        found = []
+        for name in os.listdir(path):
+            key, ext = os.path.splitext(name)
+            if ext == '.json':
+                found.append((os.stat(self.file(key)).st_mtime_ns, key))
+        for mtime, key in sorted(found):
+            self.entries[key] = os.path.getsize(self.file(key))
+            self.size += self.entries[key]
+            self.clock = mtime
+
+    def file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def touch(self, key):
+        """Marks key as the most recently used. mtimes strictly increase, since uses can be closer than the clock resolution."""
+        self.clock = max(time.time_ns(), self.clock + 1000)
+        os.utime(self.file(key), ns=(self.clock, self.clock))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the entry for key, a dict with 'role', 'deltas' and 'end_ms', or None on a miss."""
+        if key not in self.entries:
+            metrics.count('completion_cache_miss')
+            return None
+        try:
+            with open(self.file(key), 'r') as f:
+                entry = json.load(f)
+            expired = self.ttl is not None and time.time() - entry['created'] > self.ttl
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+            self.remove(key)
+            metrics.count('completion_cache_miss')
+            return None
+        if expired:
+            self.remove(key)
+            metrics.count('completion_cache_expired')
+            metrics.count('completion_cache_miss')
+            return None
+        self.touch(key)
+        self.entries.move_to_end(key)
+        metrics.count('completion_cache_hit')
+        return entry
+
+    def put(self, key, entry):
+        """Stores a Recording entry under key, then evicts the least recently used entries over max_bytes."""
+        if key in self.entries:
+            self.remove(key)
+        temp = self.file(key) + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(entry | {'created': time.time()}, f, ensure_ascii=False)
+        os.replace(temp, self.file(key))
+        self.touch(key)
+        self.entries[key] = os.path.getsize(self.file(key))
+        self.size += self.entries[key]
+        metrics.count('completion_cache_store')
+
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self.remove(next(iter(self.entries)))
+            metrics.count('completion_cache_evict')
+
+    def remove(self, key):
+        self.size -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.file(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,93 @@
+import time
+import asyncio
+import logging
+
+import metrics
+
+
+# ElevenLabs closes stream-input sockets after 20s without input. Spares older than this are not handed out.
+DEFAULT_MAX_IDLE = 15.0
+
+
+class ConnectionPool:
+    """
+    Keeps one connected and initialised websocket warm, so a turn doesn't wait for the handshake.
+
+    Stream-input sockets carry a single generation, so every acquire() consumes the spare and starts warming the
+    next one. Spares that idled for max_idle seconds, or were closed by the server, are discarded.
+
+    Args:
+        connect (Callable[[], Awaitable]): Opens and initialises a websocket.
+        max_idle (float): Seconds a spare may sit unused before it is discarded.
+    """
+
+    def __init__(self, connect, max_idle=DEFAULT_MAX_IDLE):
+        self.connect = connect
+        self.max_idle = max_idle
+        self.logger = logging.getLogger('connection_pool')
+        self.spare = None   # Task resolving to (websocket, time it was opened)
+        self.closing = set()    # Tasks closing discarded spares, kept so they aren't garbage collected mid-close
+
+    def warm(self):
+        """Starts opening a spare connection in the background, unless a usable one is ready or on its way."""
+        if self.spare is not None:
+            if not self.spare.done():
+                return
+            if self.spare.exception() is None and self.usable(*self.spare.result()):
+                return
+            self.discard()
+        self.spare = asyncio.create_task(self.open())
+
+    async def acquire(self):
+        """Returns an open, initialised websocket: the spare if it is usable, a new connection otherwise."""
+        websocket = None
+        if self.spare is not None:
+            spare, self.spare = self.spare, None
+            try:
+                websocket, opened = await spare
+            except Exception as e:
+                self.logger.warning(f"Spare connection failed: {e}")
+            else:
+                if not self.usable(websocket, opened):
+                    self.logger.info(f"Discarding spare connection idle for {time.monotonic() - opened:.1f}s")
+                    metrics.count('stale_connection')
+                    await websocket.close()
+                    websocket = None
+
+        metrics.tag('tts_connection', 'warm' if websocket else 'cold')
+        if websocket is None:
+            websocket, _ = await self.open()
+        self.warm()
+        return websocket
+
+    async def open(self):
+        start = time.perf_counter()
+        websocket = await self.connect()
+        metrics.observe('connection_pool.connect_ms', (time.perf_counter() - start) * 1000)
+        self.logger.debug("Opened connection")
+        return websocket, time.monotonic()
+
+    def usable(self, websocket, opened):
+        return websocket.open and time.monotonic() - opened < self.max_idle
+
+    def discard(self):
+        spare, self.spare = self.spare, None
+        if not spare.done():
+            spare.cancel()
+        elif spare.exception() is None:
+            closing = asyncio.create_task(spare.result()[0].close())
+            self.closing.add(closing)
+            closing.add_done_callback(self.closing.discard)
+
+    async def close(self):
+        """Closes the spare connection, if any, and waits for discarded spares to finish closing."""
+        await asyncio.gather(*self.closing, return_exceptions=True)
+        if self.spare is None:
+            return
+        spare, self.spare = self.spare, None
+        spare.cancel()
+        try:
+            websocket, _ = await spare
+        except (asyncio.CancelledError, Exception):
+            return
+        await websocket.close()
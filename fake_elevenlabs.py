@@ -0,0 +1,354 @@
+import json
+import math
+import base64
+import random
+import asyncio
+import logging
+import argparse
+import websockets
+
+from alignment import normalize_char
+
+
+# Silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz, joint stereo). Zeroed side info decodes to silence,
+# so the synthetic audio is playable by mpv and has realistic size/duration.
+SILENT_MP3_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+SILENT_MP3_FRAME_MS = 1152 / 44100 * 1000
+
+
+def normalize_text(text):
+    """Approximates ElevenLabs text normalization: strip accents, replace special chars, collapse whitespace."""
+    return ' '.join(''.join(normalize_char(c) for c in text).split())
+
+
+def silent_audio(duration_ms):
+    """Returns silent mp3 audio lasting at least duration_ms."""
+    return SILENT_MP3_FRAME * max(1, math.ceil(duration_ms / SILENT_MP3_FRAME_MS))
+
+
+# Rate sandbox assumes ElevenLabs' mp3_44100_128 output plays at, and labelled audio is generated at
+LABELLED_BYTES_PER_SECOND = 128_000 // 8
+
+
+def labelled_block_size(ms_per_char):
+    return int(ms_per_char * LABELLED_BYTES_PER_SECOND / 1000)
+
+
+def labelled_audio(chars, ms_per_char):
+    """
+    Returns stand-in audio that records what it speaks: ms_per_char worth of bytes per char, holding the char in UTF-8.
+    Not playable, but lets a test tell from the audio played which chars were heard, repeated or lost.
+    """
+    size = labelled_block_size(ms_per_char)
+    return b''.join(char.encode('utf-8')[:size].ljust(size, b'\0') for char in chars)
+
+
+def read_labelled_audio(audio, ms_per_char):
+    """Returns the chars spoken by labelled audio. A partial char at the end isn't counted."""
+    size = labelled_block_size(ms_per_char)
+    return [audio[i:i + size].rstrip(b'\0').decode('utf-8', errors='replace') for i in range(0, len(audio) - size + 1, size)]
+
+
+class Fault:
+    """
+    Failure injected into one connection of the stand-in, to reproduce what production disconnects look like.
+
+    Args:
+        close_after_chars (int): Close the connection once frames covering this many alignment chars were sent. The
+            frame that crosses it is cut short at that char, like a generation interrupted mid-word.
+        close_after_ms (float): Close the connection this long after it was accepted.
+        frame_delay_ms (float): Extra delay before every audio frame.
+        drop_alignment (float): Probability that an audio frame is sent without normalizedAlignment and alignment.
+        oversized_after_chars (int): Once this many alignment chars were sent, send a frame of oversized_bytes of
+            audio. The client rejects messages over its max_size (1 MiB by default) and closes the connection.
+        oversized_bytes (int): Audio size of the oversized frame.
+        seed (int): Seed for drop_alignment.
+    """
+
+    def __init__(self, close_after_chars=None, close_after_ms=None, frame_delay_ms=0.0, drop_alignment=0.0,
+                 oversized_after_chars=None, oversized_bytes=2 ** 21, seed=0):
+        self.close_after_chars = close_after_chars
+        self.close_after_ms = close_after_ms
+        self.frame_delay_ms = frame_delay_ms
+        self.drop_alignment = drop_alignment
+        self.oversized_after_chars = oversized_after_chars
+        self.oversized_bytes = oversized_bytes
+        self.seed = seed
+
+    def __repr__(self):
+        options = {k: v for k, v in vars(self).items() if v and k not in ('oversized_bytes', 'seed')}
+        return f"Fault({', '.join(f'{k}={v!r}' for k, v in options.items())})"
+
+
+def load_elevenlabs_fixtures(path='tests/monolingual_eng/elevenlabs/test_data.json'):
+    """Returns {test_num: (openai_output, elevenlabs_output)} for the recorded ElevenLabs fixtures."""
+    with open(path, 'r') as f:
+        tests = json.load(f)
+    return {t['test_num']: (t['openai_output'], t['elevenlabs_output']) for t in tests if 'elevenlabs_output' in t}
+
+
+class FakeElevenLabsServer:
+    """
+    Local websocket server speaking the ElevenLabs stream-input protocol.
+
+    Args:
+        host (str): Interface to bind.
+        port (int): Port to bind. 0 picks a free port.
+        char_delay_ms (float): Synthesis time per normalized character.
+        first_audio_delay_ms (float): Extra delay before the first audio frame of each connection.
+        ms_per_char (float): Spoken duration per character, used for alignment timings and audio length.
+        generation_threshold (int): Buffered chars needed before generating without try_trigger_generation.
+        trigger_threshold (int): Buffered chars needed before generating with try_trigger_generation.
+        replay (list[dict]): Recorded elevenlabs_output frames to replay instead of synthesizing alignment.
+        inactivity_timeout (float): Seconds without a message after which the connection is closed, like the real API.
+        handshake_delay_ms (float): Delay before accepting each connection, standing in for TCP/TLS setup.
+        faults (list[Fault]): Fault injected into each connection, in the order they are accepted. None, or
+            connections past the end of the list, are healthy.
+        labelled (bool): Send labelled_audio instead of silent mp3, so the chars heard can be read back from the audio.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, char_delay_ms=2.0, first_audio_delay_ms=150.0, ms_per_char=60.0,
+                 generation_threshold=120, trigger_threshold=50, replay=None, inactivity_timeout=20.0,
+                 handshake_delay_ms=0.0, faults=None, labelled=False):
+        self.host = host
+        self.port = port
+        self.char_delay_ms = char_delay_ms
+        self.first_audio_delay_ms = first_audio_delay_ms
+        self.ms_per_char = ms_per_char
+        self.generation_threshold = generation_threshold
+        self.trigger_threshold = trigger_threshold
+        self.replay = replay
+        self.inactivity_timeout = inactivity_timeout
+        self.handshake_delay_ms = handshake_delay_ms
+        self.faults = list(faults or [])
+        self.labelled = labelled
+        self.logger = logging.getLogger('fake_elevenlabs')
+        self.server = None
+        self.stats = {'connections': 0, 'chars_received': 0, 'frames_sent': 0, 'audio_bytes_sent': 0, 'faults_injected': 0}
+
+    def uri(self, voice_id, model_id='eleven_multilingual_v2'):
+        """Returns the stream-input uri for this server, in the same shape as the real API."""
+        return f"ws://{self.host}:{self.port}/v1/text-to-speech/{voice_id}/stream-input?model_id={model_id}"
+
+    async def start(self):
+        self.server = await websockets.serve(self.handler, self.host, self.port, max_size=None,
+                                             process_request=self.delay_handshake)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info(f"Fake ElevenLabs server listening on {self.host}:{self.port}")
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def delay_handshake(self, path, request_headers):
+        if self.handshake_delay_ms:
+            await asyncio.sleep(self.handshake_delay_ms / 1000)
+        return None     # Continue with the handshake
+
+    async def handler(self, websocket):
+        """Handles one stream-input connection: init message, text frames, EOS."""
+        self.stats['connections'] += 1
+        fault = self.faults[self.stats['connections'] - 1] if self.stats['connections'] <= len(self.faults) else None
+        segments = asyncio.Queue()
+        synthesizer = asyncio.create_task(self.synthesize(websocket, segments, fault))
+        closer = asyncio.create_task(self.close_after(websocket, fault.close_after_ms)) \
+            if fault is not None and fault.close_after_ms is not None else None
+        buffer = ""
+
+        try:
+            init_message = json.loads(await websocket.recv())
+            self.logger.debug(f"Init message: {json.dumps({k: v for k, v in init_message.items() if k != 'xi_api_key'})}")
+
+            while True:
+                try:
+                    message = await asyncio.wait_for(websocket.recv(), self.inactivity_timeout)
+                except asyncio.TimeoutError:
+                    self.logger.debug(f"No input for {self.inactivity_timeout}s. Closing connection")
+                    await websocket.close(1008, "Input timeout exceeded")
+                    return
+                data = json.loads(message)
+                text = data.get("text")
+                self.stats['chars_received'] += len(text or "")
+
+                if text == "":  # EOS. Flush whatever is buffered
+                    if buffer:
+                        await segments.put(buffer)
+                    await segments.put(None)
+                    break
+
+                buffer += text
+                if data.get("flush") and buffer.strip():  # Generate whatever is buffered right away
+                    await segments.put(buffer)
+                    buffer = ""
+                    continue
+
+                threshold = self.trigger_threshold if data.get("try_trigger_generation") else self.generation_threshold
+                cut = buffer.rfind(" ")
+                if len(buffer) >= threshold and cut > 0:
+                    await segments.put(buffer[:cut + 1])
+                    buffer = buffer[cut + 1:]
+
+            await synthesizer
+        except websockets.exceptions.ConnectionClosed:
+            self.logger.debug("Connection closed")
+        finally:
+            synthesizer.cancel()
+            if closer is not None:
+                closer.cancel()
+
+    async def close_after(self, websocket, ms):
+        await asyncio.sleep(ms / 1000)
+        self.stats['faults_injected'] += 1
+        await websocket.close(1011, "Injected fault")
+
+    async def synthesize(self, websocket, segments, fault=None):
+        """Turns queued text segments into audio frames, pacing them with the configured delays."""
+        first = True
+        chars_generated = 0
+        replay = list(self.replay or [])
+        state = {'chars_sent': 0, 'oversized': False, 'rng': random.Random(fault.seed if fault else 0)}
+
+        while True:
+            segment = await segments.get()
+            if segment is None:
+                break
+
+            chars = list(normalize_text(segment) + " ")
+            if first:
+                chars.insert(0, " ")    # ElevenLabs prefixes the first generation with a space
+
+            delay_ms = self.char_delay_ms * len(chars) + (self.first_audio_delay_ms if first else 0)
+            await asyncio.sleep(delay_ms / 1000)
+            first = False
+            chars_generated += len(chars)
+
+            if self.replay is None:
+                if not await self.send_audio(websocket, self.audio_frame(chars), fault, state):
+                    return
+                continue
+
+            # Release recorded frames once enough text has been generated to cover them
+            while replay and replay[0].get("normalizedAlignment") and \
+                    len(replay[0]["normalizedAlignment"]["chars"]) <= chars_generated:
+                frame = replay.pop(0)
+                chars_generated -= len(frame["normalizedAlignment"]["chars"])
+                if not await self.send_audio(websocket, self.replay_frame(frame), fault, state):
+                    return
+
+        if self.replay is None:
+            await self.send_frame(websocket, {"audio": None, "isFinal": None, "normalizedAlignment": None, "alignment": None})
+            await self.send_frame(websocket, {"isFinal": True, "normalizedAlignment": None, "alignment": None})
+            return
+
+        for frame in replay:
+            if not await self.send_audio(websocket, self.replay_frame(frame), fault, state):
+                return
+
+    async def send_audio(self, websocket, frame, fault, state):
+        """Sends a frame, injecting fault into it. Returns False once the fault has closed the connection."""
+        if fault is None:
+            await self.send_frame(websocket, frame)
+            return True
+
+        if fault.frame_delay_ms:
+            await asyncio.sleep(fault.frame_delay_ms / 1000)
+        chars = frame["normalizedAlignment"]["chars"] if frame.get("normalizedAlignment") else []
+        sent = state['chars_sent']
+
+        if fault.oversized_after_chars is not None and not state['oversized'] and \
+                sent + len(chars) > fault.oversized_after_chars:
+            state['oversized'] = True
+            self.stats['faults_injected'] += 1
+            frame = dict(frame, audio=base64.b64encode(bytes(fault.oversized_bytes)).decode())
+
+        closing = fault.close_after_chars is not None and sent + len(chars) >= fault.close_after_chars
+        if closing:
+            keep = max(0, fault.close_after_chars - sent)
+            frame = self.audio_frame(chars[:keep]) if keep < len(chars) else frame
+            chars = chars[:keep]
+
+        if chars and fault.drop_alignment and state['rng'].random() < fault.drop_alignment:
+            self.stats['faults_injected'] += 1
+            frame = dict(frame, normalizedAlignment=None, alignment=None)
+
+        if chars or not closing:
+            await self.send_frame(websocket, frame)
+        state['chars_sent'] += len(chars)
+
+        if closing:
+            self.stats['faults_injected'] += 1
+            await websocket.close(1011, "Injected fault")
+            return False
+        return True
+
+    def audio_frame(self, chars):
+        starts = [round(i * self.ms_per_char) for i in range(len(chars))]
+        durations = [round(self.ms_per_char)] * len(chars)
+        alignment = {"chars": chars, "charStartTimesMs": starts, "charDurationsMs": durations}
+        if self.labelled:
+            audio = labelled_audio(chars, self.ms_per_char)
+        else:
+            audio = silent_audio(len(chars) * self.ms_per_char)
+        return {
+            "audio": base64.b64encode(audio).decode(),
+            "isFinal": None,
+            "normalizedAlignment": alignment,
+            "alignment": dict(alignment),
+        }
+
+    def replay_frame(self, frame):
+        """Fills audio and timings that were stripped from the recorded fixture frame."""
+        frame = json.loads(json.dumps(frame))
+        if frame.get("normalizedAlignment"):
+            synthesized = self.audio_frame(frame["normalizedAlignment"]["chars"])
+            frame["audio"] = synthesized["audio"]
+            for key in ("normalizedAlignment", "alignment"):
+                if frame.get(key):
+                    n = len(frame[key]["chars"])
+                    frame[key].setdefault("charStartTimesMs", synthesized["normalizedAlignment"]["charStartTimesMs"][:n])
+                    frame[key].setdefault("charDurationsMs", synthesized["normalizedAlignment"]["charDurationsMs"][:n])
+        else:
+            frame.setdefault("audio", None)
+        return frame
+
+    async def send_frame(self, websocket, frame):
+        message = json.dumps(frame)
+        await websocket.send(message)
+        self.stats['frames_sent'] += 1
+        if frame.get("audio"):
+            self.stats['audio_bytes_sent'] += len(frame["audio"]) * 3 // 4
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run a local ElevenLabs stream-input stand-in.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--char-delay-ms', type=float, default=2.0)
+    parser.add_argument('--first-audio-delay-ms', type=float, default=150.0)
+    parser.add_argument('--replay', type=int, default=None, help="test_num of the elevenlabs fixture to replay")
+    parser.add_argument('--close-after-chars', type=int, default=None, help="Drop the first connection after N chars")
+    parser.add_argument('--close-after-ms', type=float, default=None, help="Drop the first connection after M ms")
+    args = parser.parse_args()
+
+    replay = load_elevenlabs_fixtures()[args.replay][1] if args.replay is not None else None
+    faults = [Fault(close_after_chars=args.close_after_chars, close_after_ms=args.close_after_ms)] \
+        if args.close_after_chars is not None or args.close_after_ms is not None else None
+    server = FakeElevenLabsServer(args.host, args.port, args.char_delay_ms, args.first_audio_delay_ms, replay=replay,
+                                  faults=faults)
+    async with server:
+        print(f"Set ELEVENLABS_WS_URI={server.uri('{voice_id}', '{model_id}')}&xi_api_key={{api_key}}")
+        await asyncio.Future()
+
+
+# Main execution
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,202 @@
+import json
+import time
+import asyncio
+import logging
+import argparse
+import itertools
+from openai import AsyncOpenAI
+
+
+# Filler used for prompts that don't match a recorded fixture. Tokenized roughly the way GPT-4 streams it.
+FILLER_TEXT = (
+    "Ah, Tarnished. You stand before Malenia, Blade of Miquella. I have never known defeat. "
+    "The scarlet rot blooms within me, yet my blade remains true. Heed my words, for they are few: "
+    "let your resolve be tempered like steel, and your will unbending, even as the Erdtree withers."
+)
+
+
+def synthetic_tokens(n_words):
+    """Returns stream deltas for a response of exactly n_words words, starting with the empty role delta."""
+    words = itertools.cycle(FILLER_TEXT.split())
+    tokens = [""]
+    for i in range(n_words):
+        word = next(words)
+        stripped = word.rstrip(".,:!?")
+        tokens.append(("" if i == 0 else " ") + stripped)
+        if stripped != word:
+            tokens.append(word[len(stripped):])
+    return tokens
+
+
+def load_openai_fixtures(path='tests/monolingual_eng/openai/test_data.json'):
+    """Returns {query: openai_output} for the recorded OpenAI fixtures."""
+    with open(path, 'r') as f:
+        tests = json.load(f)
+    return {t['query_template'].format(text=t['text']): t['openai_output'] for t in tests if 'openai_output' in t}
+
+
+class FakeOpenAIServer:
+    """
+    Local OpenAI-compatible server that streams chat.completions chunks over SSE.
+
+    Args:
+        host (str): Interface to bind.
+        port (int): Port to bind. 0 picks a free port.
+        ttft_ms (float): Delay before the first content token.
+        token_interval_ms (float): Delay between subsequent tokens.
+        fixtures (dict[str, list[str]]): Recorded openai_output token arrays keyed by user query.
+        default_words (int): Length of the synthetic response for queries without a fixture.
+        replay (list[str]): Token array returned for every request, overriding fixtures.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, ttft_ms=300.0, token_interval_ms=30.0, fixtures=None,
+                 default_words=40, replay=None):
+        self.host = host
+        self.port = port
+        self.ttft_ms = ttft_ms
+        self.token_interval_ms = token_interval_ms
+        self.fixtures = fixtures or {}
+        self.default_words = default_words
+        self.replay = replay
+        self.logger = logging.getLogger('fake_openai')
+        self.server = None
+        self.connections = {}
+        self.stats = {'requests': 0, 'tokens_sent': 0}
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    def client(self):
+        """Returns an AsyncOpenAI client pointed at this server."""
+        return AsyncOpenAI(api_key="fake", base_url=self.base_url, max_retries=0)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handler, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info(f"Fake OpenAI server listening on {self.base_url}")
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            for writer in self.connections.values():    # Hang up idle keep-alive connections
+                writer.close()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def tokens_for(self, messages):
+        """Picks the token array to stream for a messages list."""
+        if self.replay is not None:
+            return self.replay
+        query = messages[-1]['content'] if messages else ""
+        if query in self.fixtures:
+            return self.fixtures[query]
+
+        # Honour "N words" in the prompt so story prompts produce story-length responses
+        words = [int(w) for w in query.replace("-", " ").split() if w.isdigit()]
+        return synthetic_tokens(words[0] if words else self.default_words)
+
+    async def handler(self, reader, writer):
+        """Serves HTTP/1.1 requests on one keep-alive connection."""
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    key, _, value = line.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if method != "POST" or not path.endswith("/chat/completions"):
+                    await self.respond(writer, 404, {"error": {"message": f"Unknown route {method} {path}"}})
+                    continue
+
+                request = json.loads(body)
+                self.stats['requests'] += 1
+                tokens = self.tokens_for(request.get('messages', []))
+                if request.get('stream'):
+                    await self.stream_completion(writer, request.get('model', 'gpt-4'), tokens)
+                else:
+                    await self.respond(writer, 200, self.completion(request.get('model', 'gpt-4'), tokens))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def respond(self, writer, status, payload):
+        body = json.dumps(payload).encode()
+        writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Not Found'}\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    def completion(self, model, tokens):
+        content = "".join(tokens)
+        return {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        }
+
+    def chunk(self, model, delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    async def stream_completion(self, writer, model, tokens):
+        """Streams tokens as SSE chunks using chunked transfer encoding, so the connection can be reused."""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+        async def send_event(data):
+            event = f"data: {data}\n\n".encode()
+            writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            await writer.drain()
+
+        # OpenAI opens every stream with the role and an empty content string
+        if not tokens or tokens[0] != "":
+            tokens = [""] + list(tokens)
+
+        await send_event(json.dumps(self.chunk(model, {"role": "assistant", "content": ""})))
+        await asyncio.sleep(self.ttft_ms / 1000)
+        for i, token in enumerate(tokens[1:]):
+            if i:
+                await asyncio.sleep(self.token_interval_ms / 1000)
+            await send_event(json.dumps(self.chunk(model, {"content": token})))
+            self.stats['tokens_sent'] += 1
+
+        await send_event(json.dumps(self.chunk(model, {}, finish_reason="stop")))
+        await send_event("[DONE]")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run a local OpenAI chat.completions streaming stand-in.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--ttft-ms', type=float, default=300.0)
+    parser.add_argument('--token-interval-ms', type=float, default=30.0)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.host, args.port, args.ttft_ms, args.token_interval_ms, fixtures=load_openai_fixtures())
+    async with server:
+        print(f"Set OPENAI_BASE_URL={server.base_url}")
+        await asyncio.Future()
+
+
+# Main execution
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+import math
+
+try:
+    import tiktoken
+except ImportError:     # Token counts are estimated without it
+    tiktoken = None
+
+
+# Default token budget of a prompt, leaving room for the reply in gpt-4's 8k context
+DEFAULT_BUDGET = 3000
+
+# Tokens the chat format adds per message (role and separators), and once per prompt to prime the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_PROMPT = 3
+
+# Part of the budget set aside for past exchanges recalled from a memory.RelevanceIndex
+DEFAULT_RECALL_BUDGET = 1000
+
+# Fewest tokens worth keeping of a message compacted to fit the budget. Below this it is dropped instead.
+MIN_COMPACT_TOKENS = 32
+
+
+def token_counter(model='gpt-4'):
+    """Returns a function counting the tokens in a text: tiktoken's encoding for model if installed, else ~4 chars per token."""
+    if tiktoken is not None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+            return lambda text: len(encoding.encode(text))
+        except KeyError:
+            pass
+    return lambda text: math.ceil(len(text) / 4)
+
+
+def prompt_tokens(messages, count_tokens=None):
+    """Returns the tokens in a prompt: its .tokens if it is a Prompt, else counted."""
+    if isinstance(messages, Prompt):
+        return messages.tokens
+    count_tokens = count_tokens or token_counter()
+    return TOKENS_PER_PROMPT + sum(TOKENS_PER_MESSAGE + count_tokens(m['content']) for m in messages)
+
+
+class Prompt(list):
+    """Messages selected from a History for one request, carrying their token count and how many exchanges were recalled."""
+
+    def __init__(self, messages, tokens, recalled=0):
+        super().__init__(messages)
+        self.tokens = tokens
+        self.recalled = recalled
+
+
+class History:
+    """
+    Conversation history kept within a token budget.
+
+    Each message is counted once, when it is appended. prompt() starts with the system message, then adds messages
+    newest first while they fit. The first one that doesn't fit is compacted to the tokens left, and older messages
+    are dropped. The newest message is always included in full.
+
+    With an index, each completed exchange is added to it, and recall_budget tokens are set aside for older exchanges:
+    those most relevant to the newest message are recalled after the system message, in the order they happened.
+
+    Args:
+        budget (int): Largest number of tokens in a prompt.
+        system (str): Persona system message, kept at the start of every prompt.
+        count_tokens (function): Counts the tokens in a text. Defaults to token_counter().
+        index (memory.RelevanceIndex): Past exchanges to recall from, including earlier sessions'.
+        recall_budget (int): Tokens of the budget set aside for recalled exchanges.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, system=None, count_tokens=None, index=None,
+                 recall_budget=DEFAULT_RECALL_BUDGET):
+        self.budget = budget
+        self.count_tokens = count_tokens or token_counter()
+        self.system = {'role': 'system', 'content': system} if system else None
+        self.system_tokens = self.message_tokens(self.system) if self.system else 0
+        self.index = index
+        self.recall_budget = recall_budget if index is not None else 0
+        self.messages = []
+        self.tokens = []    # Tokens of each message, including TOKENS_PER_MESSAGE
+        self.exchange_ids = []  # Index id of the exchange each message belongs to, None until it is indexed
+
+    def message_tokens(self, message):
+        return TOKENS_PER_MESSAGE + self.count_tokens(message['content'])
+
+    def append(self, message):
+        self.messages.append(message)
+        self.tokens.append(self.message_tokens(message))
+        self.exchange_ids.append(None)
+
+        # A reply completes an exchange with the user message before it
+        if (self.index is not None and message['role'] == 'assistant' and len(self.messages) > 1
+                and self.messages[-2]['role'] == 'user' and self.exchange_ids[-2] is None):
+            exchange_id = self.index.add(self.messages[-2:], self.tokens[-2] + self.tokens[-1])
+            self.exchange_ids[-2:] = [exchange_id, exchange_id]
+
+    def __len__(self):
+        return len(self.messages)
+
+    def prompt(self):
+        """Returns the messages to send as a Prompt, within the budget."""
+        used = TOKENS_PER_PROMPT + self.system_tokens
+        selected = []
+        oldest = len(self.messages)     # Position of the oldest message selected
+        for position in reversed(range(len(self.messages))):
+            message, tokens = self.messages[position], self.tokens[position]
+            if used + tokens <= self.budget - self.recall_budget or not selected:
+                selected.append(message)
+                used += tokens
+                oldest = position
+                continue
+            compacted = self.compact(message, self.budget - self.recall_budget - used)
+            if compacted is not None:
+                selected.append(compacted[0])
+                used += compacted[1]
+                oldest = position
+            break
+        selected.reverse()
+
+        recalled = []
+        if self.index is not None and self.messages:
+            # Only exchanges older than the selected messages, so none is sent twice
+            before = next((i for i in self.exchange_ids[oldest:] if i is not None), len(self.index))
+            for exchange_id in self.index.search(self.messages[-1]['content'], before=before):
+                tokens = self.index.exchanges[exchange_id]['tokens']
+                if used + tokens <= self.budget:
+                    recalled.append(exchange_id)
+                    used += tokens
+            recalled.sort()
+            selected = [m for i in recalled for m in self.index.exchanges[i]['messages']] + selected
+
+        return Prompt([self.system] + selected if self.system else selected, used, len(recalled))
+
+    def compact(self, message, tokens):
+        """Returns (message cut short to fit in tokens, its tokens), or None if fewer than MIN_COMPACT_TOKENS would be left."""
+        available = tokens - TOKENS_PER_MESSAGE
+        if available < MIN_COMPACT_TOKENS:
+            return None
+        content = message['content']
+        cut = len(content) * available // max(1, self.count_tokens(content))
+        while cut > 0:
+            compacted = dict(message, content=content[:cut].rstrip() + "…")
+            needed = self.message_tokens(compacted)
+            if needed <= tokens:
+                return compacted, needed
+            cut = cut * 9 // 10
+        return None
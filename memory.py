@@ -0,0 +1,99 @@
+import os
+import re
+import json
+import math
+import time
+import heapq
+import logging
+import collections
+
+import metrics
+
+
+# BM25 term frequency saturation and document length normalization
+K1 = 1.5
+B = 0.75
+
+# Exchanges returned by a search, before they are fitted into the token budget
+DEFAULT_LIMIT = 8
+
+
+def tokenize(text):
+    """Splits text into lowercase word terms."""
+    return re.findall(r"\w+", text.lower())
+
+
+class RelevanceIndex:
+    """
+    BM25 index over past exchanges (a user message and the reply to it), persisted to disk.
+
+    Exchanges are appended to a JSON lines file as they complete, and the in-memory postings are updated for just
+    the new exchange, so adding one costs time in its length rather than the index size. The index is rebuilt from
+    the file on start, so it remembers conversations from earlier sessions.
+
+    Args:
+        path (str): JSON lines file holding one exchange per line. Created if missing. None keeps the index in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.logger = logging.getLogger('memory')
+        self.exchanges = []     # {'messages', 'tokens'} by id
+        self.lengths = []       # Terms in each exchange
+        self.total_length = 0
+        self.postings = collections.defaultdict(dict)   # term -> {exchange id: term frequency}
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        exchange = json.loads(line)
+                    except ValueError:     # A line cut short by a crash
+                        self.logger.warning(f"Skipping unreadable line in {path}")
+                        continue
+                    self.insert(exchange['messages'], exchange['tokens'])
+
+    def __len__(self):
+        return len(self.exchanges)
+
+    def insert(self, messages, tokens):
+        exchange_id = len(self.exchanges)
+        terms = tokenize(' '.join(m['content'] for m in messages))
+        self.exchanges.append({'messages': messages, 'tokens': tokens})
+        self.lengths.append(len(terms))
+        self.total_length += len(terms)
+        for term, frequency in collections.Counter(terms).items():
+            self.postings[term][exchange_id] = frequency
+        return exchange_id
+
+    def add(self, messages, tokens):
+        """Adds an exchange, with its size in prompt tokens. Returns its id."""
+        start = time.perf_counter()
+        exchange_id = self.insert(messages, tokens)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'messages': messages, 'tokens': tokens}, ensure_ascii=False) + '\n')
+        metrics.observe('memory.add_ms', (time.perf_counter() - start) * 1000)
+        return exchange_id
+
+    def search(self, query, limit=DEFAULT_LIMIT, before=None):
+        """Returns the ids of the exchanges most relevant to query, best first. before excludes ids from it onwards."""
+        start = time.perf_counter()
+        if not self.exchanges:
+            return []
+        before = len(self.exchanges) if before is None else before
+        average_length = self.total_length / len(self.exchanges) or 1
+        scores = collections.defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.exchanges) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for exchange_id, frequency in postings.items():
+                if exchange_id >= before:
+                    continue
+                norm = K1 * (1 - B + B * self.lengths[exchange_id] / average_length)
+                scores[exchange_id] += idf * frequency * (K1 + 1) / (frequency + norm)
+        best = heapq.nlargest(limit, scores, key=scores.get)
+        metrics.observe('memory.search_ms', (time.perf_counter() - start) * 1000)
+        return best
@@ -0,0 +1,204 @@
+import math
+import time
+import bisect
+import logging
+import contextvars
+
+
+# Metrics for the turn being processed. Set once per turn, inherited by every task the turn spawns.
+current_turn = contextvars.ContextVar('current_turn', default=None)
+
+# Clock turn timestamps and blocked times are read from, in seconds. simulation swaps in its event loop's virtual clock
+clock = time.perf_counter
+
+
+class Histogram:
+    """
+    Log-scale histogram with fixed buckets: constant memory, O(log buckets) per observation.
+    Percentiles are accurate to the bucket width (~12%), clamped to the observed min/max.
+    """
+
+    # 0, then 0.01 .. 1e8 with 20 buckets per decade
+    BOUNDS = [0.0] + [10 ** (i / 20) for i in range(-40, 161)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Returns the upper bound of the bucket containing the q-th percentile (0-100)."""
+        if not self.count:
+            return None
+        target = self.count * q / 100
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if n and cumulative >= target:
+                bound = self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3),
+            'min': round(self.min, 3),
+            'p50': round(self.percentile(50), 3),
+            'p95': round(self.percentile(95), 3),
+            'p99': round(self.percentile(99), 3),
+            'max': round(self.max, 3),
+        }
+
+
+# In-memory histograms aggregated across turns, keyed by metric name
+histograms = {}
+
+
+def observe(name, value):
+    """Adds value to the named histogram."""
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram()
+    histogram.observe(value)
+
+
+def observe_queue(name, queue):
+    """Samples the depth of an inter-stage queue, and its size in chars or bytes if it is a bounded queue."""
+    observe(f"queue_depth.{name}", queue.qsize())
+    size = getattr(queue, 'size', None)
+    if size is not None:
+        observe(f"queue_size.{name}", size)
+
+
+def snapshot():
+    """Returns a summary of every histogram."""
+    return {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+
+
+def reset():
+    histograms.clear()
+
+
+class TurnMetrics:
+    """
+    Stage boundary timestamps (ms since the start of the turn) and counts for one conversation turn.
+    events holds first_<stage> and last_<stage> times, counts holds totals per stage or counter.
+    """
+
+    def __init__(self):
+        self.start = clock()
+        self.events = {}
+        self.counts = {}
+        self.tags = {}
+
+    def elapsed_ms(self):
+        return (clock() - self.start) * 1000
+
+    def mark(self, event):
+        """Records the first time event happens in this turn."""
+        if event not in self.events:
+            self.events[event] = self.elapsed_ms()
+
+    def record(self, stage, amount=1):
+        """Records that stage emitted amount items, updating its first/last timestamps."""
+        now = self.elapsed_ms()
+        self.events.setdefault(f"first_{stage}", now)
+        self.events[f"last_{stage}"] = now
+        self.counts[stage] = self.counts.get(stage, 0) + amount
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def tag(self, name, value):
+        """Attaches a non-numeric value (e.g. configuration) to the turn."""
+        self.tags[name] = value
+
+    def finish(self):
+        """Folds this turn into the aggregate histograms."""
+        observe('turn.duration_ms', self.elapsed_ms())
+        for event, value in self.events.items():
+            observe(f"turn.time_to_{event}_ms", value)
+        for name, value in self.counts.items():
+            observe(f"turn.{name}", value)
+
+    def as_dict(self):
+        return {'events': self.events, 'counts': self.counts, 'tags': self.tags}
+
+
+def start_turn():
+    """Starts metrics for a new turn in the current context."""
+    turn = TurnMetrics()
+    current_turn.set(turn)
+    return turn
+
+
+def finish_turn():
+    """Folds the current turn into the histograms and logs it."""
+    turn = current_turn.get()
+    if turn is not None:
+        turn.finish()
+        logging.getLogger('metrics').debug(f"Turn metrics: {turn.as_dict()}")
+    return turn
+
+
+def mark(event):
+    """Marks event on the current turn, if one is being measured."""
+    turn = current_turn.get()
+    if turn is not None:
+        turn.mark(event)
+
+
+def record(stage, amount=1):
+    """Records stage output on the current turn, if one is being measured."""
+    turn = current_turn.get()
+    if turn is not None:
+        turn.record(stage, amount)
+
+
+def count(name, amount=1):
+    """Adds to a counter on the current turn, if one is being measured."""
+    turn = current_turn.get()
+    if turn is not None:
+        turn.count(name, amount)
+
+
+def tag(name, value):
+    """Tags the current turn, if one is being measured."""
+    turn = current_turn.get()
+    if turn is not None:
+        turn.tag(name, value)
+
+
+def percentile(values, q):
+    """Returns the q-th percentile (0-100) of values using linear interpolation."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    lower, upper = math.floor(rank), math.ceil(rank)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarize(values):
+    """Returns count, mean and p50/p95/p99 of values, rounded so reports diff cleanly."""
+    summary = {
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+    }
+    return {'count': len(values)} | {k: v if v is None else round(v, 3) for k, v in summary.items()}
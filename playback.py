@@ -0,0 +1,81 @@
+import bisect
+
+import alignment
+
+
+# Rate ElevenLabs' default mp3_44100_128 output is played at
+DEFAULT_BYTES_PER_SECOND = 128_000 / 8
+
+
+class PlaybackTimeline:
+    """
+    Maps how long a response has been playing to how much of its text has been spoken, e.g. to keep only what the
+    user heard when they interrupt the answer.
+
+    Built incrementally as frames are queued for playback: every normalizedAlignment char gets its start time in the
+    turn's audio (the frame's position in the audio, from the bytes queued before it, plus its charStartTimesMs),
+    and every frame the offset in the response its audio reaches, from the alignment tracker. A lookup is a binary
+    search, so O(log n) in the chars received, plus aligning the chars of one frame with the text it covers.
+
+    Args:
+        chars_to_send (list[str]): Chars of the response. May keep growing while the timeline is used.
+        bytes_per_second (float): Rate the audio is played at.
+    """
+
+    def __init__(self, chars_to_send, bytes_per_second=DEFAULT_BYTES_PER_SECOND):
+        self.chars_to_send = chars_to_send
+        self.bytes_per_second = bytes_per_second
+        self.queued_bytes = 0       # Audio added so far
+        self.written_bytes = 0      # Audio given to the sink, counted by stream(). Some of it may not be heard yet
+
+        self.chars = []             # Received normalizedAlignment chars, in playback order
+        self.times = []             # Start time (ms) of every received char. Non-decreasing
+        self.frame_starts = []      # Index in times of each aligned frame's first char
+        self.frame_offsets = []     # (offset before, offset after) in chars_to_send of each aligned frame
+        self.offset = 0
+
+    def add(self, audio_bytes, frame_alignment=None, offset=None):
+        """
+        Adds a frame of audio_bytes bytes queued for playback, after the previous ones. offset is the index in
+        chars_to_send of the first char not spoken once this frame has played, e.g. AlignmentTracker.continue_point.
+        """
+        start_ms = self.ms_at(self.queued_bytes)
+        self.queued_bytes += audio_bytes
+        if not frame_alignment or not frame_alignment.get('chars'):
+            return
+
+        offset = self.offset if offset is None else max(offset, self.offset)
+        self.frame_starts.append(len(self.times))
+        self.frame_offsets.append((self.offset, offset))
+        self.offset = offset
+
+        self.chars.extend(frame_alignment['chars'])
+        last = self.times[-1] if self.times else 0.0
+        starts = frame_alignment.get('charStartTimesMs') or [0] * len(frame_alignment['chars'])
+        for char_ms in starts:
+            last = max(last, start_ms + char_ms)     # Timings that overrun the frame's audio don't go back in time
+            self.times.append(last)
+
+    def ms_at(self, played_bytes):
+        """Playback time once played_bytes of the audio have played."""
+        return played_bytes / self.bytes_per_second * 1000
+
+    def offset_at(self, ms):
+        """Index in chars_to_send of the first char not started after ms of playback."""
+        started = bisect.bisect_right(self.times, ms)
+        if not started:
+            return 0
+        frame = bisect.bisect_right(self.frame_starts, started - 1) - 1
+        first = self.frame_starts[frame]
+        before, after = self.frame_offsets[frame]
+        covered = self.chars_to_send[before:after]
+        return before + alignment.align(covered, self.chars[first:started]).continue_point
+
+    def spoken_text(self, ms):
+        """The text spoken in ms of playback, without the word that was being spoken if it was cut off."""
+        offset = min(self.offset_at(ms), len(self.chars_to_send))
+        text = ''.join(self.chars_to_send[:offset])
+        cut_off = offset < len(self.chars_to_send) and self.chars_to_send[offset].isalnum()
+        if cut_off and text and text[-1].isalnum():
+            text = text.rsplit(None, 1)[0] if len(text.split()) > 1 else ''
+        return text.rstrip()
@@ -0,0 +1,107 @@
+import asyncio
+
+import metrics
+
+
+def item_size(item):
+    """Size an item counts against a queue's max_size: len() for text and audio, 0 for the end-of-stream None."""
+    return 0 if item is None else len(item)
+
+
+class BoundedQueue(asyncio.Queue):
+    """
+    asyncio.Queue bounded by item count and/or total size (chars of text, bytes of audio).
+
+    put() waits while the queue is full, which holds the producing stage back until the consumer catches up. Items
+    are accepted while the total is under max_size, so an item larger than max_size can't stall the pipeline and the
+    queue never holds more than max_size plus one item.
+    Time spent blocked is recorded in the queue_blocked_ms.<name> histogram and the <name>_blocked_ms turn counter.
+    ended is set once the end-of-stream None has been put, and stays set after it has been taken.
+
+    Args:
+        name (str): Queue name used in metrics, e.g. 'audio_queue'.
+        max_items (int): Largest number of queued items. None is unbounded.
+        max_size (int): Largest total item_size() of queued items. None is unbounded.
+    """
+
+    def __init__(self, name, max_items=None, max_size=None):
+        super().__init__(max_items or 0)
+        self.name = name
+        self.max_size = max_size
+        self.size = 0
+        self.ended = False
+
+    def _put(self, item):
+        self.size += item_size(item)
+        self.ended = self.ended or item is None
+        super()._put(item)
+
+    def _get(self):
+        item = super()._get()
+        self.size -= item_size(item)
+        return item
+
+    def full(self):
+        return super().full() or (self.max_size is not None and self.size >= self.max_size)
+
+    async def put(self, item):
+        if not self.full():
+            return self.put_nowait(item)
+        start = metrics.clock()
+        await super().put(item)
+        blocked_ms = (metrics.clock() - start) * 1000
+        metrics.observe(f"queue_blocked_ms.{self.name}", blocked_ms)
+        metrics.count(f"{self.name}_blocked_ms", blocked_ms)
+
+
+class SendWindow:
+    """
+    Limits how many chars send_text may send ahead of the chars ElevenLabs has synthesized.
+
+    Synthesized audio that can't be queued holds listen back, so acknowledgements stop and the window fills. send_text
+    then stops taking chunks, which carries the backpressure from the audio sink up to text_chunker and
+    chat_completion. The window has to be larger than the text ElevenLabs buffers before generating, or neither side
+    can make progress.
+
+    Positions are indexes in chars_to_send.
+
+    Args:
+        limit (int): Largest number of chars sent but not synthesized yet.
+        start (int): Position sending starts from, e.g. the continue point when resuming a response.
+    """
+
+    def __init__(self, limit, start=0):
+        self.limit = limit
+        self.sent = start
+        self.acked = start
+        self.changed = asyncio.Event()
+
+    def full(self):
+        return self.sent - self.acked >= self.limit
+
+    async def wait(self, timeout=None):
+        """Waits until there is room in the window. Returns False if timeout (seconds) ran out first."""
+        if not self.full():
+            return True
+        start = metrics.clock()
+        try:
+            while self.full():
+                self.changed.clear()
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            blocked_ms = (metrics.clock() - start) * 1000
+            metrics.observe("queue_blocked_ms.send_window", blocked_ms)
+            metrics.count("send_window_blocked_ms", blocked_ms)
+
+    def advance(self, chars):
+        """Records that chars more chars were sent."""
+        self.sent += chars
+
+    def ack(self, position):
+        """Records that everything before position has been synthesized."""
+        if position > self.acked:
+            self.acked = position
+            self.changed.set()
@@ -0,0 +1,98 @@
+import time
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+import speech_recognition as sr
+
+import metrics
+
+
+# Default seconds a recognizer may take before its result is given up on
+DEFAULT_TIMEOUT = 10.0
+
+# Recognition runs on its own threads, so a slow request can't take the threads of asyncio.to_thread
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='recognition')
+
+
+class RecognitionError(Exception):
+    """The recognition service couldn't be reached or refused the request."""
+
+
+class Recognizer:
+    """
+    Speech recognition backend. recognize() is blocking, and is run in EXECUTOR by recognize_speech().
+
+    Subclasses implement recognize(audio), returning the text or None if the audio couldn't be understood, and may
+    implement cancel() to stop a running recognize() early.
+    """
+
+    def recognize(self, audio):
+        raise NotImplementedError
+
+    def cancel(self):
+        """Asks a running recognize() to give up. Its result is ignored either way."""
+
+
+class GoogleRecognizer(Recognizer):
+    """Google's free speech recognition API, through speech_recognition."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.recognizer = sr.Recognizer()
+        self.recognizer.operation_timeout = timeout     # Lets the request thread give up too
+
+    def recognize(self, audio):
+        try:
+            return self.recognizer.recognize_google(audio)
+        except sr.UnknownValueError:
+            return None
+        except sr.RequestError as e:
+            raise RecognitionError(str(e)) from e
+
+
+class FileRecognizer(Recognizer):
+    """
+    Returns transcripts from a text file, one line per utterance in order, for offline tests. A blank line stands for
+    audio that couldn't be understood. Once the lines run out, every utterance is not understood.
+
+    Args:
+        path (str): Transcript file.
+        delay_ms (float): Time each recognition takes, standing in for the service's latency.
+    """
+
+    def __init__(self, path, delay_ms=0.0):
+        with open(path, 'r') as f:
+            self.transcripts = [line.strip() or None for line in f.read().splitlines()]
+        self.delay_ms = delay_ms
+        self.cancelled = threading.Event()
+
+    def recognize(self, audio):
+        self.cancelled.clear()
+        if self.cancelled.wait(self.delay_ms / 1000):
+            return None
+        return self.transcripts.pop(0) if self.transcripts else None
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+async def recognize_speech(recognizer, audio, timeout=DEFAULT_TIMEOUT):
+    """
+    Recognizes audio (speech_recognition AudioData) with recognizer in EXECUTOR, keeping the event loop free.
+    Returns the text, or None if it wasn't understood or took longer than timeout seconds. If the calling task is
+    cancelled, the recognizer is cancelled too. Recognition time is recorded in the stt.recognize_ms histogram.
+    """
+    logger = logging.getLogger('recognition')
+    start = time.perf_counter()
+    future = asyncio.get_running_loop().run_in_executor(EXECUTOR, recognizer.recognize, audio)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Speech recognition took longer than {timeout}s. Giving up")
+        metrics.count('stt_timeout')
+        return None
+    finally:
+        if not future.done() or future.cancelled():
+            recognizer.cancel()
+        metrics.observe('stt.recognize_ms', (time.perf_counter() - start) * 1000)
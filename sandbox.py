@@ -1,13 +1,28 @@
 import os
 import json
+import time
 import base64
 import shutil
 import logging
 import asyncio
+import contextlib
 import subprocess
 import websockets
-import speech_recognition as sr
 
+import sinks
+import vad
+import recognition
+import playback
+import queues
+import splicing
+import metrics
+import memory
+import history
+import chunking
+import alignment
+import audio_cache
+import completion_cache
+import connection_pool
 from openai import AsyncOpenAI
 
 
@@ -17,6 +32,7 @@ def setup_logger(name):
     logger.setLevel(logging.DEBUG)
 
     # Create a file handler that logs to a separate file for each named logger.
+    os.makedirs('logs', exist_ok=True)
     file_handler = logging.FileHandler(f'logs/{name}.log', mode='w')
     file_handler.setLevel(logging.DEBUG)
 
@@ -55,15 +71,129 @@ setup_logger('send_text')
 setup_logger('listen')
 setup_logger('stream')
 setup_logger('get_remaining_chars_to_send')
+setup_logger('metrics')
+setup_logger('connection_pool')
+setup_logger('audio_cache')
+setup_logger('splicing')
+setup_logger('completion_cache')
+setup_logger('memory')
+setup_logger('vad')
+setup_logger('recognition')
 
 # Define API keys and voice ID
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
 ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY", "")
 VOICE_ID = 'HxxnFvSdN4AyRUpj6yh7'
 
-# Set OpenAI API key
+# Alignments of chars received against chars sent below this confidence are logged as divergent
+ALIGNMENT_MIN_CONFIDENCE = 0.9
+MODEL_ID = 'eleven_multilingual_v2'
+# MODEL_ID = 'eleven_monolingual_v1'
+VOICE_SETTINGS = {"stability": 0.70, "similarity_boost": 0.75}
+
+# Stream-input endpoint. Override (e.g. with fake_elevenlabs.py) to run the pipeline against a local server.
+ELEVENLABS_WS_URI = os.environ.get(
+    "ELEVENLABS_WS_URI",
+    "wss://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream-input?model_id={model_id}&xi_api_key={api_key}"
+)
+
+OPENAI_MODEL = 'gpt-4'
+OPENAI_TEMPERATURE = 1
+
+# On-disk cache of chat completions (completion_cache.CompletionCache), or None to always query OpenAI. Set
+# COMPLETION_CACHE_DIR to enable it, and COMPLETION_CACHE_TTL to change how many seconds entries are replayed for.
+COMPLETION_CACHE = completion_cache.CompletionCache(
+    os.environ["COMPLETION_CACHE_DIR"],
+    ttl=float(os.environ.get("COMPLETION_CACHE_TTL", completion_cache.DEFAULT_TTL))
+) if os.environ.get("COMPLETION_CACHE_DIR") else None
+
+# Largest number of tokens in a prompt, including the persona system message (see history.History)
+HISTORY_TOKEN_BUDGET = history.DEFAULT_BUDGET
+
+# Past exchanges recalled into prompts by relevance to the newest message (memory.RelevanceIndex), or None to only
+# send the newest messages. Set MEMORY_FILE to remember conversations across sessions.
+MEMORY = memory.RelevanceIndex(os.environ["MEMORY_FILE"]) if os.environ.get("MEMORY_FILE") else None
+
+# Persona system message kept at the start of every prompt
+SYSTEM_MESSAGE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'system-msg.txt')
+
+# How cached completions are put into the text queue: 'original' at the pace they were streamed, 'instant' all at once
+COMPLETION_REPLAY = os.environ.get("COMPLETION_REPLAY", 'original')
+
+# Set OpenAI API key. OPENAI_BASE_URL (e.g. fake_openai.py) is picked up by the client if set.
 aclient = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
+# Adaptive chunking: sizes in chars for chunks sent to ElevenLabs (see chunking.DEFAULT_SCHEDULE), and seconds
+# without new tokens after which buffered words are flushed. None sends every word as it completes.
+CHUNK_SCHEDULE = None
+CHUNK_IDLE_TIMEOUT = chunking.DEFAULT_IDLE_TIMEOUT
+
+# Bounds on the inter-stage queues as (max items, max size), with size in chars for text and bytes for audio. None is
+# unbounded. A full queue holds its producer back: a slow audio sink stalls listen, which stops acknowledging text
+# (see SEND_WINDOW), which stalls send_text, text_chunker and finally chat_completion.
+QUEUE_BOUNDS = {
+    'text_queue': (None, 2000),
+    'chunked_text_queue': (None, 2000),
+    'audio_queue': (None, 256 * 1024),  # ~16s of mp3_44100_128 audio
+    'send_queue': (None, 2000),                 # Uncached sentences (SENTENCE_CACHE)
+    'segment_queue': (64, None),                # Sentences waiting to be spliced (SENTENCE_CACHE)
+    'live_audio_queue': (None, 256 * 1024),     # Synthesized audio waiting to be spliced (SENTENCE_CACHE)
+}
+
+# Largest number of chars sent to ElevenLabs but not synthesized yet. None disables it. Must be larger than the text
+# ElevenLabs buffers before it starts generating.
+SEND_WINDOW = 1000
+
+# Furthest a response resumed after a disconnect is moved back from the continue point, to start at the clause or
+# word it falls in rather than mid-word. The audio synthesized again is dropped. 0 resumes at the continue point.
+RESUME_MAX_REWIND = alignment.DEFAULT_MAX_REWIND
+
+# Seconds send_text waits on a full SEND_WINDOW before sending a keep-alive. ElevenLabs closes sockets after 20s
+# without input.
+KEEPALIVE_INTERVAL = 10.0
+
+# On-disk cache of synthesized audio (audio_cache.AudioCache), or None to always synthesize. Set AUDIO_CACHE_DIR to
+# enable it.
+AUDIO_CACHE = audio_cache.AudioCache(os.environ["AUDIO_CACHE_DIR"]) if os.environ.get("AUDIO_CACHE_DIR") else None
+
+# Sentence-granularity audio cache. When set, each completed sentence is looked up before it is sent: cached sentences
+# are played from the cache and only the others are synthesized, with the audio spliced back into text order. Text is
+# held back until its sentence is complete, and sent word by word. Set SENTENCE_CACHE_DIR to enable it.
+SENTENCE_CACHE = audio_cache.AudioCache(os.environ["SENTENCE_CACHE_DIR"]) if os.environ.get("SENTENCE_CACHE_DIR") else None
+
+# Silence after speech that ends the user's query (see vad.Endpointer). Shorter answers sooner but may cut the user
+# off mid-sentence.
+VAD_HANGOVER_MS = vad.DEFAULT_HANGOVER_MS
+
+# Speech recognition backend (recognition.Recognizer). Set STT_TRANSCRIPTS to a transcript file to answer from it
+# instead of Google (see recognition.FileRecognizer).
+STT_RECOGNIZER = recognition.FileRecognizer(os.environ["STT_TRANSCRIPTS"]) if os.environ.get("STT_TRANSCRIPTS") \
+    else recognition.GoogleRecognizer()
+
+# Seconds to wait for the user's utterance to be endpointed, and for it to be recognized. None waits indefinitely.
+LISTEN_TIMEOUT = None
+STT_TIMEOUT = recognition.DEFAULT_TIMEOUT
+
+# Keep listening while the answer plays, and cut it off as soon as the user starts speaking. Needs headphones or echo
+# cancellation, otherwise the answer interrupts itself, so it is off unless BARGE_IN is set.
+BARGE_IN = bool(os.environ.get("BARGE_IN"))
+
+# Speech that interrupts the answer. Longer than a query has to be, so a cough doesn't cut the answer off
+BARGE_IN_MIN_SPEECH_MS = 150
+
+# Seconds the interrupted turn has to stop in: the OpenAI stream, the websocket stages and playback
+BARGE_IN_DEADLINE = 0.1
+
+# Command used to play the streamed mp3 audio from stdin
+AUDIO_PLAYER_COMMAND = ["mpv", "--no-cache", "--no-terminal", "--", "fd://0"]
+
+# Keep one player process for the whole session instead of starting one per turn
+PERSISTENT_PLAYER = True
+
+# Rate the player consumes audio at (ElevenLabs' default mp3_44100_128 output). Used to wait for playback to finish
+# when the player is kept open between turns. None if the player doesn't play in real time.
+AUDIO_BYTES_PER_SECOND = 128_000 / 8
+
 class MPVProcessSingleton:
     _instance = None
 
@@ -71,85 +201,208 @@ class MPVProcessSingleton:
         if cls._instance is None:
             cls._instance = super(MPVProcessSingleton, cls).__new__(cls)
             cls._instance.process = None
+            cls._instance.interrupted = False   # Set by kill_process(). Writes are dropped until resume()
+            cls._instance.playback_end = 0.0
+            cls._instance.writing = 0       # Size of the chunk write() is blocked on
         return cls._instance
 
     def is_installed(self, lib_name):
         return shutil.which(lib_name) is not None
 
     def start_process(self):
-        if not self.is_installed("mpv"):
+        if not self.is_installed(AUDIO_PLAYER_COMMAND[0]):
             app_logger.error("mpv not found, necessary to stream audio. Install it for proper functionality.")
             raise ValueError("mpv not found, necessary to stream audio. Install instructions: https://mpv.io/installation/")
 
         if self.process is None or self.process.poll() is not None:
+            if self.process is not None:
+                app_logger.warning(f"mpv exited with code {self.process.returncode}. Restarting it.")
+                metrics.count('player_restart')
             multi_log("Starting mpv process", loggers=['app', 'stream'])
+            start = time.perf_counter()
             self.process = subprocess.Popen(
-                ["mpv", "--no-cache", "--no-terminal", "--", "fd://0"],
+                AUDIO_PLAYER_COMMAND,
                 stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
             )
+            metrics.observe('player.startup_ms', (time.perf_counter() - start) * 1000)
+            metrics.count('player_start')
+
+    def write(self, chunk):
+        """
+        Writes audio to the player, restarting it if it died. Blocks while the pipe is full. Dropped after
+        kill_process(), so a write that was already on its way isn't heard, or restarts the player, after it.
+        """
+        self.writing = len(chunk)
+        try:
+            for attempt in range(2):
+                if self.interrupted:
+                    return
+                self.start_process()
+                process = self.process
+                try:
+                    process.stdin.write(chunk)
+                    process.stdin.flush()
+                    break
+                except BrokenPipeError:
+                    with contextlib.suppress(OSError):
+                        process.stdin.close()
+                    if self.interrupted:
+                        return      # Interrupted while writing. The chunk isn't to be heard
+                    process.wait()     # Dead. start_process() replaces it
+            else:
+                raise BrokenPipeError("mpv closed its input twice in a row")
+        finally:
+            self.writing = 0
+
+        # Estimate when the audio written so far finishes playing
+        if AUDIO_BYTES_PER_SECOND:
+            self.playback_end = max(self.playback_end, time.monotonic()) + len(chunk) / AUDIO_BYTES_PER_SECOND
+
+    def buffered_bytes(self):
+        """Estimate of the audio given to write() that hasn't played yet, the chunk it is blocked on included."""
+        if not AUDIO_BYTES_PER_SECOND:
+            return self.writing
+        return max(0.0, self.playback_end - time.monotonic()) * AUDIO_BYTES_PER_SECOND + self.writing
+
+    async def wait_for_playback(self):
+        """Waits until the audio written so far has played, leaving the player open for the next turn."""
+        remaining = self.playback_end - time.monotonic()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
 
     def stop_process(self):
         if self.process and self.process.stdin:
             multi_log("Stopping mpv process...", loggers=['app', 'stream'])
+            start = time.perf_counter()
             # self.process.terminate()
-            self.process.stdin.close()
-            self.process.wait()
+            with contextlib.suppress(BrokenPipeError):
+                self.process.stdin.close()
+            self.process.wait()     # Returns once the buffered audio has played
             self.process = None
+            metrics.observe('player.stop_ms', (time.perf_counter() - start) * 1000)
             multi_log("Stopped mpv process", loggers=['app', 'stream'])
 
+    def resume(self):
+        """Lets write() play audio again after kill_process(), starting a new process."""
+        self.interrupted = False
+
+    def kill_process(self):
+        """Stops playback at once, dropping buffered audio and the writes still to come until resume()."""
+        self.interrupted = True
+        if self.process:
+            multi_log("Killing mpv process", loggers=['app', 'stream'])
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+            self.playback_end = 0.0
+
 
 
-async def text_chunker(input_queue, output_queue):
-    """Split text into chunks (words) and place them into an output queue."""
-    buffer = ""
+def make_queue(name):
+    """Returns an inter-stage queue bounded by QUEUE_BOUNDS."""
+    max_items, max_size = QUEUE_BOUNDS.get(name, (None, None))
+    return queues.BoundedQueue(name, max_items, max_size)
+
+
+def make_chunker():
+    """Returns a chunker configured by CHUNK_SCHEDULE, and tags the turn with it."""
+    metrics.tag('chunk_schedule', list(CHUNK_SCHEDULE) if CHUNK_SCHEDULE else None)
+    if not CHUNK_SCHEDULE:
+        return chunking.WordChunker()
+    metrics.tag('chunk_idle_timeout', CHUNK_IDLE_TIMEOUT)
+    return chunking.AdaptiveChunker(CHUNK_SCHEDULE, CHUNK_IDLE_TIMEOUT)
+
+
+async def text_chunker(input_queue, output_queue, chunker=None, prefix=None, ended=None):
+    """
+    Split text into chunks (words by default) and place them into an output queue.
+    prefix is chunked before anything from input_queue, e.g. the unspoken text of a response being resumed.
+    ended (asyncio.Event), if given, is set once the end of text has been taken from input_queue.
+    """
+    chunker = chunker or chunking.WordChunker()
+    idle_timeout = getattr(chunker, 'idle_timeout', None)
     logger = logging.getLogger('text_chunker')
+    debug = logger.isEnabledFor(logging.DEBUG)
 
     async def put_in_queue(data, queue):
-        logger.debug(f"Adding to queue: {repr(data)}")
+        if data is not None:
+            metrics.record('chunk')
+            metrics.observe('chunk.chars', len(data))
         await queue.put(data)
+        metrics.observe_queue('chunked_text_queue', queue)
+
+    if prefix:
+        for chunk in chunker.feed(prefix):
+            await put_in_queue(chunk, output_queue)
 
     while True:
-        text = await input_queue.get()
-        logger.debug(f"Chunker received text: {repr(text)}")
+        if idle_timeout and chunker.pending():
+            try:
+                text = await asyncio.wait_for(input_queue.get(), idle_timeout)
+            except asyncio.TimeoutError:  # LLM stalled. Send what is buffered so audio doesn't stall too
+                chunk = chunker.flush_idle()
+                logger.debug(f"Idle for {idle_timeout}s. Flushing: {repr(chunk)}")
+                metrics.count('idle_flush')
+                await put_in_queue(chunk, output_queue)
+                continue
+        else:
+            text = await input_queue.get()
         
         if text is None:  # End of input
             multi_log("Text chunker reached end of text queue.", loggers=['app', 'text_chunker'])
-            if buffer:
-                await put_in_queue(buffer + " ", output_queue)
-                buffer = "" # Reset buffer
+            if ended is not None:
+                ended.set()
+            chunk = chunker.flush()
+            if chunk:
+                logger.debug(f"Adding to queue: {repr(chunk)}")
+                await put_in_queue(chunk, output_queue)
             await put_in_queue(None, output_queue) # Signal completion
             break
 
-        for char in text:
-            if char == " ": # We have reached end of word. Send contents of buffer
-                if buffer:
-                    await put_in_queue(buffer + " ", output_queue)
-                    buffer = ""
-            else:
-                buffer += char
-        
-        logger.debug(f"Buffer: {repr(buffer)}")
+        chunks = chunker.feed(text)
+        if debug:   # Skip formatting the message when DEBUG is off; this runs once per token
+            logger.debug(f"Chunker received text: {repr(text)}. Adding to queue: {repr(chunks)}")
+        for chunk in chunks:
+            await put_in_queue(chunk, output_queue)
 
 
-async def send_text(websocket, chunked_text_queue):
-    """Send chunked text from the queue to ElevenLabs API."""
+async def send_text(websocket, chunked_text_queue, try_trigger_generation=False, window=None):
+    """
+    Send chunked text from the queue to ElevenLabs API. chunking.Flush chunks are synthesized right away.
+    If a queues.SendWindow is given, waits for room in it before taking each chunk.
+    """
     
     logger = logging.getLogger('send_text')
     
     while True:
+        if window is not None:
+            while not await window.wait(KEEPALIVE_INTERVAL):
+                logger.debug("Send window full. Sending keep-alive")
+                await websocket.send(json.dumps({"text": " "}))
         chunked_text = await chunked_text_queue.get()
         if chunked_text is None:  # End of chunked text. Signal the end of the text stream
             multi_log("Send text reached end of chunked text queue. Sending EOS signal.", loggers=['app', 'send_text'])
             await websocket.send(json.dumps({"text": ""}))
             break
-        text_message = {"text": chunked_text, "try_trigger_generation": False}
+        text_message = {"text": chunked_text, "try_trigger_generation": try_trigger_generation}
+        if isinstance(chunked_text, chunking.Flush):
+            text_message["flush"] = True
         logger.debug(f"Sending text to ElevenLabs for TTS: {repr(chunked_text)}")
         await websocket.send(json.dumps(text_message))
+        metrics.record('frame_sent')
+        if window is not None:
+            window.advance(len(chunked_text))
     
 
 
-async def listen(websocket, audio_queue, chars_received):
-    """Listen to the websocket for audio data and stream it."""
+async def listen(websocket, audio_queue, chars_received, tracker=None, window=None, recorder=None, timeline=None,
+                 trimmer=None):
+    """
+    Listen to the websocket for audio data and stream it. Received chars are fed to the alignment tracker, if given,
+    and acknowledged in the send window. Audio frames are also given to the audio_cache.Recorder, if given, and added
+    to the playback.PlaybackTimeline, if given. A resumed connection's audio is passed through the
+    splicing.OverlapTrimmer, if given, so what was already heard isn't played again.
+    """
 
     logger = logging.getLogger('listen')
     multi_log("Started listening to websocket", loggers=['app', 'listen'])
@@ -158,16 +411,34 @@ async def listen(websocket, audio_queue, chars_received):
         message = await websocket.recv()
         data = json.loads(message)
         
+        audio_data = None
         if data.get("audio"):   # Audio key might be absent, or value could be null. Don't proceed if either
-            audio_data = base64.b64decode(data.pop('audio'))
+            audio_data = splicing.AudioFrame(base64.b64decode(data.pop('audio')), data.get("normalizedAlignment"))
+            metrics.record('audio_frame')
+            metrics.count('audio_bytes', len(audio_data))
             logger.debug(f"Data received (audio-omitted): {json.dumps(data)}")
-            await audio_queue.put(audio_data)  # Place audio data into the queue
+            if trimmer is not None:
+                audio_data = trimmer.trim(audio_data)
+            if audio_data is not None:
+                if recorder is not None:
+                    recorder.add(audio_data, data.get("normalizedAlignment"))
+                await audio_queue.put(audio_data)  # Place audio data into the queue
+                metrics.observe_queue('audio_queue', audio_queue)
         else:
             logger.debug(f"Data received: {json.dumps(data)}")
         
         if data.get("normalizedAlignment"):   
             if data["normalizedAlignment"].get("chars"):
                 chars_received.extend(data["normalizedAlignment"]["chars"])  # Accumulate received characters
+                if tracker is not None:
+                    tracker.feed(data["normalizedAlignment"]["chars"])
+                    if window is not None:
+                        window.ack(tracker.aligned_upto)
+                metrics.count('alignment_chars', len(data["normalizedAlignment"]["chars"]))
+
+        if timeline is not None and audio_data is not None:
+            # Once the frame has played, the response has been spoken up to the tracker's continue point
+            timeline.add(len(audio_data), audio_data.alignment, tracker.continue_point if tracker is not None else None)
         
         if data.get('isFinal'):
             multi_log("Received final audio response", loggers=['app', 'listen'])
@@ -176,10 +447,15 @@ async def listen(websocket, audio_queue, chars_received):
             break
 
 
-async def stream(audio_queue):
-    mpv_singleton = MPVProcessSingleton()
-    mpv_singleton.start_process()
-    mpv_process = mpv_singleton.process
+def default_sink():
+    """Returns the mpv sink, kept open between turns if PERSISTENT_PLAYER is set."""
+    return sinks.PlayerSink(MPVProcessSingleton(), persistent=PERSISTENT_PLAYER)
+
+
+async def stream(audio_queue, sink=None, timeline=None):
+    """Writes audio from the queue to sink (mpv playback by default). Bytes written are counted in timeline, if given."""
+    sink = sink or default_sink()
+    sink.start()
 
     logger = logging.getLogger('stream')
     multi_log("Started streaming audio", loggers=['app', 'stream'])
@@ -188,10 +464,23 @@ async def stream(audio_queue):
         if chunk is None:  # Check for the signal to end streaming
             multi_log("Stream reached end of audio queue", loggers=['app', 'stream'])
             break
-        mpv_process.stdin.write(chunk)
-        mpv_process.stdin.flush()
 
-    mpv_singleton.stop_process()
+        if timeline is not None:
+            timeline.written_bytes += len(chunk)    # Counted as it's written, so a long write is playing meanwhile
+        start = metrics.clock()
+        if sink.blocking:
+            # Write from a worker thread: a full pipe blocks the writer, not the event loop. Awaiting it one chunk at
+            # a time keeps the order and holds further audio back until the player has drained the pipe.
+            await asyncio.to_thread(sink.write, chunk)
+        else:
+            sink.write(chunk)
+        blocked_ms = (metrics.clock() - start) * 1000
+        metrics.observe('stream.write_ms', blocked_ms)
+        metrics.count('write_blocked_ms', blocked_ms)
+        metrics.record('playback')
+        metrics.count('bytes_written', len(chunk))
+
+    await sink.finish()
 
 
 def get_remaining_chars_to_send(chars_to_send: list, chars_received: list) -> list:
@@ -205,210 +494,425 @@ def get_remaining_chars_to_send(chars_to_send: list, chars_received: list) -> li
     logger.debug(f"Characters received. Len: {len(chars_received)}.")
     logger.debug(f"{json.dumps(chars_received)}")
 
+    # Determine where to continue in the text queue.
+    # Continue point is the index after the last character received succesfully.
+    result = alignment.align(chars_to_send, chars_received)
+    logger.debug(f"Continue point: {result.continue_point}. Confidence: {result.confidence:.3f}. Edit cost: {result.cost}")
 
-    def custom_decode(char):
-        special_chars = {
-            "\u2018": "'",  # Left single quotation mark
-            "\u2019": "'",  # Right single quotation mark
-            "\u201C": '"',  # Left double quotation mark
-            "\u201D": '"',  # Right double quotation mark
-            "\u2013": "-",  # En dash
-            "\u2014": "-",  # Em dash
-            "\u2026": "...",  # Horizontal ellipsis
-            "\u2022": "*",  # Bullet
-            "\u00A3": "GBP",  # Pound sign
-            "\u20AC": "EUR",  # Euro sign
-            "\u00D7": "x",  # Multiplication sign
-            "\u00F7": "/",  # Division sign
-            # Add more special characters as needed
-        }
-        return special_chars.get(char, char)
-
-    # Format chars to send for easier comparison with characters received
-    chars_to_send_formatted = [custom_decode(c) for c in chars_to_send]
-
-    # Format chars received for easier comparison
-    chars_received_formatted = chars_received[1:]   # Remove leading space in chars_received
-    
-    # Log formatted versions for troubleshooting
-    logger.debug(f"Characters to send formatted. Len: {len(chars_to_send_formatted)}.")
-    logger.debug(f"{json.dumps(chars_to_send_formatted)}")
-    logger.debug(f"Characters received formatted. Len: {len(chars_received_formatted)}.")
-    logger.debug(f"{json.dumps(chars_received_formatted)}")
+    if result.confidence < ALIGNMENT_MIN_CONFIDENCE:
+        logger.warning(f"Low confidence alignment ({result.confidence:.3f}). Received text diverged from text sent.")
+        logger.debug(f"Context for chars_to_send: {json.dumps(chars_to_send[max(0, result.continue_point-20):result.continue_point+20])}")
+        logger.debug(f"Context for chars_received: {json.dumps(chars_received[-40:])}")
 
+    if result.continue_point >= len(chars_to_send):
+        logger.info("All characters received. No need to find continue point.")
+        return []
 
-    # Determine where to continue in the text queue.
-    # Continue point is the index after the last character received succesfully. 
-    continue_point = None
-    
-    # The index in the second array.
-    # This is where the matching character should be in the second array.
-    # The matching character is allowed to be at most (j + displacement tolerance away)
-    j = 0
-    displacement_tolerance = 2
+    remaining_chars = chars_to_send[result.continue_point:]
 
-    for i in range(len(chars_to_send_formatted)):
-        # The character to match
-        char = chars_to_send_formatted[i]
+    logger.debug(f"Remaining chars. Len {len(remaining_chars)}")
+    logger.debug(f"{json.dumps(remaining_chars)}")
+    return remaining_chars
 
-        if char == "\n":
-            continue
 
-        # If j pointer in bounds:
-        if j < len(chars_received_formatted):
-            
-            # The matching character is allowed to be at most (j + displacement tolerance away)
-            # If the matching character is not exactly at j, but within the tolerance, update j, and log that occurrence
-            # Else, throw an error and populate logs
-            try:
-                index_of_next_matching_char = chars_received_formatted.index(char, j)
-                if index_of_next_matching_char == j:
-                    pass
-                
-                elif index_of_next_matching_char - j <= displacement_tolerance:
-                    logger.warning(f"Idiosyncracy found. Expected matching char '{char}' to be at {j}. Was found at {index_of_next_matching_char}")
-                    logger.debug(f"Context for chars_to_send: {json.dumps(chars_to_send_formatted[max(0, i-10):i+10])}")
-                    logger.debug(f"Context for chars_received: {json.dumps(chars_received_formatted[max(0, j-10):j+10])}")
-
-                    # Set j to index of matching char 
-                    j = index_of_next_matching_char
-                
-                else:
-                    logger.error(f"Index of next matching char not within tolerance. Expected char '{char}' to be at {j}. Was found at {index_of_next_matching_char}. Displacement tolerance: {displacement_tolerance}")
-                    logger.error(f"Context for chars_to_send: {json.dumps(chars_to_send_formatted[max(0, i-10):i+10])}")
-                    logger.error(f"Context for chars_received (centered at j): {json.dumps(chars_received_formatted[max(0, j-10):j+10])}")
-                    logger.error(f"Context for chars_received (centered at index of next_next_matching_char): {json.dumps(chars_received_formatted[max(0, index_of_next_matching_char-10):index_of_next_matching_char+10])}")
-                    raise Exception(f"Could not confirm that the current char was received within the displacement tolerance. Char: '{char}'")
-
-                # Increment j
-                j += 1
-            
+async def connect_tts(uri):
+    """Opens a stream-input websocket at uri and sends the init message."""
+    websocket = await websockets.connect(uri)
+    app_logger.info("WebSocket connection established with ElevenLabs API.")
+    await init_tts(websocket)
+    return websocket
 
-            except ValueError as e: # If can't find matching char in chars received
-                logger.warning(f"Index() could not find a match for char '{char}' at position {i}")
-                logger.debug(f"Context for chars_to_send: {json.dumps(chars_to_send_formatted[max(0, i-10):i+10])}")
-                logger.debug(f"Context for chars_received (centered at j): {json.dumps(chars_received_formatted[max(0, j-10):j+10])}")
-                continue_point = i
-                break
 
+async def init_tts(websocket):
+    """Sends the init message that opens a stream-input connection."""
+    init_message = {
+        "text": " ",
+        "voice_settings": VOICE_SETTINGS,
+        "xi_api_key": ELEVENLABS_API_KEY,
+    }
+    await websocket.send(json.dumps(init_message))
 
-        else: # If reached end of received chars, then the current un-matched char is the continue point
-            logger.info("Found continue point")
-            continue_point = i
-            break
 
-    # If loop exited naturally (went out of bounds), then all characters were matched...
-    if continue_point is None:
-        logger.info("All characters received. No need to find continue point.")
-        return []
+def tts_uri(voice_id):
+    return ELEVENLABS_WS_URI.format(voice_id=voice_id, model_id=MODEL_ID, api_key=ELEVENLABS_API_KEY)
 
-    logger.debug(f"Continue point: {continue_point}")
-    remaining_chars = chars_to_send[continue_point:]
 
-    logger.debug(f"Remaining chars. Len {len(remaining_chars)}")
-    logger.debug(f"{json.dumps(remaining_chars)}")
-    return remaining_chars
+def audio_cache_key(voice_id, text):
+    return audio_cache.cache_key(voice_id, MODEL_ID, VOICE_SETTINGS, text)
 
 
-async def text_to_speech_input_streaming(voice_id, text_queue, chars_to_send):
-    chunked_text_queue = asyncio.Queue() 
-    audio_queue = asyncio.Queue()
-    chars_received = []
+async def play_cached(audio, frames, audio_queue):
+    """Queues cached audio frame by frame, as listen does for a live response."""
+    offset = 0
+    for frame in frames:
+        metrics.record('audio_frame')
+        await audio_queue.put(audio[offset:offset + frame['audio_bytes']])
+        offset += frame['audio_bytes']
+    await audio_queue.put(None)
 
-    while True:
-        try:
-            # uri = f"wss://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream-input?model_id=eleven_monolingual_v1&xi_api_key={ELEVENLABS_API_KEY}"
-            uri = f"wss://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream-input?model_id=eleven_multilingual_v2&xi_api_key={ELEVENLABS_API_KEY}"
-            async with websockets.connect(uri) as websocket:
-                app_logger.info("WebSocket connection established with ElevenLabs API.")
-                init_message = {
-                    "text": " ",
-                    "voice_settings": {"stability": 0.70, "similarity_boost": 0.75},
-                    "xi_api_key": ELEVENLABS_API_KEY,
-                }
-                await websocket.send(json.dumps(init_message))
-
-                # Start the text_chunker, send_text, listen, and stream concurrently
-                await asyncio.gather(
-                    text_chunker(text_queue, chunked_text_queue),
-                    send_text(websocket, chunked_text_queue),
-                    listen(websocket, audio_queue, chars_received),
-                    stream(audio_queue)
-                )
-                
-            break  # Exit the loop if everything went well
-        
-        except websockets.exceptions.ConnectionClosed as e:
-            app_logger.warning(f"WebSocket connection closed unexpectedly: {e}. Retrying...")
-            
-            remaining_chars = get_remaining_chars_to_send(chars_to_send, chars_received)
 
-            # Add remaining text to queue
-            text_queue = asyncio.Queue()
-            await text_queue.put(''.join(remaining_chars))
-            await text_queue.put(None)
+async def sentence_splicer(chunked_text_queue, send_queue, segment_queue, cache, voice_id):
+    """
+    Groups chunks into sentences and looks each one up in the sentence cache. Every sentence goes to segment_queue in
+    text order. Only uncached ones are passed on to send_text, their last chunk as a Flush so ElevenLabs generates
+    them on their own, and their audio can be told apart.
+    """
+    logger = logging.getLogger('splicing')
+    pieces = []
+
+    async def emit():
+        sentence = pieces[:]
+        pieces.clear()
+        text = ''.join(sentence)
+        if not text.strip():
+            return
+        cached = await asyncio.to_thread(cache.get, audio_cache_key(voice_id, text))
+        logger.debug(f"Sentence {'cached' if cached else 'live'}: {repr(text)}")
+        await segment_queue.put(splicing.Segment(text, cached))
+        if cached:
+            metrics.count('sentence_cache_chars', len(text))   # Chars not billed
+            return
+        for piece in sentence[:-1]:
+            await send_queue.put(piece)
+        await send_queue.put(chunking.Flush(sentence[-1]))
 
-            # Reset chars_to_send, chars_received, chunked_text queue, and audio_queue
-            chars_to_send = remaining_chars
-            chars_received = []
-            chunked_text_queue = asyncio.Queue()
+    while True:
+        chunk = await chunked_text_queue.get()
+        if chunk is None:
+            await emit()
+            await segment_queue.put(None)
+            await send_queue.put(None)
+            break
+        for piece, ends_sentence in splicing.split_sentences(chunk):
+            pieces.append(piece)
+            if ends_sentence:
+                await emit()
 
 
-            
-        except Exception as e:
-            app_logger.error(f"An unexpected error occurred: {e}")
+async def splice_audio(segment_queue, live_queue, audio_queue, cache, voice_id, tracker=None, window=None,
+                       recorder=None, timeline=None, trimmer=None):
+    """
+    Puts the audio of each sentence in segment_queue into audio_queue, in text order: cached sentences straight from
+    the cache, live ones from the frames listen received until their chars are covered. Takes over listen's
+    alignment, send window, recorder, timeline and trimmer duties, since only here are frames in text order. Live sentences whose
+    alignment matches their text exactly are stored in the sentence cache.
+    """
+    live_ended = False
+
+    async def forward(frame):
+        if tracker is not None and frame.chars:
+            tracker.feed(frame.chars)
+            if window is not None:
+                window.ack(tracker.aligned_upto)
+        if trimmer is not None:
+            frame = trimmer.trim(frame)
+            if frame is None:
+                return
+        if recorder is not None:
+            recorder.add(frame, frame.alignment)
+        if timeline is not None:
+            timeline.add(len(frame), frame.alignment, tracker.continue_point if tracker is not None else None)
+        await audio_queue.put(frame)
+
+    while True:
+        segment = await segment_queue.get()
+        if segment is None:
+            while not live_ended:   # Anything synthesized past the last sentence, e.g. a trailing space
+                frame = await live_queue.get()
+                live_ended = frame is None
+                if not live_ended:
+                    await forward(frame)
+            await audio_queue.put(None)
             break
 
+        if segment.cached:
+            audio, frames = segment.cached
+            offset = 0
+            for frame in frames:
+                metrics.record('cached_frame')
+                await forward(splicing.AudioFrame(audio[offset:offset + frame['audio_bytes']], frame['normalizedAlignment']))
+                offset += frame['audio_bytes']
+            continue
+
+        needed = splicing.spoken_length(segment.text)
+        spoken = 0
+        frames = []
+        while spoken < needed and not live_ended:
+            frame = await live_queue.get()
+            if frame is None:
+                live_ended = True
+                break
+            spoken += splicing.spoken_chars(frame.chars)
+            frames.append(frame)
+            await forward(frame)
+        if spoken == needed and frames:
+            metrics.count('sentence_cache_store')
+            await asyncio.to_thread(cache.put, audio_cache_key(voice_id, segment.text), segment.text, b''.join(frames),
+                                    [{'audio_bytes': len(frame), 'normalizedAlignment': frame.alignment} for frame in frames])
+
+
+async def run_stages(*stages, watch=None):
+    """
+    Runs pipeline stages concurrently and returns their results. Unlike asyncio.gather, if a stage (or the watch
+    task) fails, the other stages are cancelled before the error is raised, so none is left blocked on a queue.
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        pending = set(tasks) | ({watch} if watch is not None else set())
+        while not all(task.done() for task in tasks):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        return [task.result() for task in tasks]
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def text_to_speech_input_streaming(voice_id, text_queue, chars_to_send, uri=None, pool=None, sink=None,
+                                         cache=None, sentence_cache=None, timeline=None, use_cache=True):
+    """
+    Streams text_queue through ElevenLabs and writes the audio to sink (mpv playback by default).
+    Connections come from pool when one is given.
+
+    With an audio cache (AUDIO_CACHE by default), text that is fully queued before synthesis starts, e.g. a stock
+    reply, is played from the cache without opening a connection when it has been spoken before, and is stored in the
+    cache otherwise if it was synthesized on a single connection. Text still streaming in, e.g. an LLM reply, can't be
+    looked up, so it isn't stored either.
+
+    With a sentence cache (SENTENCE_CACHE by default), sentences are looked up one by one and only uncached ones are
+    synthesized. See sentence_splicer and splice_audio.
+
+    use_cache=False bypasses both audio caches: nothing is looked up or stored.
+
+    With a playback.PlaybackTimeline, the audio played is mapped to the text spoken, across reconnects too.
+
+    If the connection drops, the response is resumed on a new one from the start of the word or clause the continue
+    point falls in (see alignment.resume_point), through a fresh chunker. The audio already queued keeps playing on
+    the same player, and the resumed audio it overlaps is dropped (see splicing.OverlapTrimmer).
+    """
+    cache = cache if cache is not None else AUDIO_CACHE
+    sentence_cache = sentence_cache if sentence_cache is not None else SENTENCE_CACHE
+    if not use_cache:
+        cache = sentence_cache = None
+        metrics.tag('audio_cache', 'bypass')
+    audio_queue = make_queue('audio_queue')
+    recorder = None
+    if cache is not None and getattr(text_queue, 'ended', False):
+        cached = await asyncio.to_thread(cache.get, audio_cache_key(voice_id, ''.join(chars_to_send)))
+        metrics.tag('audio_cache', 'hit' if cached else 'miss')
+        if cached:
+            await run_stages(play_cached(*cached, audio_queue), stream(audio_queue, sink))
+            return
+        recorder = cache.recorder()
+
+    chars_received = []
+    tracker = alignment.AlignmentTracker(chars_to_send)
+    start = 0           # Index in chars_to_send the current connection starts at
+    prefix = None       # Unspoken text to resend on the current connection
+    received_upto = 0   # Index in chars_to_send of the first char whose audio hasn't been queued
+    trimmer = None
+    text_ended = asyncio.Event()    # Set once a text_chunker has taken the end of text from text_queue
+
+    # One player for every connection of the turn, so audio queued before a disconnect is played once and in order
+    player = asyncio.create_task(stream(audio_queue, sink, timeline))
+    try:
+        while True:
+            try:
+                if pool is not None:
+                    websocket = await pool.acquire()
+                else:
+                    websocket = await connect_tts(uri or tts_uri(voice_id))
+                metrics.mark('websocket_ready')
+
+                try:
+                    # Start the text_chunker, send_text and listen concurrently, alongside the player
+                    chunked_text_queue = make_queue('chunked_text_queue')
+                    window = queues.SendWindow(SEND_WINDOW, start) if SEND_WINDOW else None
+                    if sentence_cache is None:
+                        chunker = make_chunker()
+                        stages = [
+                            text_chunker(text_queue, chunked_text_queue, chunker, prefix, text_ended),
+                            send_text(websocket, chunked_text_queue, chunker.try_trigger_generation, window),
+                            listen(websocket, audio_queue, chars_received, tracker, window, recorder, timeline,
+                                   trimmer),
+                        ]
+                    else:
+                        # Splice cached and live sentences. Word chunks, so that sentences can be told apart
+                        metrics.tag('sentence_cache', True)
+                        send_queue = make_queue('send_queue')
+                        segment_queue = make_queue('segment_queue')
+                        live_queue = make_queue('live_audio_queue')
+                        stages = [
+                            text_chunker(text_queue, chunked_text_queue, chunking.WordChunker(), prefix, text_ended),
+                            sentence_splicer(chunked_text_queue, send_queue, segment_queue, sentence_cache, voice_id),
+                            send_text(websocket, send_queue, False, window),
+                            listen(websocket, live_queue, chars_received),
+                            splice_audio(segment_queue, live_queue, audio_queue, sentence_cache, voice_id, tracker,
+                                         window, recorder, timeline, trimmer),
+                        ]
+                    await run_stages(*stages, watch=player)
+                finally:
+                    await websocket.close()
+
+                break  # Exit the loop if everything went well
+
+            except websockets.exceptions.ConnectionClosed as e:
+                app_logger.warning(f"WebSocket connection closed unexpectedly: {e}. Retrying...")
+                disconnected = time.perf_counter()
+                metrics.count('resume')
+
+                # The tracker has been aligning chars as they arrived, so the continue point is ready. A connection
+                # dropped while its overlap was being trimmed may not have got as far as the one before it
+                result = tracker.result()
+                app_logger.info(f"Continue point: {result.continue_point}/{len(chars_to_send)}. Confidence: {result.confidence:.3f}")
+                metrics.observe('alignment.confidence', result.confidence)
+                received_upto = max(received_upto, result.continue_point)
+                start = alignment.resume_point(chars_to_send, received_upto, RESUME_MAX_REWIND)
+                metrics.observe('resume.rewind_chars', received_upto - start)
+                prefix = ''.join(chars_to_send[start:])
+                if trimmer is not None and not trimmer.resumed:
+                    disconnected = trimmer.since    # Not recovered from the previous disconnect yet
+                trimmer = splicing.OverlapTrimmer(chars_to_send, start, received_upto,
+                                                  AUDIO_BYTES_PER_SECOND or playback.DEFAULT_BYTES_PER_SECOND,
+                                                  since=disconnected)
+
+                # Deltas still queued are already in chars_to_send, so in prefix. Later ones are read from text_queue.
+                # The end of text may have been taken by the cancelled text_chunker, so it is put back if it was sent.
+                ended = text_ended.is_set()
+                while not text_queue.empty():
+                    ended = text_queue.get_nowait() is None or ended
+                if ended:
+                    text_queue.put_nowait(None)
+
+                # Align what the next connection speaks from the resume point on. Its audio may overlap what was
+                # already received, so the response isn't cached
+                recorder = None
+                chars_received = []
+                tracker = alignment.AlignmentTracker(chars_to_send, start=start)
+
+            except Exception as e:
+                app_logger.error(f"An unexpected error occurred: {e}")
+                player.cancel()
+                recorder = None
+                # Nothing reads text_queue anymore. Consume the rest of the response so chat_completion doesn't block
+                # on the bounded queue, and the turn still returns the reply
+                if not text_ended.is_set():
+                    while await text_queue.get() is not None:
+                        pass
+                break
+
+        await asyncio.wait([player])
+        if not player.cancelled() and player.exception() is not None:
+            app_logger.error(f"Audio stream failed: {player.exception()}")
+        elif recorder is not None and recorder.frames and not recorder.overflowed:
+            text = ''.join(chars_to_send)
+            await asyncio.to_thread(cache.put, audio_cache_key(voice_id, text), text, recorder.audio(), recorder.frames)
+    finally:
+        player.cancel()
 
 
-async def chat_completion(messages, text_queue, chars_to_send):
+
+async def lookup_completion(messages, cache):
+    """Looks messages up in a completion cache. Returns (cache key, entry or None), and tags the turn hit or miss."""
+    key = completion_cache.cache_key(OPENAI_MODEL, OPENAI_TEMPERATURE, messages)
+    entry = await asyncio.to_thread(cache.get, key)
+    metrics.tag('completion_cache', 'hit' if entry else 'miss')
+    return key, entry
+
+
+async def chat_completion(messages, text_queue, chars_to_send, client=None, cache=None, use_cache=True, replay=None,
+                          lookup=None):
+    """
+    Streams the response to messages into text_queue. Returns the assistant message.
+
+    With a completion cache (COMPLETION_CACHE by default), a request made before is replayed from the cache instead
+    of querying OpenAI, at the pace given by replay (COMPLETION_REPLAY by default). use_cache=False bypasses the cache
+    for this request: it is neither looked up nor stored. lookup is the result of lookup_completion, if messages have
+    been looked up already.
+    """
     logger = logging.getLogger('chat_completion')
     multi_log(f"Sending query to OpenAI: {messages[-1]}", loggers=['app', 'chat_completion'])
+    metrics.count('prompt_tokens', history.prompt_tokens(messages))
+    metrics.count('prompt_messages', len(messages))
+    metrics.count('prompt_recalled', getattr(messages, 'recalled', 0))
+
+    cache = cache if cache is not None else COMPLETION_CACHE
+    if not use_cache:
+        cache = None
+        metrics.tag('completion_cache', 'bypass')
+
+    async def put_content(content):
+        metrics.record('token')
+        print(content, end='', flush=True)
+        logger.debug(f"Received content from OpenAI: {repr(content)}")
+        response_content.append(content)
+        await text_queue.put(content)  # Place the content into the queue
+        metrics.observe_queue('text_queue', text_queue)
+
+        # Keep track of every char received
+        for char in content:
+            chars_to_send.append(char)
+
+    role = None
+    response_content = []
+
+    if cache is not None:
+        key, entry = lookup or await lookup_completion(messages, cache)
+        if entry is not None:
+            multi_log("Replaying OpenAI response from the completion cache", loggers=['app', 'chat_completion'])
+            role = entry['role']
+            async for content in completion_cache.replay(entry, replay or COMPLETION_REPLAY):
+                await put_content(content)
+            await text_queue.put(None)
+            return {'role': role, 'content': "".join(response_content)}
+        recording = completion_cache.Recording()
 
-    response = await aclient.chat.completions.create(
-        model='gpt-4', 
+    client = client or aclient
+    response = await client.chat.completions.create(
+        model=OPENAI_MODEL, 
         messages=messages,
-        temperature=1, 
+        temperature=OPENAI_TEMPERATURE, 
         stream=True
     )
 
-    role = None
-    response_content = []
-    
-    async for chunk in response:        
-        delta = chunk.choices[0].delta
-
-        # Role only returned in first chunk. First chunk always empty string.
-        if delta.content == '':
-            role = delta.role
-            logger.debug(f"Role: {role}")
-
-        if delta.content is not None:
-            if delta.content != "": # OpenAI usually starts response with empty string
-                print(delta.content, end='', flush=True)
-                logger.debug(f"Received content from OpenAI: {repr(delta.content)}")
-                response_content.append(delta.content)
-                await text_queue.put(delta.content)  # Place the content into the queue
-
-                # Keep track of every char received
-                for char in delta.content:
-                    chars_to_send.append(char)
+    # Closed when the task is cancelled too, so OpenAI stops generating as soon as the user interrupts
+    try:
+        async for chunk in response:        
+            delta = chunk.choices[0].delta
+
+            # Role only returned in first chunk. First chunk always empty string.
+            if delta.content == '':
+                role = delta.role
+                logger.debug(f"Role: {role}")
+
+            if delta.content is not None:
+                if delta.content != "": # OpenAI usually starts response with empty string
+                    if cache is not None:
+                        recording.add(delta.content)
+                    await put_content(delta.content)
             
-            else:
-                logger.debug(f"Delta.content is empty string: {repr(delta.content)}")
+                else:
+                    logger.debug(f"Delta.content is empty string: {repr(delta.content)}")
 
-        else:
-            multi_log("Received end of OpenAI response", loggers=['app', 'chat_completion'])
-            logger.info(f"Response content: {json.dumps(response_content)}")
-            logger.debug(f"chars_to_send: {json.dumps(chars_to_send)}")
-            await text_queue.put(None)  # Sentinel value to indicate no more items will be added
+            else:
+                multi_log("Received end of OpenAI response", loggers=['app', 'chat_completion'])
+                logger.info(f"Response content: {json.dumps(response_content)}")
+                logger.debug(f"chars_to_send: {json.dumps(chars_to_send)}")
+                await text_queue.put(None)  # Sentinel value to indicate no more items will be added
+                if cache is not None:
+                    await asyncio.to_thread(cache.put, key, recording.entry(role))
             
-            # Return dict containing the role + response string
-            response_content_string = "".join(response_content)
-            ret_val = {'role': role, 'content': response_content_string}
-            logger.debug(f"ret_val: {json.dumps(ret_val)}")
-            return ret_val
-    
+                # Return dict containing the role + response string
+                response_content_string = "".join(response_content)
+                ret_val = {'role': role, 'content': response_content_string}
+                logger.debug(f"ret_val: {json.dumps(ret_val)}")
+                return ret_val
+    finally:
+        await response.close()
+
 
 # async def main():
 #     app_logger.info("Program started")
@@ -427,60 +931,173 @@ async def chat_completion(messages, text_queue, chars_to_send):
 #     )
 #     app_logger.info("Program finished")
 
-def speech_to_text():
-    # Initialize the recognizer
-    r = sr.Recognizer()
+async def run_turn(messages, client=None, uri=None, pool=None, sink=None, use_cache=True, timeline=None,
+                   use_audio_cache=True):
+    """
+    Streams the response to messages through TTS and playback. Returns the assistant message.
+    use_cache=False bypasses the completion cache for this turn, and use_audio_cache=False the audio and sentence
+    caches. The response's chars and playback are tracked in timeline (a playback.PlaybackTimeline), if given.
 
-    # Use the default microphone as the audio source
-    with sr.Microphone() as source:
-        print("Please say something:")
-        # Listen for the first phrase and extract the audio data
-        audio = r.listen(source)
+    With an audio cache (AUDIO_CACHE), a response replayed from the completion cache is queued in full before
+    synthesis starts, so it is played from the audio cache when it has been spoken before, and stored in it otherwise.
+    """
+    metrics.start_turn()
+
+    text_queue = make_queue('text_queue')
+    chars_to_send = timeline.chars_to_send if timeline is not None else []
+    lookup = None
+    if use_cache and use_audio_cache and COMPLETION_CACHE is not None and AUDIO_CACHE is not None:
+        lookup = await lookup_completion(messages, COMPLETION_CACHE)
+    try:
+        if lookup is not None and lookup[1] is not None:
+            text_queue = queues.BoundedQueue('text_queue')     # Holds the whole response
+            message = await chat_completion(messages, text_queue, chars_to_send, client=client, replay='instant',
+                                            lookup=lookup)
+            await text_to_speech_input_streaming(VOICE_ID, text_queue, chars_to_send, uri=uri, pool=pool, sink=sink,
+                                                 timeline=timeline, use_cache=use_audio_cache)
+            values = [message]
+        else:
+            values = await asyncio.gather(
+                chat_completion(messages, text_queue, chars_to_send, client=client, use_cache=use_cache,
+                                lookup=lookup),
+                text_to_speech_input_streaming(VOICE_ID, text_queue, chars_to_send, uri=uri, pool=pool, sink=sink,
+                                               timeline=timeline, use_cache=use_audio_cache)
+            )
+    except asyncio.CancelledError:
+        metrics.count('interrupted')
+        metrics.finish_turn()
+        raise
+    metrics.finish_turn()
+    return values[0]
 
-        try:
-            # Use Google's speech recognition
-            text = r.recognize_google(audio)
-            print("You said: " + text)
-            return text
-        except sr.UnknownValueError:
-            print("Google Speech Recognition could not understand audio")
-        except sr.RequestError as e:
-            print("Could not request results from Google Speech Recognition service; {0}".format(e))
+
+async def run_turn_with_barge_in(messages, source, client=None, uri=None, pool=None, sink=None):
+    """
+    Runs run_turn while listening to source. If the user starts speaking, the turn is cancelled: the OpenAI stream,
+    the websocket stages and playback. The time from detecting speech to the turn having stopped is recorded in the
+    barge_in.cancel_ms histogram.
+
+    Returns (assistant message, capture task of the user's next utterance). If the answer was interrupted, the message
+    holds only the words played before the user spoke, or is None if none were, so history keeps what was heard. The
+    capture keeps listening after the turn, so speech that interrupted the answer isn't lost.
+    """
+    speech = asyncio.Event()
+    timeline = playback.PlaybackTimeline([], AUDIO_BYTES_PER_SECOND or playback.DEFAULT_BYTES_PER_SECOND)
+    endpointer = vad.Endpointer(source.sample_rate, hangover_ms=VAD_HANGOVER_MS, min_speech_ms=BARGE_IN_MIN_SPEECH_MS)
+    capture = asyncio.create_task(vad.capture(source, endpointer, on_speech=speech.set))
+    turn = asyncio.create_task(run_turn(messages, client=client, uri=uri, pool=pool, sink=sink, timeline=timeline))
+    barge_in = asyncio.create_task(speech.wait())
+    try:
+        await asyncio.wait([turn, barge_in], return_when=asyncio.FIRST_COMPLETED)
+        if turn.done():
+            return turn.result(), capture
+    except BaseException:
+        turn.cancel()
+        capture.cancel()
+        raise
+    finally:
+        barge_in.cancel()
+
+    multi_log("User started speaking. Interrupting the answer", loggers=['app', 'stream'])
+    detected = time.perf_counter()
+    sink = sink or default_sink()
+    heard_bytes = max(0, timeline.written_bytes - sink.pending_bytes())    # Before interrupt() drops the buffer
+    turn.cancel()
+    sink.interrupt()    # Buffered audio would keep playing after the stream stops
+    done, _ = await asyncio.wait([turn], timeout=BARGE_IN_DEADLINE)
+    cancel_ms = (time.perf_counter() - detected) * 1000
+    metrics.observe('barge_in.cancel_ms', cancel_ms)
+    if not done:
+        app_logger.warning(f"Interrupted turn still running {cancel_ms:.0f}ms after speech was detected")
+
+    spoken = timeline.spoken_text(timeline.ms_at(heard_bytes))
+    metrics.observe('barge_in.unspoken_chars', len(timeline.chars_to_send) - len(spoken))
+    app_logger.info(f"Spoken before the interruption: {repr(spoken)}")
+    return ({'role': 'assistant', 'content': spoken} if spoken else None), capture
+
+
+async def speak(text, uri=None, pool=None, sink=None, cache=None):
+    """Speaks a known text, such as a stock reply. Played from the audio cache if it has been spoken before."""
+    text_queue = queues.BoundedQueue('text_queue')
+    text_queue.put_nowait(text)
+    text_queue.put_nowait(None)
+    await text_to_speech_input_streaming(VOICE_ID, text_queue, list(text), uri=uri, pool=pool, sink=sink, cache=cache)
+
+
+async def speech_to_text(source, recognizer=None, listen_timeout=None, recognize_timeout=None, capture=None):
+    """
+    Captures the user's next utterance from source (see vad.capture) and recognizes it. Returns the text, or None.
+    Capture and recognition run off the event loop, and stop when the task is cancelled or a timeout passes.
+    capture is a capture already listening to source, e.g. the one run_turn_with_barge_in returns.
+    """
+    recognizer = recognizer or STT_RECOGNIZER
+    listen_timeout = listen_timeout if listen_timeout is not None else LISTEN_TIMEOUT
+    recognize_timeout = recognize_timeout if recognize_timeout is not None else STT_TIMEOUT
+    if capture is None:
+        print("Please say something:")
+        capture = vad.capture(source, vad.Endpointer(source.sample_rate, hangover_ms=VAD_HANGOVER_MS))
+
+    try:
+        utterance = await asyncio.wait_for(capture, listen_timeout)
+    except asyncio.TimeoutError:
+        print("No speech heard")
+        return None
+    if utterance is None:
+        return None
+
+    try:
+        text = await recognition.recognize_speech(recognizer, utterance.audio_data(), recognize_timeout)
+    except recognition.RecognitionError as e:
+        print("Could not request results from the speech recognition service; {0}".format(e))
+        return None
+    if text is None:
+        print("Speech recognition could not understand audio")
+        return None
+    print("You said: " + text)
+    return text
 
 async def main():
     app_logger.info("Program started")
     
-    messages = []
+    with open(SYSTEM_MESSAGE_FILE, 'r') as f:
+        conversation = history.History(HISTORY_TOKEN_BUDGET, system=f.read(), index=MEMORY)
+    uri = tts_uri(VOICE_ID)
+    pool = connection_pool.ConnectionPool(lambda: connect_tts(uri))
+    sink = default_sink()
+    microphone = vad.MicrophoneSource()
+    microphone.open()
+    capture = None      # Capture of the next query started during the previous answer (BARGE_IN)
 
     while True:
         
         # Todo:
         # Speech to text
         # user_query = input("Enter your query or type 'exit' to quit: ")
-        user_query = speech_to_text()
+        pool.warm()     # Handshake while the user speaks
+        user_query = await speech_to_text(microphone, capture=capture)
+        capture = None
         if user_query is None: 
             continue
         
 
-        messages.append({'role': 'user', 'content': user_query})
-
-        # Ensure messages token size is under the limit. TODO: Implement better solution
-        if len(messages) > 10:
-            messages = messages[-10:]
+        conversation.append({'role': 'user', 'content': user_query})
 
         if user_query.lower() == 'exit':
             break
         
-        text_queue = asyncio.Queue()
-        chars_to_send = []
-        values = await asyncio.gather(
-            chat_completion(messages, text_queue, chars_to_send),
-            text_to_speech_input_streaming(VOICE_ID, text_queue, chars_to_send)
-        )
-
-        messages.append(values[0])
+        # Only the persona, the newest messages and relevant past exchanges that fit in HISTORY_TOKEN_BUDGET are sent
+        if BARGE_IN:
+            message, capture = await run_turn_with_barge_in(conversation.prompt(), microphone, pool=pool, sink=sink)
+            if message is not None:     # Only what was played if the user interrupted
+                conversation.append(message)
+        else:
+            conversation.append(await run_turn(conversation.prompt(), pool=pool, sink=sink))
         print('\n')
 
+    await pool.close()
+    sink.close()
+    microphone.close()
+    logging.getLogger('metrics').info(f"Session metrics: {json.dumps(metrics.snapshot())}")
     app_logger.info("Program finished")
 
 
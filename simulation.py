@@ -0,0 +1,288 @@
+import asyncio
+import selectors
+import collections
+from types import SimpleNamespace
+
+import websockets
+from websockets.frames import Close
+
+import sinks
+import metrics
+import sandbox
+import playback
+from fake_openai import FakeOpenAIServer
+from fake_elevenlabs import FakeElevenLabsServer
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """
+    Selector that doesn't wait for timers: when the loop would sleep until its next timer, the virtual clock is moved
+    to it instead. Real I/O, e.g. a worker thread waking the loop, is still polled, and waited for when there is
+    nothing else to do.
+    """
+
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:     # No timers. Only another thread can wake the loop
+            return super().select(None)
+        self.loop.now += timeout
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop with a virtual clock, starting at 0. The clock only moves when every task is waiting, and then jumps
+    straight to the next timer, so sleeps and timeouts take no real time and a run is timed the same way every time.
+
+    Worker threads (asyncio.to_thread, blocking sinks) run in real time while the clock may jump, so runs that use
+    them aren't reproducible.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(VirtualSelector(self))
+
+    def time(self):
+        return self.now
+
+
+def run(main):
+    """Runs coroutine main on a VirtualClockLoop and returns its result. Turn metrics are timed by the virtual clock."""
+    with asyncio.Runner(loop_factory=VirtualClockLoop) as runner:
+        clock, metrics.clock = metrics.clock, runner.get_loop().time
+        try:
+            return runner.run(main)
+        finally:
+            metrics.clock = clock
+
+
+def completion_chunk(content, role=None):
+    """Returns a streamed chat.completions chunk with the attributes chat_completion reads."""
+    delta = SimpleNamespace(role=role, content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None if content is not None else 'stop')])
+
+
+class CompletionStream:
+    """Chunks of one streamed completion, paced like fake_openai.FakeOpenAIServer.stream_completion."""
+
+    def __init__(self, server, tokens):
+        self.chunks = self.generate(server, tokens)
+
+    async def generate(self, server, tokens):
+        # OpenAI opens every stream with the role and an empty content string
+        if not tokens or tokens[0] != "":
+            tokens = [""] + list(tokens)
+
+        yield completion_chunk("", role='assistant')
+        await asyncio.sleep(server.ttft_ms / 1000)
+        for i, token in enumerate(tokens[1:]):
+            if i:
+                await asyncio.sleep(server.token_interval_ms / 1000)
+            server.stats['tokens_sent'] += 1
+            yield completion_chunk(token)
+        yield completion_chunk(None)
+
+    def __aiter__(self):
+        return self.chunks
+
+    async def close(self):
+        await self.chunks.aclose()
+
+
+class SimulatedOpenAI:
+    """
+    In-memory stand-in for an AsyncOpenAI client's streamed chat completions.
+
+    Args:
+        server (FakeOpenAIServer): Picks the tokens and their timings, and counts requests and tokens in its stats.
+            It isn't started.
+        latency_ms (float): One-way network latency. The stream starts after a round trip.
+    """
+
+    def __init__(self, server=None, latency_ms=0.0):
+        self.server = server or FakeOpenAIServer()
+        self.latency_ms = latency_ms
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        if not stream:
+            raise NotImplementedError("Only streamed completions are simulated")
+        self.server.stats['requests'] += 1
+        await asyncio.sleep(2 * self.latency_ms / 1000)
+        return CompletionStream(self.server, self.server.tokens_for(messages))
+
+
+class MemoryWebSocket:
+    """
+    One end of an in-memory websocket connection, with the parts of the websockets API the pipeline and the
+    ElevenLabs stand-in use: send(), recv(), close() and open. See memory_pipe().
+
+    Messages arrive latency_ms after they are sent, in order. Once either end has closed, send() raises
+    ConnectionClosed, and recv() does too once the messages that arrived before the close have been read.
+    """
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.peer = None
+        self.inbox = asyncio.Queue()
+        self.in_flight = collections.deque()
+        self.close_frame = None     # Close frame sent or received, once the connection is closing
+        self.close_received = False
+
+    @property
+    def open(self):
+        return self.close_frame is None
+
+    def connection_closed(self):
+        rcvd, sent = (self.close_frame, None) if self.close_received else (None, self.close_frame)
+        if self.close_frame.code in (1000, 1001):
+            return websockets.exceptions.ConnectionClosedOK(rcvd, sent)
+        return websockets.exceptions.ConnectionClosedError(rcvd, sent)
+
+    def transmit(self, message):
+        if not self.latency_ms:
+            self.peer.arrive(message)
+            return
+        # Every message is delayed as long, so each timer delivers the oldest one in flight
+        self.in_flight.append(message)
+        asyncio.get_running_loop().call_later(self.latency_ms / 1000, lambda: self.peer.arrive(self.in_flight.popleft()))
+
+    def arrive(self, message):
+        if isinstance(message, Close):
+            if self.close_frame is not None:
+                return
+            self.close_frame = message
+            self.close_received = True
+        elif self.close_frame is not None:  # Closed on this end meanwhile
+            return
+        self.inbox.put_nowait(message)
+
+    async def send(self, message):
+        if self.close_frame is not None:
+            raise self.connection_closed()
+        self.transmit(message)
+
+    async def recv(self):
+        while True:
+            if self.close_frame is not None and self.inbox.empty():
+                raise self.connection_closed()
+            message = await self.inbox.get()
+            if not isinstance(message, Close):
+                return message
+
+    async def close(self, code=1000, reason=""):
+        if self.close_frame is not None:
+            return
+        self.close_frame = Close(code, reason)
+        self.inbox.put_nowait(self.close_frame)     # Wakes a pending recv()
+        self.transmit(self.close_frame)
+
+
+def memory_pipe(latency_ms=0.0):
+    """Returns both ends (client, server) of an in-memory websocket connection."""
+    client, server = MemoryWebSocket(latency_ms), MemoryWebSocket(latency_ms)
+    client.peer, server.peer = server, client
+    return client, server
+
+
+class SimulatedElevenLabs:
+    """
+    In-memory stand-in for the ElevenLabs stream-input API. Every connection is served by the handler of a
+    fake_elevenlabs.FakeElevenLabsServer over a memory_pipe(), so synthesis, timings, stats and faults are the
+    stand-in's own.
+
+    Can be given to text_to_speech_input_streaming as its pool, in which case every acquire() opens a connection, or
+    be wrapped in a connection_pool.ConnectionPool(simulated.connect) to keep one warm.
+
+    Args:
+        server (FakeElevenLabsServer): Serves the connections. It isn't started.
+        latency_ms (float): One-way network latency. Opening a connection also takes a round trip.
+    """
+
+    def __init__(self, server=None, latency_ms=0.0):
+        self.server = server or FakeElevenLabsServer()
+        self.latency_ms = latency_ms
+        self.handlers = set()
+
+    async def connect(self):
+        """Opens an initialised connection, like sandbox.connect_tts."""
+        await asyncio.sleep((self.server.handshake_delay_ms + 2 * self.latency_ms) / 1000)
+        client, server = memory_pipe(self.latency_ms)
+        handler = asyncio.create_task(self.server.handler(server))
+        self.handlers.add(handler)
+        handler.add_done_callback(self.handlers.discard)
+        await sandbox.init_tts(client)
+        return client
+
+    async def acquire(self):
+        return await self.connect()
+
+
+class SimulatedSink(sinks.Sink):
+    """
+    Plays audio in virtual time: each write starts playing once the audio written before it has played, at
+    bytes_per_second, and finish() waits until all of it has been heard, like a persistent player. Writes never
+    block. Times are read from the event loop's clock, in seconds.
+
+    Args:
+        bytes_per_second (float): Rate the audio plays at.
+    """
+
+    def __init__(self, bytes_per_second=playback.DEFAULT_BYTES_PER_SECOND):
+        self.bytes_per_second = bytes_per_second
+        self.bytes_written = 0
+        self.chunks = 0
+        self.first_write = None
+        self.last_write = None
+        self.playing_until = None   # When the audio written so far will have played
+        self.gaps = []              # Silences (ms) between chunks, where playback ran out of audio
+        self.interrupted = None
+
+    def now(self):
+        return asyncio.get_running_loop().time()
+
+    def write(self, chunk):
+        now = self.now()
+        if self.first_write is None:
+            self.first_write = now
+        elif now > self.playing_until:
+            self.gaps.append((now - self.playing_until) * 1000)
+        self.last_write = now
+        self.playing_until = max(self.playing_until or now, now) + len(chunk) / self.bytes_per_second
+        self.bytes_written += len(chunk)
+        self.chunks += 1
+
+    async def finish(self):
+        if self.playing_until is not None:
+            await asyncio.sleep(max(0.0, self.playing_until - self.now()))
+
+    def pending_bytes(self):
+        if self.playing_until is None:
+            return 0
+        return max(0.0, self.playing_until - self.now()) * self.bytes_per_second
+
+    def interrupt(self):
+        self.interrupted = self.now()
+        self.playing_until = self.interrupted
+
+
+async def simulate_turn(messages, openai=None, elevenlabs=None, sink=None, pool=None):
+    """
+    Runs sandbox.run_turn on the in-memory stand-ins (defaults of SimulatedOpenAI, SimulatedElevenLabs and
+    SimulatedSink). It bypasses the completion cache and both audio caches (AUDIO_CACHE and SENTENCE_CACHE), so every
+    stage runs on the stand-ins whatever the environment sets. Connections come from pool when one is given, e.g. a
+    connection_pool.ConnectionPool over elevenlabs.connect. Returns (assistant message, metrics.TurnMetrics).
+
+    Run it with run() for virtual timings: a turn then takes as long as its Python code, not its audio.
+    """
+    openai = openai or SimulatedOpenAI()
+    elevenlabs = elevenlabs or SimulatedElevenLabs()
+    message = await sandbox.run_turn(messages, client=openai, pool=pool or elevenlabs, sink=sink or SimulatedSink(),
+                                     use_cache=False, use_audio_cache=False)
+    return message, metrics.current_turn.get()
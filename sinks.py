@@ -0,0 +1,168 @@
+import os
+import time
+import asyncio
+
+import metrics
+
+
+class Sink:
+    """
+    Destination for a turn's audio. stream() calls start() before the first chunk, write() for every chunk and
+    finish() after the last one. close() ends the session.
+
+    Sinks whose write() can block set blocking, and are written to from a worker thread.
+    """
+
+    blocking = False
+
+    def start(self):
+        pass
+
+    def write(self, chunk):
+        raise NotImplementedError
+
+    async def finish(self):
+        pass
+
+    def pending_bytes(self):
+        """Bytes written that haven't been heard yet, e.g. buffered by a player."""
+        return 0
+
+    def interrupt(self):
+        """Silences audio already written, e.g. when the user interrupts the answer. The next start() resumes."""
+        pass
+
+    def close(self):
+        pass
+
+
+class PlayerSink(Sink):
+    """
+    Plays audio through a player process such as sandbox.MPVProcessSingleton.
+
+    Args:
+        player: Object with start_process(), write(chunk), buffered_bytes(), wait_for_playback(), stop_process(),
+            kill_process() and resume().
+        persistent (bool): Keep the player open between turns, instead of stopping it after each one.
+    """
+
+    blocking = True
+
+    def __init__(self, player, persistent=True):
+        self.player = player
+        self.persistent = persistent
+
+    def start(self):
+        self.player.resume()    # A new turn plays again after an interrupt()
+        self.player.start_process()
+        metrics.tag('player', 'persistent' if self.persistent else 'per_turn')
+
+    def write(self, chunk):
+        self.player.write(chunk)
+
+    async def finish(self):
+        if self.persistent:
+            await self.player.wait_for_playback()   # Turn over once it has been heard. Stdin stays open
+        else:
+            await asyncio.to_thread(self.player.stop_process)
+
+    def pending_bytes(self):
+        return self.player.buffered_bytes()
+
+    def interrupt(self):
+        self.player.kill_process()
+
+    def close(self):
+        self.player.stop_process()
+
+
+class NullSink(Sink):
+    """Discards audio, keeping only byte counts and write times. For load tests and machines without audio."""
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.chunks = 0
+        self.first_write = None     # time.perf_counter() of the first and last write
+        self.last_write = None
+        self.interrupted = None     # time.perf_counter() of the last interrupt()
+
+    def write(self, chunk):
+        now = time.perf_counter()
+        if self.first_write is None:
+            self.first_write = now
+        self.last_write = now
+        self.bytes_written += len(chunk)
+        self.chunks += 1
+
+    def interrupt(self):
+        self.interrupted = time.perf_counter()
+
+
+class FileSink(Sink):
+    """
+    Writes audio to a file.
+
+    Args:
+        path (str): File to write. If it contains {turn}, each turn goes to its own segment, e.g. "out/turn_{turn:03d}.mp3".
+            Otherwise every turn is appended to the same file.
+    """
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self.segmented = "{turn" in path
+        self.turn = 0
+        self.file = None
+
+    def start(self):
+        if self.file is not None:
+            return
+        path = self.path.format(turn=self.turn) if self.segmented else self.path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'wb' if self.segmented else 'ab')
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    async def finish(self):
+        self.file.flush()
+        if self.segmented:
+            self.file.close()
+            self.file = None
+            self.turn += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class TeeSink(Sink):
+    """Passes the same chunk objects to several sinks, in order. Blocking if any of them is."""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+        self.blocking = any(sink.blocking for sink in sinks)
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def write(self, chunk):
+        for sink in self.sinks:
+            sink.write(chunk)
+
+    async def finish(self):
+        await asyncio.gather(*(sink.finish() for sink in self.sinks))
+
+    def pending_bytes(self):
+        return max(sink.pending_bytes() for sink in self.sinks)
+
+    def interrupt(self):
+        for sink in self.sinks:
+            sink.interrupt()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
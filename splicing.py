@@ -0,0 +1,182 @@
+import re
+import time
+from collections import namedtuple
+
+import metrics
+import alignment
+
+
+# End of a sentence: terminal punctuation, optional closing quotes or brackets, then whitespace
+SENTENCE_END = re.compile(r'[.!?…]+["\'”’)\]]*\s+')
+
+# Layer III bitrates (kbps) by bitrate index, for MPEG-1 and for MPEG-2/2.5
+MP3_BITRATES = {
+    'mpeg1': [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    'mpeg2': [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Sample rates by the version bits of the header: MPEG-1, MPEG-2 and MPEG-2.5
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+# A sentence in text order. cached is (audio, frames) from the sentence cache, or None if it is synthesized live.
+Segment = namedtuple('Segment', ['text', 'cached'])
+
+
+class AudioFrame(bytes):
+    """Audio from one websocket message, carrying the normalizedAlignment it speaks (None if there was none)."""
+
+    def __new__(cls, data, alignment=None):
+        frame = super().__new__(cls, data)
+        frame.alignment = alignment
+        return frame
+
+    @property
+    def chars(self):
+        return self.alignment["chars"] if self.alignment and self.alignment.get("chars") else []
+
+
+def mp3_frame_length(data, i):
+    """Length of the MPEG Layer III frame whose header starts at data[i], or None if there is no valid header there."""
+    if i + 4 > len(data) or data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+        return None
+    version, layer = (data[i + 1] >> 3) & 3, (data[i + 1] >> 1) & 3
+    bitrate_index, rate_index, padding = data[i + 2] >> 4, (data[i + 2] >> 2) & 3, (data[i + 2] >> 1) & 1
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES['mpeg1' if version == 3 else 'mpeg2'][bitrate_index] * 1000
+    return (144 if version == 3 else 72) * bitrate // MP3_SAMPLE_RATES[version][rate_index] + padding
+
+
+def mp3_frame_starts(data):
+    """
+    Offsets of the MP3 frames in data, walking frame headers from the first sync word that begins a valid one. Bytes
+    before it finish a frame of the previous message. [] if data isn't MP3, e.g. PCM.
+    """
+    start = data.find(b"\xff")
+    while start != -1 and mp3_frame_length(data, start) is None:
+        start = data.find(b"\xff", start + 1)
+    starts = []
+    while start != -1 and start < len(data):
+        length = mp3_frame_length(data, start)
+        if length is None:
+            break
+        starts.append(start)
+        start += length
+    return starts
+
+
+def split_sentences(chunk):
+    """
+    Splits a chunk at sentence ends. Returns [(piece, ends_sentence)].
+
+    Whitespace after a sentence end stays with that sentence, so "end.\\n\\nNext " splits into "end.\\n\\n" and "Next ".
+    """
+    pieces = []
+    start = 0
+    for match in SENTENCE_END.finditer(chunk):
+        pieces.append((chunk[start:match.end()], True))
+        start = match.end()
+    if start < len(chunk):
+        pieces.append((chunk[start:], False))
+    return pieces
+
+
+def spoken_length(text):
+    """Number of non-space chars ElevenLabs reports in normalizedAlignment when it speaks text."""
+    return sum(1 for c in alignment.normalize(text)[0] if c != " ")
+
+
+def spoken_chars(chars):
+    """Number of non-space chars in a list of normalizedAlignment chars."""
+    return sum(1 for c in chars if not c.isspace())
+
+
+class OverlapTrimmer:
+    """
+    Drops the audio a resumed connection synthesizes again. A response resumed at alignment.resume_point is spoken
+    from there, though the audio up to the continue point was queued before the disconnect: frames are dropped until
+    the continue point, and the frame it falls in is cut at the charStartTimesMs of its first char past it. MP3 audio
+    is cut at the start of the MP3 frame that time falls in, so the decoder is never given a partial frame.
+
+    Records the time from the disconnect to the first new audio in the resume.latency_ms histogram, and the audio
+    dropped in resume.dropped_ms.
+
+    Args:
+        chars_to_send (list[str]): Chars of the response.
+        start (int): Index in chars_to_send the resumed connection speaks from.
+        until (int): Index in chars_to_send of the first char whose audio wasn't received before the disconnect.
+        bytes_per_second (float): Rate of the audio, to turn char timings into byte offsets.
+        since (float): time.perf_counter() of the disconnect recovery is timed from: an earlier one if the
+            connections since then dropped before any new audio. Now by default.
+    """
+
+    def __init__(self, chars_to_send, start, until, bytes_per_second, since=None):
+        self.chars_to_send = chars_to_send
+        self.start = start
+        self.until = until
+        self.bytes_per_second = bytes_per_second
+        self.since = since if since is not None else time.perf_counter()
+        self.received = []      # normalizedAlignment chars of the overlap so far
+        self.trimming = until > start
+        self.dropped_bytes = 0
+        self.resumed = False
+
+    def spoken_upto(self, count):
+        """Index in chars_to_send after the first count received chars, relative to start."""
+        return alignment.align(self.chars_to_send[self.start:], self.received[:count]).continue_point
+
+    def trim(self, frame):
+        """Returns the part of the AudioFrame past the overlap, or None if it is all overlap."""
+        if self.trimming:
+            frame = self.cut(frame)
+        if frame and not self.resumed:
+            self.resumed = True
+            metrics.observe('resume.latency_ms', (time.perf_counter() - self.since) * 1000)
+        return frame
+
+    def cut(self, frame):
+        if not frame.chars:     # Can't tell what unaligned audio speaks. Keep it rather than lose text
+            self.finish()
+            return frame
+
+        before = len(self.received)
+        self.received.extend(frame.chars)
+        overlap = self.until - self.start
+        if self.spoken_upto(len(self.received)) < overlap:
+            self.dropped_bytes += len(frame)
+            return None
+
+        # First char of the frame past the overlap. The chars spoken only grow with the chars received
+        lo, hi = 0, len(frame.chars)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.spoken_upto(before + mid) >= overlap:
+                hi = mid
+            else:
+                lo = mid + 1
+        starts = frame.alignment.get("charStartTimesMs")
+        if lo == 0 or not starts:
+            self.finish()
+            return frame
+        if lo == len(frame.chars):
+            self.dropped_bytes += len(frame)
+            self.finish()
+            return None
+
+        cut = min(len(frame), int(starts[lo] * self.bytes_per_second / 1000))
+        frame_starts = mp3_frame_starts(frame)
+        if frame_starts:
+            # A cut mid-frame would be decoded as a click. Keep the whole MP3 frame the first new char starts in
+            cut = max((start for start in frame_starts if start <= cut), default=frame_starts[0])
+        cut_ms = cut / self.bytes_per_second * 1000
+        self.dropped_bytes += cut
+        self.finish()
+        trimmed = {"chars": frame.chars[lo:], "charStartTimesMs": [max(0, ms - cut_ms) for ms in starts[lo:]]}
+        if frame.alignment.get("charDurationsMs"):
+            trimmed["charDurationsMs"] = frame.alignment["charDurationsMs"][lo:]
+        return AudioFrame(frame[cut:], trimmed)
+
+    def finish(self):
+        """Stops trimming, and records how much audio was dropped."""
+        self.trimming = False
+        metrics.observe('resume.dropped_ms', self.dropped_bytes / self.bytes_per_second * 1000)
@@ -0,0 +1,125 @@
+import io
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import sandbox
+import metrics
+from sinks import NullSink
+from audio_cache import AudioCache, cache_key
+from completion_cache import CompletionCache
+from fake_openai import FakeOpenAIServer
+from fake_elevenlabs import FakeElevenLabsServer
+
+
+SETTINGS = {"stability": 0.70, "similarity_boost": 0.75}
+
+
+def frames_for(audio):
+    return [{'audio_bytes': len(audio), 'normalizedAlignment': {'chars': list("hi ")}}]
+
+
+class TestAudioCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        metrics.reset()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_cache_key(self):
+        """ Test that keys ignore whitespace and typographic differences, but not voice, model or settings. """
+        key = cache_key('voice', 'eleven_multilingual_v2', SETTINGS, "Rise, Tarnished…")
+        self.assertEqual(key, cache_key('voice', 'eleven_multilingual_v2', SETTINGS, " Rise,\n\nTarnished... "))
+        self.assertNotEqual(key, cache_key('other', 'eleven_multilingual_v2', SETTINGS, "Rise, Tarnished…"))
+        self.assertNotEqual(key, cache_key('voice', 'eleven_monolingual_v1', SETTINGS, "Rise, Tarnished…"))
+        self.assertNotEqual(key, cache_key('voice', 'eleven_multilingual_v2', SETTINGS | {"stability": 0.5}, "Rise, Tarnished…"))
+
+    def test_round_trip(self):
+        """ Test that stored audio and frames are returned, also by a cache reopened on the same folder. """
+        cache = AudioCache(self.folder.name)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', "hi", b"x" * 100, frames_for(b"x" * 100))
+        self.assertEqual(cache.get('a'), (b"x" * 100, frames_for(b"x" * 100)))
+
+        reopened = AudioCache(self.folder.name)
+        self.assertEqual(reopened.get('a'), (b"x" * 100, frames_for(b"x" * 100)))
+        self.assertEqual(reopened.size, cache.size)
+
+    def test_lru_eviction(self):
+        """ Test that the least recently used entries are evicted once the cache is over max_bytes. """
+        cache = AudioCache(self.folder.name, max_bytes=2000)
+        for key in "abc":
+            cache.put(key, key, b"x" * 500, frames_for(b"x" * 500))
+        cache.get('a')      # b is now the least recently used
+        cache.put('d', "d", b"x" * 500, frames_for(b"x" * 500))
+
+        self.assertNotIn('b', cache)
+        self.assertEqual(list(cache.entries), ['c', 'a', 'd'])
+        self.assertLessEqual(cache.size, 2000)
+        self.assertEqual(sorted(os.listdir(self.folder.name)), sorted(f"{k}.{ext}" for k in "acd" for ext in ("mp3", "json")))
+        self.assertEqual(list(AudioCache(self.folder.name).entries), ['c', 'a', 'd'])
+
+    def test_hit_skips_websocket(self):
+        """ Test that a stock reply is synthesized once, then played from the cache without a connection. """
+        async def run():
+            cache = AudioCache(self.folder.name)
+            async with FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0) as server:
+                sinks, turns = [], []
+                for _ in range(2):
+                    turns.append(metrics.start_turn())
+                    sinks.append(NullSink())
+                    await sandbox.speak("Rise, Tarnished.", uri=server.uri('voice'), sink=sinks[-1], cache=cache)
+                return sinks, turns, server.stats
+
+        (first, second), turns, stats = asyncio.run(run())
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(second.bytes_written, first.bytes_written)
+        self.assertGreater(first.bytes_written, 0)
+        self.assertEqual([turn.tags['audio_cache'] for turn in turns], ['miss', 'hit'])
+        self.assertEqual(turns[0].counts['audio_cache_store'], 1)
+        self.assertEqual(turns[1].counts['audio_cache_hit'], 1)
+        self.assertIn('first_playback', turns[1].events)
+
+    def test_replayed_reply_cached(self):
+        """ Test that a reply replayed from the completion cache is synthesized once, then played from the cache. """
+        async def run():
+            sandbox.COMPLETION_CACHE = CompletionCache(os.path.join(self.folder.name, 'completions'))
+            sandbox.AUDIO_CACHE = AudioCache(os.path.join(self.folder.name, 'audio'))
+            messages = [{'role': 'user', 'content': "Tell me a story in 30 words"}]
+            async with FakeOpenAIServer(ttft_ms=0, token_interval_ms=0) as openai_server, \
+                    FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0) as server:
+                async with openai_server.client() as client:
+                    sinks, turns, replies = [], [], []
+                    for _ in range(3):
+                        sinks.append(NullSink())
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            replies.append(await sandbox.run_turn(messages, client=client, uri=server.uri('voice'),
+                                                                  sink=sinks[-1]))
+                        turns.append(metrics.current_turn.get())
+                return sinks, turns, replies, openai_server.stats, server.stats
+
+        completion_cache, audio_cache = sandbox.COMPLETION_CACHE, sandbox.AUDIO_CACHE
+        try:
+            sinks, turns, replies, openai_stats, stats = asyncio.run(run())
+        finally:
+            sandbox.COMPLETION_CACHE, sandbox.AUDIO_CACHE = completion_cache, audio_cache
+
+        self.assertEqual(openai_stats['requests'], 1)
+        self.assertEqual(stats['connections'], 2)      # The streamed reply, then the first replay
+        self.assertEqual(replies[1], replies[0])
+        self.assertEqual(replies[2], replies[0])
+        self.assertEqual([turn.tags['completion_cache'] for turn in turns], ['miss', 'hit', 'hit'])
+        self.assertNotIn('audio_cache', turns[0].tags)
+        self.assertEqual([turn.tags['audio_cache'] for turn in turns[1:]], ['miss', 'hit'])
+        self.assertEqual(sinks[2].bytes_written, sinks[1].bytes_written)
+        self.assertGreater(sinks[1].bytes_written, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
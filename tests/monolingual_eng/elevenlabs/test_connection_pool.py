@@ -0,0 +1,72 @@
+import sys
+import asyncio
+import unittest
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import sandbox
+from connection_pool import ConnectionPool
+from fake_elevenlabs import FakeElevenLabsServer
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_warm_spare(self):
+        """ Test that acquire hands out the warmed connection and starts warming the next one. """
+        async def run():
+            async with FakeElevenLabsServer() as server:
+                pool = ConnectionPool(lambda: sandbox.connect_tts(server.uri('voice')))
+                pool.warm()
+                await asyncio.sleep(0.1)
+                self.assertEqual(server.stats['connections'], 1)
+
+                websocket = await pool.acquire()
+                self.assertTrue(websocket.open)
+                await asyncio.sleep(0.1)
+                self.assertEqual(server.stats['connections'], 2)
+
+                await websocket.close()
+                await pool.close()
+
+        asyncio.run(run())
+
+    def test_idle_spare_discarded(self):
+        """ Test that spares that idled out, or were closed by the server, are replaced. """
+        async def run():
+            async with FakeElevenLabsServer(inactivity_timeout=0.1) as server:
+                pool = ConnectionPool(lambda: sandbox.connect_tts(server.uri('voice')), max_idle=10)
+                pool.warm()
+                await asyncio.sleep(0.3)    # Closed by the server
+                websocket = await pool.acquire()
+                self.assertTrue(websocket.open)
+                self.assertEqual(server.stats['connections'], 2)
+                await websocket.close()
+
+                pool.max_idle = 0.05
+                await asyncio.sleep(0.06)
+                pool.warm()     # Replaces the spare acquire started warming
+                await asyncio.sleep(0.05)
+                self.assertEqual(server.stats['connections'], 4)
+                await pool.close()
+
+        asyncio.run(run())
+
+    def test_discarded_spare_closed(self):
+        """ Test that a discarded spare is closed in a task the pool keeps, and close() waits for it. """
+        async def run():
+            async with FakeElevenLabsServer() as server:
+                pool = ConnectionPool(lambda: sandbox.connect_tts(server.uri('voice')), max_idle=0.05)
+                pool.warm()
+                await asyncio.sleep(0.1)
+                spare, _ = pool.spare.result()
+                pool.warm()     # Idled out, so it is discarded
+                self.assertEqual(len(pool.closing), 1)
+
+                await pool.close()
+                self.assertFalse(spare.open)
+                self.assertEqual(pool.closing, set())
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
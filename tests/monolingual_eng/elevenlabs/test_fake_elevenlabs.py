@@ -0,0 +1,113 @@
+import sys
+import json
+import asyncio
+import unittest
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+from sandbox import send_text, listen, text_chunker
+from fake_elevenlabs import FakeElevenLabsServer, Fault, load_elevenlabs_fixtures, read_labelled_audio
+import websockets
+
+
+async def run_stages(uri, openai_output, audio_queue=None, chars_received=None):
+    """Runs the real text_chunker, send_text and listen stages against uri. Returns (audio chunks, chars received)."""
+    text_queue = asyncio.Queue()
+    chunked_text_queue = asyncio.Queue()
+    audio_queue = audio_queue if audio_queue is not None else asyncio.Queue()
+    chars_received = chars_received if chars_received is not None else []
+
+    for text in openai_output:
+        await text_queue.put(text)
+    await text_queue.put(None)
+
+    async with websockets.connect(uri) as websocket:
+        await websocket.send(json.dumps({"text": " "}))
+        await asyncio.gather(
+            text_chunker(text_queue, chunked_text_queue),
+            send_text(websocket, chunked_text_queue),
+            listen(websocket, audio_queue, chars_received)
+        )
+
+    audio = []
+    while (chunk := audio_queue.get_nowait()) is not None:
+        audio.append(chunk)
+    return audio, chars_received
+
+
+class TestFakeElevenLabsServer(unittest.TestCase):
+
+    def test_replay_fixtures(self):
+        """ Test that every recorded elevenlabs_output fixture replays through the real listen stage. """
+        async def run():
+            for test_num, (openai_output, elevenlabs_output) in load_elevenlabs_fixtures('test_data.json').items():
+                async with FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0, replay=elevenlabs_output) as server:
+                    audio, chars_received = await run_stages(server.uri('voice'), openai_output)
+
+                expected = [c for frame in elevenlabs_output if frame["normalizedAlignment"] for c in frame["normalizedAlignment"]["chars"]]
+                self.assertEqual(chars_received, expected, f"test_num {test_num}")
+                self.assertTrue(audio)
+
+        asyncio.run(run())
+
+    def test_synthesized_alignment(self):
+        """ Test that synthesized responses align with the text sent, with a leading space. """
+        async def run():
+            async with FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0, generation_threshold=20) as server:
+                text = ["Hello", " there", ",", " Tarnished", ".", " Rise", " now", " and", " face", " me", "."]
+                audio, chars_received = await run_stages(server.uri('voice'), text)
+                self.assertEqual(server.stats['connections'], 1)
+
+            self.assertEqual(''.join(chars_received), " " + ''.join(text) + " ")
+            self.assertGreater(len(audio), 1)
+
+        asyncio.run(run())
+
+    def test_first_audio_delay(self):
+        """ Test that the first audio frame is held back by first_audio_delay_ms. """
+        async def run():
+            async with FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=200) as server:
+                loop = asyncio.get_running_loop()
+                start = loop.time()
+                await run_stages(server.uri('voice'), ["Hi", "."])
+                self.assertGreaterEqual(loop.time() - start, 0.2)
+
+        asyncio.run(run())
+
+    def test_fault_injection(self):
+        """ Test that injected faults cut the connection mid-frame, or send a frame the client rejects. """
+        text = ["Hello", " there", ",", " Tarnished", ".", " Rise", " now", " and", " face", " me", "."]
+
+        async def run(fault):
+            audio_queue, chars_received = asyncio.Queue(), []
+            async with FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0, generation_threshold=20,
+                                            faults=[fault], labelled=True) as server:
+                with self.assertRaises(websockets.exceptions.ConnectionClosed) as closed:
+                    await run_stages(server.uri('voice'), text, audio_queue, chars_received)
+                self.assertEqual(server.stats['faults_injected'], 1)
+            audio = b''.join(audio_queue.get_nowait() for _ in range(audio_queue.qsize()))
+            return closed.exception, audio, chars_received
+
+        # Audio of exactly the chars reported, up to the char the connection is closed at
+        closed, audio, chars_received = asyncio.run(run(Fault(close_after_chars=24)))
+        self.assertEqual(closed.rcvd.code, 1011)
+        self.assertEqual(''.join(chars_received), " Hello there, Tarnished.")
+        self.assertEqual(read_labelled_audio(audio, 60), chars_received)
+
+        closed, audio, chars_received = asyncio.run(run(Fault(oversized_after_chars=0)))
+        self.assertEqual(closed.sent.code, 1009)     # Message too big
+        self.assertEqual(audio, b'')
+
+    def test_drop_alignment(self):
+        """ Test that frames can be sent with audio but without their alignment. """
+        async def run():
+            async with FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0, generation_threshold=20,
+                                            faults=[Fault(drop_alignment=1.0)]) as server:
+                return await run_stages(server.uri('voice'), ["Hi", " there", "."])
+
+        audio, chars_received = asyncio.run(run())
+        self.assertEqual(chars_received, [])
+        self.assertTrue(audio)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import sys
+import asyncio
+import tempfile
+import unittest
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import sandbox
+import metrics
+import splicing
+from sinks import NullSink
+from audio_cache import AudioCache
+from fake_elevenlabs import FakeElevenLabsServer
+
+
+class RecordingSink(NullSink):
+    """Keeps the alignment chars of every frame written, in order."""
+
+    def __init__(self):
+        super().__init__()
+        self.chars = []
+
+    def write(self, chunk):
+        super().write(chunk)
+        self.chars.extend(chunk.chars)
+
+
+async def speak_streamed(text, server, cache, sink):
+    """Streams text word by word, like chat_completion, so the whole-text cache can't answer it."""
+    text_queue = sandbox.make_queue('text_queue')
+
+    async def produce():
+        for word in text.split(' '):
+            await text_queue.put(word + ' ')
+            await asyncio.sleep(0)
+        await text_queue.put(None)
+
+    turn = metrics.start_turn()
+    await asyncio.gather(produce(), sandbox.text_to_speech_input_streaming(
+        'voice', text_queue, list(text + ' '), uri=server.uri('voice'), sink=sink, sentence_cache=cache))
+    return turn
+
+
+class TestSentenceSplicing(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        metrics.reset()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_split_sentences(self):
+        """ Test that chunks split after sentence ends, keeping closing quotes and whitespace with the sentence. """
+        self.assertEqual(splicing.split_sentences('end." Next one! And '),
+                         [('end." ', True), ('Next one! ', True), ('And ', False)])
+        self.assertEqual(splicing.split_sentences('3.5 words'), [('3.5 words', False)])
+        self.assertEqual(splicing.split_sentences('Wait...\n\n'), [('Wait...\n\n', True)])
+
+    def test_cached_sentences_are_not_resent(self):
+        """ Test that a repeated sentence plays from the cache, and only the new sentence is sent, in text order. """
+        first_text = "Rise, Tarnished. The Elden Ring awaits thee."
+        second_text = "Rise, Tarnished. Seek the grace of gold."
+
+        async def run():
+            cache = AudioCache(self.folder.name)
+            async with FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0) as server:
+                first_turn = await speak_streamed(first_text, server, cache, RecordingSink())
+                sent_before = server.stats['chars_received']
+                sink = RecordingSink()
+                second_turn = await speak_streamed(second_text, server, cache, sink)
+                return first_turn, second_turn, sink, server.stats['chars_received'] - sent_before
+
+        first_turn, second_turn, sink, chars_sent = asyncio.run(run())
+        self.assertEqual(first_turn.counts['sentence_cache_store'], 2)
+        self.assertEqual(second_turn.counts['sentence_cache_chars'], len("Rise, Tarnished. "))
+        self.assertLess(chars_sent, len(second_text) - len("Rise, Tarnished.") + 5)    # Plus the init message's space
+        self.assertEqual(''.join(sink.chars).split(), second_text.split())
+        self.assertLess(second_turn.events['first_cached_frame'], second_turn.events['first_audio_frame'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import sys
+import json
+import random
+import unittest
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+from alignment import align, AlignmentTracker
+
+
+def load_inputs(test_num):
+    with open(f'inputs/{test_num}/chars_to_send.json', 'r') as f:
+        chars_to_send = json.load(f)
+    with open(f'inputs/{test_num}/chars_received.json', 'r') as f:
+        chars_received = json.load(f)
+    with open(f'inputs/{test_num}/remaining_chars.json', 'r') as f:
+        remaining_chars = json.load(f)
+    return chars_to_send, chars_received, remaining_chars
+
+
+class TestAlign(unittest.TestCase):
+
+    def test_divergence_does_not_raise(self):
+        """ Test that unrelated received text yields a low confidence instead of an exception. """
+        chars_to_send, _, _ = load_inputs("01")
+        rng = random.Random(0)
+        chars_received = [" "] + [rng.choice("abcdefghij ") for _ in range(500)]
+
+        result = align(chars_to_send, chars_received)
+        self.assertLess(result.confidence, 0.5)
+        self.assertLessEqual(result.continue_point, len(chars_to_send))
+
+
+class TestAlignmentTracker(unittest.TestCase):
+
+    def test_streamed_batches_match_align(self):
+        """ Test that feeding normalizedAlignment batches while chars_to_send grows gives the same result as align(). """
+        rng = random.Random(0)
+        for test_num in ("01", "02", "03"):
+            chars_to_send, chars_received, remaining_chars = load_inputs(test_num)
+            expected = align(chars_to_send, chars_received)
+
+            for _ in range(10):
+                sent = []
+                tracker = AlignmentTracker(sent)
+                i = 0
+                while i < len(chars_received):
+                    batch = rng.randint(1, 150)
+                    sent.extend(chars_to_send[len(sent):i + batch + rng.randint(0, 300)])   # OpenAI runs ahead of TTS
+                    tracker.feed(chars_received[i:i + batch])
+                    i += batch
+                    self.assertLessEqual(tracker.continue_point, len(chars_to_send))
+                sent.extend(chars_to_send[len(sent):])
+
+                self.assertEqual(tracker.result(), expected)
+                self.assertEqual(chars_to_send[tracker.continue_point:], remaining_chars)
+
+
+if __name__ == '__main__':
+    unittest.main()
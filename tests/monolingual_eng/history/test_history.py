@@ -0,0 +1,98 @@
+import io
+import sys
+import asyncio
+import unittest
+import contextlib
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import metrics
+from sandbox import chat_completion
+from fake_openai import FakeOpenAIServer
+from history import History, Prompt, prompt_tokens, TOKENS_PER_MESSAGE, TOKENS_PER_PROMPT
+
+
+def count_words(text):
+    return len(text.split())
+
+
+class CountingCounter:
+    """Word counter that remembers every text it was asked to count."""
+
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, text):
+        self.texts.append(text)
+        return count_words(text)
+
+
+def turn(i, words):
+    return [{'role': 'user', 'content': f"question {i}"}, {'role': 'assistant', 'content': ' '.join(['word'] * words)}]
+
+
+class TestHistory(unittest.TestCase):
+
+    def test_budget_drops_oldest(self):
+        """ Test that the prompt keeps the system message and the newest messages that fit, oldest dropped first. """
+        conversation = History(budget=100, system="You are Malenia.", count_tokens=count_words)
+        for i in range(10):
+            for message in turn(i, 10):
+                conversation.append(message)
+        conversation.append({'role': 'user', 'content': "latest"})
+
+        prompt = conversation.prompt()
+        self.assertEqual(prompt[0], {'role': 'system', 'content': "You are Malenia."})
+        self.assertEqual(prompt[-1]['content'], "latest")
+        self.assertLessEqual(prompt.tokens, 100)
+        self.assertEqual(prompt.tokens, prompt_tokens(list(prompt), count_words))
+        self.assertEqual(prompt[1:], conversation.messages[-len(prompt) + 1:])
+
+    def test_short_messages_fill_budget(self):
+        """ Test that short greetings are all kept, instead of being cut at a fixed message count. """
+        conversation = History(budget=1000, count_tokens=count_words)
+        for i in range(30):
+            for message in turn(i, 1):
+                conversation.append(message)
+        self.assertEqual(len(conversation.prompt()), 60)
+
+    def test_compacts_message_on_the_edge(self):
+        """ Test that the oldest message that doesn't fit is cut short to the tokens left, instead of dropped. """
+        conversation = History(budget=120, count_tokens=count_words)
+        conversation.append({'role': 'assistant', 'content': ' '.join(f"w{i}" for i in range(200))})
+        conversation.append({'role': 'user', 'content': ' '.join(['word'] * 40)})
+
+        prompt = conversation.prompt()
+        self.assertEqual(len(prompt), 2)
+        self.assertTrue(prompt[0]['content'].startswith("w0 w1 "))
+        self.assertTrue(prompt[0]['content'].endswith("…"))
+        self.assertLessEqual(prompt.tokens, 120)
+        self.assertGreaterEqual(prompt.tokens, 120 - 10)
+
+    def test_counts_once(self):
+        """ Test that each message is counted when it is appended, not again for every prompt. """
+        counter = CountingCounter()
+        conversation = History(budget=1000, system="persona", count_tokens=counter)
+        for message in turn(0, 5):
+            conversation.append(message)
+        for _ in range(5):
+            conversation.prompt()
+        self.assertEqual(len(counter.texts), 3)
+
+    def test_prompt_size_metrics(self):
+        """ Test that chat_completion records the prompt size on the turn. """
+        prompt = Prompt([{'role': 'user', 'content': "hi"}], tokens=TOKENS_PER_PROMPT + TOKENS_PER_MESSAGE + 1)
+
+        async def run():
+            turn = metrics.start_turn()
+            async with FakeOpenAIServer(ttft_ms=0, token_interval_ms=0) as server, server.client() as client:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    await chat_completion(prompt, asyncio.Queue(), [], client=client)
+            return turn
+
+        turn = asyncio.run(run())
+        self.assertEqual(turn.counts['prompt_tokens'], prompt.tokens)
+        self.assertEqual(turn.counts['prompt_messages'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
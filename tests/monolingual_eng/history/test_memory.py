@@ -0,0 +1,96 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import metrics
+from memory import RelevanceIndex
+from history import History
+
+
+TOPICS = ["scarlet rot", "Miquella's needle", "the Haligtree", "Radahn's festival", "the Lands Between",
+          "Godrick the Grafted", "the Erdtree", "Ranni's moon"]
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def exchange(i, topic):
+    return [{'role': 'user', 'content': f"Question {i}: tell me about {topic}"},
+            {'role': 'assistant', 'content': f"Tarnished, {topic} is a tale of old, number {i}."}]
+
+
+class TestMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'memory.jsonl')
+        metrics.reset()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_search_ranks_relevant_exchanges(self):
+        """ Test that exchanges sharing rare query terms rank first, and ids from before onwards are left out. """
+        index = RelevanceIndex()
+        for i, topic in enumerate(TOPICS):
+            index.add(exchange(i, topic), 20)
+        self.assertEqual(index.search("What did you say about the Haligtree?")[0], 2)
+        self.assertEqual(index.search("Ranni and her moon", limit=1), [7])
+        self.assertNotIn(7, index.search("Ranni and her moon", before=7))
+        self.assertEqual(index.search("nothing matches xyzzy"), [])
+
+    def test_persisted_across_sessions(self):
+        """ Test that a reopened index holds the same exchanges, skipping a line cut short by a crash. """
+        index = RelevanceIndex(self.path)
+        for i, topic in enumerate(TOPICS):
+            index.add(exchange(i, topic), 20)
+        with open(self.path, 'a') as f:
+            f.write('{"messages": [{"role": "us')
+
+        reopened = RelevanceIndex(self.path)
+        self.assertEqual(len(reopened), len(TOPICS))
+        self.assertEqual(reopened.exchanges, index.exchanges)
+        self.assertEqual(reopened.search("scarlet rot"), index.search("scarlet rot"))
+
+    def test_incremental_add_is_fast(self):
+        """ Test that adding an exchange to a large index stays well under a millisecond. """
+        index = RelevanceIndex(self.path)
+        for i in range(500):
+            index.add(exchange(i, TOPICS[i % len(TOPICS)]), 20)
+        histogram = metrics.histograms['memory.add_ms']
+        self.assertEqual(histogram.count, 500)
+        self.assertLess(histogram.percentile(50), 1.0)
+
+    def test_history_recalls_old_exchanges(self):
+        """ Test that prompts recall relevant exchanges from earlier sessions, in order and within the budget. """
+        index = RelevanceIndex(self.path)
+        earlier = History(budget=200, count_tokens=count_words, index=index, recall_budget=60)
+        for i in range(200):
+            for message in exchange(i, TOPICS[i % len(TOPICS)] if i != 3 else "the Kindred of Rot"):
+                earlier.append(message)
+        self.assertEqual(len(index), 200)
+
+        conversation = History(budget=200, system="You are Malenia.", count_tokens=count_words,
+                               index=RelevanceIndex(self.path), recall_budget=60)
+        conversation.append({'role': 'user', 'content': "Remind me, what were the Kindred of Rot?"})
+        prompt = conversation.prompt()
+        self.assertGreaterEqual(prompt.recalled, 1)
+        position = prompt.index(exchange(3, "the Kindred of Rot")[0])
+        self.assertEqual(prompt[position + 1], exchange(3, "the Kindred of Rot")[1])
+        self.assertEqual(prompt[0]['role'], 'system')
+        self.assertEqual(prompt[-1]['content'], "Remind me, what were the Kindred of Rot?")
+        self.assertLessEqual(prompt.tokens, 200)
+
+        # Exchanges already among the newest messages aren't recalled a second time
+        for message in exchange(200, "the Kindred of Rot"):
+            conversation.append(message)
+        conversation.append({'role': 'user', 'content': "And the Kindred of Rot again?"})
+        prompt = conversation.prompt()
+        self.assertEqual(len(prompt), len({m['content'] for m in prompt}))
+
+
+if __name__ == "__main__":
+    unittest.main()
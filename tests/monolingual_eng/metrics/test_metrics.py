@@ -0,0 +1,65 @@
+import sys
+import random
+import asyncio
+import unittest
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import metrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles_within_bucket_width(self):
+        """ Test that bucketed percentiles stay within ~12% of the exact percentile. """
+        rng = random.Random(0)
+        values = [rng.lognormvariate(5, 1) for _ in range(10000)]
+        histogram = metrics.Histogram()
+        for value in values:
+            histogram.observe(value)
+
+        for q in (50, 95, 99):
+            exact = metrics.percentile(values, q)
+            self.assertAlmostEqual(histogram.percentile(q) / exact, 1, delta=0.13)
+        self.assertEqual(histogram.summary()['count'], 10000)
+
+    def test_zero_and_empty(self):
+        """ Test that zero queue depths and empty histograms summarize cleanly. """
+        histogram = metrics.Histogram()
+        self.assertEqual(histogram.summary(), {'count': 0})
+        histogram.observe(0)
+        self.assertEqual(histogram.percentile(99), 0)
+
+
+class TestTurnMetrics(unittest.TestCase):
+
+    def test_turn_propagates_to_tasks(self):
+        """ Test that stages running in gathered tasks record onto the turn started by their caller. """
+        async def stage(name, n):
+            for _ in range(n):
+                metrics.record(name)
+                await asyncio.sleep(0)
+
+        async def run():
+            metrics.reset()
+            turn = metrics.start_turn()
+            await asyncio.gather(stage('token', 3), stage('chunk', 2))
+            metrics.finish_turn()
+            return turn
+
+        turn = asyncio.run(run())
+        self.assertEqual(turn.counts, {'token': 3, 'chunk': 2})
+        self.assertLessEqual(turn.events['first_token'], turn.events['last_token'])
+        self.assertEqual(metrics.snapshot()['turn.token']['count'], 1)
+
+    def test_no_turn_is_a_noop(self):
+        """ Test that recording outside a turn does nothing. """
+        async def run():
+            metrics.record('token')
+            metrics.count('audio_bytes', 10)
+            return metrics.current_turn.get()
+
+        self.assertIsNone(asyncio.run(run()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import io
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import metrics
+from sandbox import chat_completion
+from fake_openai import FakeOpenAIServer
+from completion_cache import CompletionCache, Recording, cache_key
+
+
+MESSAGES = [{'role': 'user', 'content': "Tell me a story in 20 words"}]
+
+
+def entry_for(text, end_ms=10):
+    return {'role': 'assistant', 'deltas': [[0, text]], 'end_ms': end_ms}
+
+
+async def run_chat_completion(client, cache, **kwargs):
+    """Runs chat_completion with client in its own turn. Returns (ret_val, text queue contents, seconds taken, turn)."""
+    turn = metrics.start_turn()
+    text_queue = asyncio.Queue()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ret_val = await chat_completion(MESSAGES, text_queue, [], client=client, cache=cache, **kwargs)
+    texts = []
+    while not text_queue.empty():
+        texts.append(text_queue.get_nowait())
+    return ret_val, texts, time.perf_counter() - start, turn
+
+
+class TestCompletionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        metrics.reset()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_cache_key(self):
+        """ Test that keys don't depend on dict order, but do on model, temperature and every message. """
+        key = cache_key('gpt-4', 1, [{'role': 'user', 'content': "hi"}])
+        self.assertEqual(key, cache_key('gpt-4', 1, [{'content': "hi", 'role': 'user'}]))
+        self.assertNotEqual(key, cache_key('gpt-4o', 1, [{'role': 'user', 'content': "hi"}]))
+        self.assertNotEqual(key, cache_key('gpt-4', 0.5, [{'role': 'user', 'content': "hi"}]))
+        self.assertNotEqual(key, cache_key('gpt-4', 1, [{'role': 'system', 'content': "x"}, {'role': 'user', 'content': "hi"}]))
+
+    def test_ttl_and_size_cap(self):
+        """ Test that expired entries are dropped, and the least recently used are evicted over max_bytes. """
+        cache = CompletionCache(self.folder.name, ttl=60)
+        cache.put('a', entry_for("hi"))
+        self.assertEqual(cache.get('a')['deltas'], [[0, "hi"]])
+        cache.ttl = 0
+        time.sleep(0.01)
+        self.assertIsNone(cache.get('a'))
+        self.assertNotIn('a', cache)
+
+        cache = CompletionCache(self.folder.name, max_bytes=400)
+        for key in "abc":
+            cache.put(key, entry_for(key * 100))
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+        self.assertEqual(sorted(os.listdir(self.folder.name)), ['b.json', 'c.json'])
+
+    def test_replay(self):
+        """ Test that a repeated request is replayed without querying OpenAI, at the recorded pace or instantly. """
+        async def run():
+            cache = CompletionCache(self.folder.name)
+            async with FakeOpenAIServer(ttft_ms=100, token_interval_ms=10) as server:
+                async with server.client() as client:   # Closed here, not by the garbage collector in a later test
+                    live = await run_chat_completion(client, cache)
+                    paced = await run_chat_completion(client, cache)
+                    instant = await run_chat_completion(client, cache, replay='instant')
+                    bypassed = await run_chat_completion(client, cache, use_cache=False)
+                return live, paced, instant, bypassed, server.stats['requests']
+
+        live, paced, instant, bypassed, requests = asyncio.run(run())
+        self.assertEqual(requests, 2)   # The first request and the bypassed one
+        self.assertEqual(paced[:2], live[:2])
+        self.assertEqual(instant[:2], live[:2])
+        self.assertGreater(paced[2], 0.8 * live[2])
+        self.assertLess(instant[2], 0.1)
+        self.assertEqual([run[3].tags['completion_cache'] for run in (live, paced, instant, bypassed)],
+                         ['miss', 'hit', 'hit', 'bypass'])
+
+    def test_recording(self):
+        """ Test that recorded deltas carry increasing times since the request, ending by end_ms. """
+        recording = Recording()
+        recording.add("a")
+        time.sleep(0.02)
+        recording.add("b")
+        entry = recording.entry('assistant')
+        self.assertEqual([content for _, content in entry['deltas']], ["a", "b"])
+        self.assertGreaterEqual(entry['deltas'][1][0] - entry['deltas'][0][0], 15)
+        self.assertGreaterEqual(entry['end_ms'], entry['deltas'][1][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
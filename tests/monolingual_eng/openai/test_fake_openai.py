@@ -0,0 +1,63 @@
+import sys
+import asyncio
+import unittest
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+from sandbox import chat_completion
+from fake_openai import FakeOpenAIServer, load_openai_fixtures
+
+
+async def run_chat_completion(server, query):
+    """Runs the real chat_completion against server. Returns (ret_val, text queue contents, chars_to_send)."""
+    text_queue = asyncio.Queue()
+    chars_to_send = []
+    ret_val = await chat_completion([{'role': 'user', 'content': query}], text_queue, chars_to_send, client=server.client())
+
+    texts = []
+    while not text_queue.empty():
+        texts.append(text_queue.get_nowait())
+    return ret_val, texts, chars_to_send
+
+
+class TestFakeOpenAIServer(unittest.TestCase):
+
+    def test_replay_fixtures(self):
+        """ Test that recorded openai_output token arrays are replayed delta for delta. """
+        async def run():
+            fixtures = load_openai_fixtures('test_data.json')
+            async with FakeOpenAIServer(ttft_ms=0, token_interval_ms=0, fixtures=fixtures) as server:
+                for query, openai_output in fixtures.items():
+                    ret_val, texts, chars_to_send = await run_chat_completion(server, query)
+
+                    expected = [t for t in openai_output if t != ""]
+                    self.assertEqual(texts, expected + [None])
+                    self.assertEqual(ret_val, {'role': 'assistant', 'content': ''.join(openai_output)})
+                    self.assertEqual(chars_to_send, list(''.join(openai_output)))
+
+                self.assertEqual(server.stats['requests'], len(fixtures))
+
+        asyncio.run(run())
+
+    def test_story_length(self):
+        """ Test that prompts asking for N words get an N word synthetic response. """
+        async def run():
+            async with FakeOpenAIServer(ttft_ms=0, token_interval_ms=0) as server:
+                ret_val, _, _ = await run_chat_completion(server, "Hello, can you tell me a story that is exactly 500 words long?")
+            self.assertEqual(len(ret_val['content'].split()), 500)
+
+        asyncio.run(run())
+
+    def test_timing(self):
+        """ Test that time-to-first-token and inter-token delays are applied. """
+        async def run():
+            async with FakeOpenAIServer(ttft_ms=100, token_interval_ms=10, replay=["", "a", "b", "c"]) as server:
+                loop = asyncio.get_running_loop()
+                start = loop.time()
+                await run_chat_completion(server, "anything")
+                self.assertGreaterEqual(loop.time() - start, 0.12)
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
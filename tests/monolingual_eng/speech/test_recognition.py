@@ -0,0 +1,96 @@
+import io
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import vad
+import sandbox
+import metrics
+import recognition
+from test_vad import write_wav, noise, voiced
+
+
+class TestRecognition(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.query = write_wav(os.path.join(self.folder.name, 'query.wav'), noise(300), voiced(600), noise(1500))
+        self.transcripts = os.path.join(self.folder.name, 'transcripts.txt')
+        with open(self.transcripts, 'w') as f:
+            f.write("Hi Malenia\n\nTell me a story\n")
+        metrics.reset()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def speech_to_text(self, recognizer, **kwargs):
+        async def run():
+            with vad.WavSource(self.query, realtime=False) as source:
+                return await sandbox.speech_to_text(source, recognizer, **kwargs)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            return asyncio.run(run())
+
+    def test_file_recognizer(self):
+        """ Test that transcripts are returned line by line, with blank lines and missing lines not understood. """
+        recognizer = recognition.FileRecognizer(self.transcripts)
+        self.assertEqual([self.speech_to_text(recognizer) for _ in range(4)], ["Hi Malenia", None, "Tell me a story", None])
+
+    def test_event_loop_runs_during_recognition(self):
+        """ Test that other coroutines keep running while the user speaks and the speech is recognized. """
+        async def run():
+            recognizer = recognition.FileRecognizer(self.transcripts, delay_ms=300)
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.create_task(tick())
+            with vad.WavSource(self.query, realtime=True) as source:
+                text = await sandbox.speech_to_text(source, recognizer)
+            ticker.cancel()
+            return text, ticks
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            text, ticks = asyncio.run(run())
+        self.assertEqual(text, "Hi Malenia")
+        self.assertGreater(ticks, 100)     # ~1.2s of capture and 0.3s of recognition
+
+    def test_timeout(self):
+        """ Test that slow recognition is given up on after the timeout, and the recognizer is cancelled. """
+        recognizer = recognition.FileRecognizer(self.transcripts, delay_ms=5000)
+        start = time.perf_counter()
+        self.assertIsNone(self.speech_to_text(recognizer, recognize_timeout=0.1))
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertTrue(recognizer.cancelled.is_set())
+        self.assertEqual(recognizer.transcripts[0], "Hi Malenia")   # The cancelled call didn't use up a transcript
+
+    def test_cancellation(self):
+        """ Test that cancelling the task stops recognition promptly. """
+        async def run():
+            recognizer = recognition.FileRecognizer(self.transcripts, delay_ms=5000)
+            with vad.WavSource(self.query, realtime=False) as source:
+                task = asyncio.create_task(sandbox.speech_to_text(source, recognizer))
+                await asyncio.sleep(0.2)
+                task.cancel()
+                start = time.perf_counter()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            return recognizer, time.perf_counter() - start
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            recognizer, elapsed = asyncio.run(run())
+        self.assertTrue(recognizer.cancelled.is_set())
+        self.assertLess(elapsed, 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
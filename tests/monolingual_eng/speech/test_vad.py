@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import wave
+import asyncio
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import vad
+import metrics
+
+
+RATE = 16000
+
+
+def noise(ms, level=0.001, seed=0):
+    return np.random.default_rng(seed).normal(0, level, RATE * ms // 1000)
+
+
+def voiced(ms, pitch=150):
+    """Harmonics of pitch with a syllable-rate envelope, standing in for speech."""
+    t = np.arange(RATE * ms // 1000) / RATE
+    wave_ = sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 6))
+    return 0.2 * wave_ * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t)) + noise(ms)
+
+
+def write_wav(path, *segments):
+    samples = np.clip(np.concatenate(segments), -1, 1)
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(RATE)
+        f.writeframes((samples * 32767).astype(np.int16).tobytes())
+    return path
+
+
+class TestVad(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        metrics.reset()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def wav(self, name, *segments):
+        return write_wav(os.path.join(self.folder.name, name), *segments)
+
+    def test_frame_features(self):
+        """ Test that voiced frames are loud with few zero crossings, and white noise crosses zero about every other sample. """
+        frames = np.stack([voiced(30)[:480], np.random.default_rng(1).normal(0, 0.2, 480), np.zeros(480)])
+        energy_db, zcr = vad.frame_features((frames * 32767).astype(np.int16))
+        self.assertGreater(energy_db[0], -20)
+        self.assertLess(zcr[0], 0.1)
+        self.assertGreater(zcr[1], 0.4)
+        self.assertLess(energy_db[2], -100)
+
+    def test_endpoints_utterance(self):
+        """ Test that an utterance is found where it was spoken, short pauses included, and endpointed after the hangover. """
+        path = self.wav('query.wav', noise(1000), voiced(800), noise(200), voiced(600), noise(2000))
+
+        async def run():
+            with vad.WavSource(path, realtime=False) as source:
+                return await vad.capture(source, vad.Endpointer(RATE, hangover_ms=450))
+
+        utterance = asyncio.run(run())
+        self.assertAlmostEqual(utterance.speech_start_ms, 1000, delta=60)
+        self.assertAlmostEqual(utterance.speech_end_ms, 2600, delta=60)
+        self.assertAlmostEqual(utterance.endpoint_ms - utterance.speech_end_ms, 450, delta=30)
+        self.assertAlmostEqual(utterance.duration_ms, utterance.endpoint_ms - 1000 + vad.DEFAULT_PRE_ROLL_MS, delta=60)
+        self.assertEqual(metrics.histograms['vad.endpoint_latency_ms'].count, 1)
+        self.assertEqual(utterance.audio_data().sample_rate, RATE)
+
+    def test_ignores_noise(self):
+        """ Test that silence, clicks shorter than min_speech_ms and loud white noise aren't taken for speech. """
+        loud_noise = np.random.default_rng(2).normal(0, 0.2, RATE)
+        path = self.wav('noise.wav', noise(500), voiced(30), noise(500), loud_noise, noise(500))
+
+        async def run():
+            with vad.WavSource(path, realtime=False) as source:
+                return await vad.capture(source)
+
+        self.assertIsNone(asyncio.run(run()))
+
+    def test_realtime_latency(self):
+        """ Test that audio captured in real time is handed on within the hangover plus a frame or two. """
+        path = self.wav('short.wav', noise(300), voiced(400), noise(1500))
+
+        async def run():
+            with vad.WavSource(path, realtime=True) as source:
+                start = time.perf_counter()
+                utterance = await vad.capture(source, vad.Endpointer(RATE, hangover_ms=300))
+                return utterance, (time.perf_counter() - start) * 1000
+
+        utterance, elapsed_ms = asyncio.run(run())
+        self.assertLess(elapsed_ms, 700 + 300 + 150)
+        self.assertGreaterEqual(utterance.endpoint_latency_ms, 300)
+        self.assertLess(utterance.endpoint_latency_ms, 300 + 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,246 @@
+import io
+import sys
+import base64
+import time
+import asyncio
+import unittest
+import contextlib
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import sandbox
+import metrics
+import splicing
+from sinks import NullSink
+from queues import BoundedQueue, SendWindow
+from fake_openai import FakeOpenAIServer, synthetic_tokens
+from fake_elevenlabs import FakeElevenLabsServer, Fault, silent_audio, normalize_text, read_labelled_audio
+
+
+class SlowSink(NullSink):
+    """Consumes audio at bytes_per_second, like a real-time player."""
+
+    blocking = True
+
+    def __init__(self, bytes_per_second):
+        super().__init__()
+        self.bytes_per_second = bytes_per_second
+
+    def write(self, chunk):
+        time.sleep(len(chunk) / self.bytes_per_second)
+        super().write(chunk)
+
+
+class CaptureSink(NullSink):
+    """Keeps the audio written."""
+
+    def __init__(self):
+        super().__init__()
+        self.audio = bytearray()
+
+    def write(self, chunk):
+        super().write(chunk)
+        self.audio += chunk
+
+
+class DroppingServer(FakeElevenLabsServer):
+    """Closes the first connection after its first audio frame. Records the chars spoken on each connection."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.spoken = {}
+
+    async def send_frame(self, websocket, frame):
+        await super().send_frame(websocket, frame)
+        if frame.get("normalizedAlignment"):
+            self.spoken.setdefault(self.stats['connections'], []).extend(frame["normalizedAlignment"]["chars"])
+            if self.stats['connections'] == 1:
+                await websocket.close()
+
+
+class MidWordDroppingServer(DroppingServer):
+    """Cuts the first frame of the first connection after `cut` chars, mid-word, then closes the connection."""
+
+    def __init__(self, cut, **kwargs):
+        super().__init__(**kwargs)
+        self.cut = cut
+
+    async def send_frame(self, websocket, frame):
+        if self.stats['connections'] == 1 and frame.get("normalizedAlignment"):
+            alignment = {key: value[:self.cut] for key, value in frame["normalizedAlignment"].items()}
+            frame = dict(frame, normalizedAlignment=alignment, alignment=alignment,
+                         audio=base64.b64encode(silent_audio(self.cut * self.ms_per_char)).decode())
+        await super().send_frame(websocket, frame)
+
+
+async def run_turn(openai_server, elevenlabs_server, sink, query):
+    async with openai_server, elevenlabs_server:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return await asyncio.wait_for(sandbox.run_turn(
+                [{'role': 'user', 'content': query}], client=openai_server.client(),
+                uri=elevenlabs_server.uri('voice'), sink=sink), 20)
+
+
+class TestBackpressure(unittest.TestCase):
+
+    def setUp(self):
+        self.bounds = sandbox.QUEUE_BOUNDS
+        self.window = sandbox.SEND_WINDOW
+        metrics.reset()
+
+    def tearDown(self):
+        sandbox.QUEUE_BOUNDS = self.bounds
+        sandbox.SEND_WINDOW = self.window
+
+    def test_bounded_queue(self):
+        """ Test that put() waits while the queue holds max_size, and records how long it waited. """
+        async def run():
+            turn = metrics.start_turn()
+            queue = BoundedQueue('audio_queue', max_size=10)
+            await queue.put(b"a" * 6)
+            await queue.put(b"b" * 6)     # Accepted: the total was under max_size
+            self.assertTrue(queue.full())
+
+            async def consume():
+                await asyncio.sleep(0.05)
+                return queue.get_nowait()
+
+            consumer = asyncio.create_task(consume())
+            await queue.put(None)
+            self.assertEqual(await consumer, b"a" * 6)
+            self.assertEqual(queue.size, 6)
+            self.assertTrue(queue.ended)
+            return turn
+
+        turn = asyncio.run(run())
+        self.assertGreaterEqual(turn.counts['audio_queue_blocked_ms'], 40)
+
+    def test_send_window(self):
+        """ Test that the window opens once enough chars are acknowledged, and times out otherwise. """
+        async def run():
+            window = SendWindow(10, start=5)
+            window.advance(10)
+            self.assertFalse(await window.wait(0.01))
+            asyncio.get_running_loop().call_later(0.01, window.ack, 6)
+            self.assertTrue(await window.wait(1))
+
+        asyncio.run(run())
+
+    def test_slow_sink_holds_back_pipeline(self):
+        """ Test that a slow sink keeps queued audio bounded and holds listen, send_text and chat_completion back. """
+        sandbox.QUEUE_BOUNDS = {'text_queue': (None, 100), 'chunked_text_queue': (None, 100), 'audio_queue': (None, 8192)}
+        sandbox.SEND_WINDOW = 300
+
+        openai_server = FakeOpenAIServer(ttft_ms=0, token_interval_ms=0)
+        elevenlabs_server = FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0, ms_per_char=5)
+        sink = SlowSink(bytes_per_second=400_000)
+        asyncio.run(run_turn(openai_server, elevenlabs_server, sink, "Tell me a story in 300 words"))
+
+        self.assertEqual(sink.bytes_written, elevenlabs_server.stats['audio_bytes_sent'])
+        self.assertGreater(sink.bytes_written, 16 * 8192)
+        largest_frame = 120 * 5 * 16 + 2048     # Generation threshold * ms per char * bytes per ms, plus slack
+        self.assertLessEqual(metrics.histograms['queue_size.audio_queue'].max, 8192 + largest_frame)
+        self.assertLessEqual(metrics.histograms['queue_size.text_queue'].max, 100 + 20)
+        for boundary in ('audio_queue', 'send_window', 'chunked_text_queue', 'text_queue'):
+            self.assertGreater(metrics.histograms[f'turn.{boundary}_blocked_ms'].total, 0, boundary)
+
+    def test_tts_failure_consumes_text(self):
+        """ Test that a turn whose TTS connection fails still returns a reply larger than the text_queue bound. """
+        async def run():
+            async with openai_server:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    return await asyncio.wait_for(sandbox.run_turn(
+                        [{'role': 'user', 'content': "Tell me a story in 500 words"}], client=openai_server.client(),
+                        uri="ws://127.0.0.1:1/v1/x", sink=NullSink()), 20)
+
+        openai_server = FakeOpenAIServer(ttft_ms=0, token_interval_ms=0)
+        message = asyncio.run(run())
+        self.assertEqual(len(message['content'].split()), 500)
+        self.assertGreater(len(message['content']), sandbox.QUEUE_BOUNDS['text_queue'][1])
+
+    def test_resume_after_disconnect(self):
+        """ Test that a dropped connection resumes from the continue point and still speaks text sent afterwards. """
+        openai_server = FakeOpenAIServer(ttft_ms=0, token_interval_ms=5)
+        elevenlabs_server = DroppingServer(char_delay_ms=0, first_audio_delay_ms=0, generation_threshold=40)
+        sink = NullSink()
+        message = asyncio.run(run_turn(openai_server, elevenlabs_server, sink, "Tell me a story in 60 words"))
+
+        self.assertEqual(elevenlabs_server.stats['connections'], 2)
+        first, resumed = ''.join(elevenlabs_server.spoken[1]), ''.join(elevenlabs_server.spoken[2])
+        last_word = message['content'].split()[-1]
+        self.assertTrue(resumed.strip().endswith(last_word), resumed)
+        self.assertLess(len(first) + len(resumed), len(message['content']) + 40)     # Little is spoken twice
+        self.assertGreater(sink.bytes_written, 0)
+
+    def test_resume_plain_queue(self):
+        """ Test that a response resumes to the end from a plain asyncio.Queue whose end of text was already chunked. """
+        tokens = synthetic_tokens(30)
+        elevenlabs_server = DroppingServer(char_delay_ms=0, first_audio_delay_ms=0, generation_threshold=40)
+
+        async def run():
+            text_queue = asyncio.Queue()
+            for token in tokens + [None]:
+                text_queue.put_nowait(token)
+            async with elevenlabs_server:
+                await asyncio.wait_for(sandbox.text_to_speech_input_streaming(
+                    sandbox.VOICE_ID, text_queue, list(''.join(tokens)), uri=elevenlabs_server.uri('voice'),
+                    sink=NullSink(), cache=None), 10)
+
+        asyncio.run(run())
+        self.assertEqual(elevenlabs_server.stats['connections'], 2)
+        resumed = ''.join(elevenlabs_server.spoken[2])
+        self.assertTrue(resumed.strip().endswith(tokens[-1]), resumed)
+
+    def test_resume_mid_word(self):
+        """ Test that a response cut mid-word resumes from its clause, and the audio spoken twice is dropped. """
+        def turn(elevenlabs_server):
+            openai_server = FakeOpenAIServer(ttft_ms=0, token_interval_ms=5)
+            sink = NullSink()
+            asyncio.run(run_turn(openai_server, elevenlabs_server, sink, "Tell me a story in 30 words"))
+            return sink
+
+        kwargs = dict(char_delay_ms=0, first_audio_delay_ms=0, generation_threshold=40)
+        uninterrupted = turn(FakeElevenLabsServer(**kwargs))
+        metrics.reset()
+        elevenlabs_server = MidWordDroppingServer(cut=len(" Ah, Tarnished. You stan"), **kwargs)
+        sink = turn(elevenlabs_server)
+
+        resumed = ''.join(elevenlabs_server.spoken[2])
+        self.assertTrue(resumed.strip().startswith("You stand before"), resumed)
+        self.assertAlmostEqual(metrics.histograms['resume.dropped_ms'].total, len(" You stan") * 60, delta=30)
+        self.assertAlmostEqual(sink.bytes_written, uninterrupted.bytes_written, delta=6 * 417)  # The overlap is ~20 mp3 frames
+        self.assertEqual(metrics.histograms['resume.latency_ms'].count, 1)
+        self.assertEqual(metrics.histograms['resume.rewind_chars'].total, len("You stan"))
+
+    def test_overlap_cut_on_mp3_frames(self):
+        """ Test that the overlap is cut at an MP3 frame boundary, so the remaining audio starts on a frame sync word. """
+        text = " Ah, Tarnished. You stand before Malenia"
+        start = text.index("You")
+        trimmer = splicing.OverlapTrimmer(list(text), start, start + len("You stan"), bytes_per_second=16000)
+        chars = list(" You stand before")
+        alignment = {'chars': chars, 'charStartTimesMs': [i * 60 for i in range(len(chars))]}
+        audio = silent_audio(len(chars) * 60)
+
+        trimmed = trimmer.trim(splicing.AudioFrame(audio, alignment))
+        self.assertEqual(trimmed.chars, list("d before"))
+        self.assertEqual(trimmed[:2], b"\xff\xfb")
+        self.assertEqual(len(trimmed) % 417, 0)
+        self.assertEqual(splicing.mp3_frame_starts(b"\x00\x01" + audio[:834])[:2], [2, 419])    # Partial frame skipped
+        self.assertEqual(splicing.mp3_frame_starts("Tarnished".encode()), [])
+
+    def test_repeated_faults_heard_once(self):
+        """ Test that every char is heard exactly once after disconnects mid-word, mid-overlap and on an oversized frame. """
+        faults = [Fault(close_after_chars=23), Fault(close_after_chars=5), Fault(oversized_after_chars=30)]
+        openai_server = FakeOpenAIServer(ttft_ms=0, token_interval_ms=2)
+        elevenlabs_server = FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0, generation_threshold=40,
+                                                 faults=faults, labelled=True)
+        sink = CaptureSink()
+        message = asyncio.run(run_turn(openai_server, elevenlabs_server, sink, "Tell me a story in 40 words"))
+
+        self.assertEqual(elevenlabs_server.stats['connections'], 4)
+        heard = ''.join(read_labelled_audio(bytes(sink.audio), elevenlabs_server.ms_per_char))
+        self.assertEqual(heard.replace(" ", ""), normalize_text(message['content']).replace(" ", ""))
+        self.assertEqual(metrics.histograms['resume.latency_ms'].count, 1)     # Timed from the first disconnect
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import io
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+sys.path.append('../speech')  # WAV helpers of test_vad
+import vad
+import sandbox
+import metrics
+import playback
+from sinks import NullSink
+from fake_openai import FakeOpenAIServer, synthetic_tokens
+from fake_elevenlabs import FakeElevenLabsServer
+from test_vad import write_wav, noise, voiced
+
+
+class PlaybackSink(NullSink):
+    """Takes as long to write audio as it takes to play, and records writes started after an interrupt."""
+
+    blocking = True
+
+    def __init__(self, bytes_per_second=16000):
+        super().__init__()
+        self.bytes_per_second = bytes_per_second
+        self.late_writes = 0
+        self.playing_since = None
+        self.playing_until = 0.0
+
+    def write(self, chunk):
+        if self.interrupted is not None:
+            self.late_writes += 1
+        self.playing_since = self.playing_since or time.perf_counter()
+        self.playing_until = max(self.playing_until, time.perf_counter()) + len(chunk) / self.bytes_per_second
+        time.sleep(len(chunk) / self.bytes_per_second)
+        super().write(chunk)
+
+    def pending_bytes(self):
+        return max(0.0, self.playing_until - time.perf_counter()) * self.bytes_per_second
+
+
+class TestBargeIn(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        metrics.reset()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def run_turn(self, wav, query, openai_server, elevenlabs_server, sink):
+        async def run():
+            async with openai_server, elevenlabs_server, openai_server.client() as client:
+                with vad.WavSource(wav, realtime=True) as source:
+                    start = time.perf_counter()
+                    message, capture = await sandbox.run_turn_with_barge_in(
+                        [{'role': 'user', 'content': query}], source, client=client,
+                        uri=elevenlabs_server.uri('voice'), sink=sink)
+                    elapsed = time.perf_counter() - start
+                    if sink.interrupted is not None:
+                        utterance = await capture
+                    else:
+                        capture.cancel()
+                        utterance = None
+                    return message, utterance, elapsed
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            return asyncio.run(run())
+
+    def test_speech_interrupts_answer(self):
+        """ Test that speaking during the answer stops the LLM stream, synthesis and playback within 100ms. """
+        wav = write_wav(os.path.join(self.folder.name, 'interrupt.wav'), noise(1500), voiced(800), noise(1500))
+        openai_server = FakeOpenAIServer(ttft_ms=0, token_interval_ms=20)
+        elevenlabs_server = FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0)
+        sink = PlaybackSink()
+        message, utterance, elapsed = self.run_turn(wav, "Tell me a story in 300 words", openai_server, elevenlabs_server, sink)
+
+        self.assertLess(elapsed, 3)
+        self.assertLess(metrics.histograms['barge_in.cancel_ms'].max, 100)
+        self.assertIsNotNone(sink.interrupted)
+        self.assertEqual(sink.late_writes, 0)
+        self.assertLess(openai_server.stats['tokens_sent'], 200)     # Generation stopped, far from 300 words
+        self.assertAlmostEqual(utterance.speech_start_ms, 1500, delta=60)   # The interruption is the next query
+        self.assertEqual(metrics.histograms['turn.interrupted'].count, 1)
+
+        # History keeps the words played before the interruption: 60ms of audio per char, less the leading space
+        response = ''.join(synthetic_tokens(300))
+        played_ms = (sink.interrupted - sink.playing_since) * 1000
+        played_chars = played_ms / elevenlabs_server.ms_per_char
+        self.assertEqual(message['role'], 'assistant')
+        self.assertTrue(response.startswith(message['content']))
+        self.assertEqual(response[len(message['content'])], ' ')
+        self.assertAlmostEqual(len(message['content']), played_chars - 1, delta=12)
+
+    def test_timeline(self):
+        """ Test that playback time maps to the chars started by then, across frames and a reconnect. """
+        chars_to_send = list("Hello there. General Kenobi.")
+        timeline = playback.PlaybackTimeline(chars_to_send, bytes_per_second=1000)
+
+        def frame(text, ms_per_char=100):
+            return {'chars': list(text), 'charStartTimesMs': [i * ms_per_char for i in range(len(text))]}
+
+        timeline.add(1300, frame(" Hello there."), offset=12)
+        timeline.add(0)     # Audio without alignment moves nothing
+        timeline.add(400, frame(" Gen"), offset=16)     # Cut short by a disconnect
+        timeline.add(1300, frame(" eral Kenobi."), offset=28)   # Resent from the continue point on a new connection
+
+        self.assertEqual(timeline.offset_at(-1), 0)
+        self.assertEqual(timeline.spoken_text(0), "")     # Only the leading space has started
+        self.assertEqual(timeline.offset_at(650), 6)
+        self.assertEqual(timeline.offset_at(1300), 13)     # The space before "General" has started
+        self.assertEqual(timeline.spoken_text(650), "Hello")
+        self.assertEqual(timeline.spoken_text(450), "")     # "Hell" is cut off
+        self.assertEqual(timeline.spoken_text(1500), "Hello there.")
+        self.assertEqual(timeline.spoken_text(2100), "Hello there. General")
+        self.assertEqual(timeline.spoken_text(2800), "Hello there. General Kenobi")
+        self.assertEqual(timeline.spoken_text(10_000), "Hello there. General Kenobi.")
+
+    def test_answer_without_interruption(self):
+        """ Test that an answer plays to the end while the user is quiet, and the capture keeps listening. """
+        wav = write_wav(os.path.join(self.folder.name, 'quiet.wav'), noise(8000))
+        openai_server = FakeOpenAIServer(ttft_ms=0, token_interval_ms=0)
+        elevenlabs_server = FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0)
+        sink = NullSink()
+        message, utterance, elapsed = self.run_turn(wav, "Tell me a story in 10 words", openai_server, elevenlabs_server, sink)
+
+        self.assertEqual(len(message['content'].split()), 10)
+        self.assertEqual(sink.bytes_written, elevenlabs_server.stats['audio_bytes_sent'])
+        self.assertIsNone(sink.interrupted)
+        self.assertNotIn('barge_in.cancel_ms', metrics.histograms)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+import io
+import sys
+import time
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+import websockets
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import sandbox
+import metrics
+import simulation
+from audio_cache import AudioCache
+from fake_openai import FakeOpenAIServer, synthetic_tokens
+from fake_elevenlabs import FakeElevenLabsServer, Fault
+
+
+STORY = [{'role': 'user', 'content': "Tell me a story in 500 words"}]
+
+
+class TestSimulation(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def simulate(self, openai_server=None, elevenlabs_server=None, latency_ms=20.0, messages=STORY):
+        """Runs a turn in virtual time. Returns (message, turn metrics, sink, elevenlabs server, wall seconds)."""
+        openai_server = openai_server or FakeOpenAIServer(ttft_ms=300, token_interval_ms=30)
+        elevenlabs_server = elevenlabs_server or FakeElevenLabsServer(char_delay_ms=2, first_audio_delay_ms=150)
+        sink = simulation.SimulatedSink()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            message, turn = simulation.run(simulation.simulate_turn(
+                messages, simulation.SimulatedOpenAI(openai_server, latency_ms),
+                simulation.SimulatedElevenLabs(elevenlabs_server, latency_ms), sink))
+        return message, turn, sink, elevenlabs_server, time.perf_counter() - start
+
+    def test_virtual_clock(self):
+        """ Test that sleeps and timeouts take no real time, and the clock moves exactly as far as they wait. """
+        async def run():
+            loop = asyncio.get_running_loop()
+            await asyncio.sleep(3600)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(asyncio.Event().wait(), 1.5)
+            await asyncio.gather(asyncio.sleep(10), asyncio.sleep(20))
+            return loop.time()
+
+        start = time.perf_counter()
+        self.assertAlmostEqual(simulation.run(run()), 3621.5, places=6)
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+    def test_memory_pipe(self):
+        """ Test that messages arrive in order after the latency, and those in flight are read before the close. """
+        async def run():
+            loop = asyncio.get_running_loop()
+            client, server = simulation.memory_pipe(latency_ms=50)
+            for i in range(3):
+                await client.send(str(i))
+            await client.close(1011, "Injected fault")
+            self.assertFalse(client.open)
+            with self.assertRaises(websockets.exceptions.ConnectionClosed):
+                await client.send("late")
+
+            received = [await server.recv() for _ in range(3)]
+            arrived = loop.time()
+            with self.assertRaises(websockets.exceptions.ConnectionClosedError):
+                await server.recv()
+            return received, arrived
+
+        received, arrived = simulation.run(run())
+        self.assertEqual(received, ["0", "1", "2"])
+        self.assertAlmostEqual(arrived, 0.05, places=6)
+
+    def test_story_turn(self):
+        """ Test that a 500-word story turn runs in well under a second, with stage timings set by the stand-ins. """
+        message, turn, sink, elevenlabs_server, elapsed = self.simulate()
+
+        self.assertLess(elapsed, 2)
+        self.assertEqual(len(message['content'].split()), 500)
+        self.assertGreater(metrics.histograms['turn.duration_ms'].max, 19_000)   # The story's audio still plays in full
+
+        tokens = len(synthetic_tokens(500)) - 1
+        self.assertAlmostEqual(turn.events['websocket_ready'], 40, places=6)     # Handshake round trip
+        self.assertAlmostEqual(turn.events['first_token'], 40 + 300, places=6)
+        self.assertAlmostEqual(turn.events['last_token'], 40 + 300 + (tokens - 1) * 30, places=6)
+        self.assertEqual(turn.events['first_playback'], turn.events['first_audio_frame'])
+        self.assertEqual(sink.bytes_written, elevenlabs_server.stats['audio_bytes_sent'])
+        self.assertEqual(sink.gaps, [])     # Synthesis keeps ahead of playback
+
+    def test_reproducible(self):
+        """ Test that the same turn gives exactly the same stage timings and counts every time. """
+        _, first, first_sink, _, _ = self.simulate()
+        _, second, second_sink, _, _ = self.simulate()
+        self.assertEqual(first.events, second.events)
+        self.assertEqual(first.counts, second.counts)
+        self.assertEqual(first_sink.playing_until, second_sink.playing_until)
+
+    def test_latency_change(self):
+        """ Test that a slower synthesis start delays first audio by exactly as much. """
+        _, fast, _, _, _ = self.simulate(elevenlabs_server=FakeElevenLabsServer(char_delay_ms=2, first_audio_delay_ms=150))
+        _, slow, _, _, _ = self.simulate(elevenlabs_server=FakeElevenLabsServer(char_delay_ms=2, first_audio_delay_ms=250))
+        self.assertAlmostEqual(slow.events['first_audio_frame'] - fast.events['first_audio_frame'], 100, places=6)
+        self.assertEqual(slow.events['first_token'], fast.events['first_token'])
+
+    def test_disconnect(self):
+        """ Test that a turn resumed after a dropped connection is simulated reproducibly too. """
+        def simulate():
+            server = FakeElevenLabsServer(char_delay_ms=2, first_audio_delay_ms=150, faults=[Fault(close_after_chars=300)])
+            return self.simulate(elevenlabs_server=server)
+
+        message, turn, sink, server, elapsed = simulate()
+        self.assertLess(elapsed, 2)
+        self.assertEqual(len(message['content'].split()), 500)
+        self.assertEqual(turn.counts['resume'], 1)
+        self.assertEqual(server.stats['connections'], 2)
+        self.assertEqual(server.stats['faults_injected'], 1)
+        self.assertEqual(simulate()[1].events, turn.events)
+
+    def test_audio_caches_bypassed(self):
+        """ Test that audio caches set in the environment are neither looked up nor stored to. """
+        caches = sandbox.AUDIO_CACHE, sandbox.SENTENCE_CACHE
+        with tempfile.TemporaryDirectory() as audio, tempfile.TemporaryDirectory() as sentences:
+            sandbox.AUDIO_CACHE, sandbox.SENTENCE_CACHE = AudioCache(audio), AudioCache(sentences)
+            try:
+                message, turn, sink, elevenlabs_server, _ = self.simulate()
+                self.assertEqual(len(sandbox.AUDIO_CACHE.entries), 0)
+                self.assertEqual(len(sandbox.SENTENCE_CACHE.entries), 0)
+            finally:
+                sandbox.AUDIO_CACHE, sandbox.SENTENCE_CACHE = caches
+
+        self.assertEqual(turn.tags['audio_cache'], 'bypass')
+        self.assertNotIn('sentence_cache', turn.tags)
+        self.assertEqual(sink.bytes_written, elevenlabs_server.stats['audio_bytes_sent'])
+
+
+if __name__ == "__main__":
+    unittest.main()
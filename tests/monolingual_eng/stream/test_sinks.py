@@ -0,0 +1,96 @@
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import sandbox
+import metrics
+from sinks import NullSink, FileSink, TeeSink
+from fake_elevenlabs import FakeElevenLabsServer
+
+
+class RecordingSink(NullSink):
+    """Keeps the chunk objects it is given."""
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+
+    def write(self, chunk):
+        super().write(chunk)
+        self.received.append(chunk)
+
+
+async def play(sink, chunks):
+    audio_queue = asyncio.Queue()
+    for chunk in chunks:
+        await audio_queue.put(chunk)
+    await audio_queue.put(None)
+    await sandbox.stream(audio_queue, sink)
+
+
+class TestSinks(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_null_sink(self):
+        """ Test that the null sink counts bytes and write times. """
+        sink = NullSink()
+        asyncio.run(play(sink, [b"a" * 10, b"b" * 20]))
+        self.assertEqual(sink.bytes_written, 30)
+        self.assertEqual(sink.chunks, 2)
+        self.assertLessEqual(sink.first_write, sink.last_write)
+
+    def test_file_sink_segments(self):
+        """ Test that {turn} in the path writes each turn to its own file, and that without it turns are appended. """
+        with tempfile.TemporaryDirectory() as folder:
+            segments = FileSink(os.path.join(folder, "turn_{turn}.mp3"))
+            single = FileSink(os.path.join(folder, "session.mp3"))
+            for turn in range(2):
+                asyncio.run(play(TeeSink(segments, single), [b"ab", b"c" * (turn + 1)]))
+            segments.close()
+            single.close()
+
+            with open(os.path.join(folder, "turn_0.mp3"), 'rb') as f:
+                self.assertEqual(f.read(), b"abc")
+            with open(os.path.join(folder, "turn_1.mp3"), 'rb') as f:
+                self.assertEqual(f.read(), b"abcc")
+            with open(os.path.join(folder, "session.mp3"), 'rb') as f:
+                self.assertEqual(f.read(), b"abcabcc")
+
+    def test_tee_sink_shares_chunks(self):
+        """ Test that the tee passes the same bytes objects to every sink, without copying. """
+        first, second = RecordingSink(), RecordingSink()
+        chunks = [b"a" * 10, b"b" * 10]
+        asyncio.run(play(TeeSink(first, second), chunks))
+        for chunk, a, b in zip(chunks, first.received, second.received):
+            self.assertIs(a, chunk)
+            self.assertIs(b, chunk)
+
+    def test_headless_pipeline(self):
+        """ Test that text_to_speech_input_streaming runs without an audio player when given a sink. """
+        async def run():
+            turn = metrics.start_turn()
+            sink = NullSink()
+            text = ["Rise", " now", ",", " Tarnished", "."]
+            text_queue = asyncio.Queue()
+            for delta in text + [None]:
+                await text_queue.put(delta)
+            chars_to_send = list(''.join(text))
+
+            async with FakeElevenLabsServer(char_delay_ms=0, first_audio_delay_ms=0) as server:
+                await sandbox.text_to_speech_input_streaming('voice', text_queue, chars_to_send,
+                                                             uri=server.uri('voice'), sink=sink)
+                return turn, sink, server.stats
+
+        turn, sink, stats = asyncio.run(run())
+        self.assertGreater(sink.bytes_written, 0)
+        self.assertEqual(sink.bytes_written, stats['audio_bytes_sent'])
+        self.assertEqual(turn.counts['bytes_written'], sink.bytes_written)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import sys
+import time
+import asyncio
+import unittest
+
+sys.path.append('../../../')  # Add the parent directory to the Python path
+import sandbox
+import metrics
+from sinks import PlayerSink
+
+# Player that reads one 100 byte write and exits, as if it crashed
+CRASHING_PLAYER_COMMAND = [sys.executable, "-c", "import sys; sys.stdin.buffer.read(100)"]
+
+# Player that reads ~80 KB/s, so writes fill the pipe and stall
+SLOW_PLAYER_COMMAND = [sys.executable, "-c", "import sys, time\nwhile sys.stdin.buffer.read1(4096): time.sleep(0.05)"]
+
+
+async def play(chunks):
+    audio_queue = asyncio.Queue()
+    for chunk in chunks:
+        await audio_queue.put(chunk)
+    await audio_queue.put(None)
+    await sandbox.stream(audio_queue)
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.command = sandbox.AUDIO_PLAYER_COMMAND
+        self.bytes_per_second = sandbox.AUDIO_BYTES_PER_SECOND
+        self.persistent = sandbox.PERSISTENT_PLAYER
+        sandbox.AUDIO_PLAYER_COMMAND = [sys.executable, "-c", "import sys; sys.stdin.buffer.read()"]
+        sandbox.AUDIO_BYTES_PER_SECOND = None
+        metrics.reset()
+
+    def tearDown(self):
+        sandbox.MPVProcessSingleton().stop_process()
+        sandbox.AUDIO_PLAYER_COMMAND = self.command
+        sandbox.AUDIO_BYTES_PER_SECOND = self.bytes_per_second
+        sandbox.PERSISTENT_PLAYER = self.persistent
+
+    def test_persistent_player(self):
+        """ Test that the player process is kept open across turns. """
+        sandbox.PERSISTENT_PLAYER = True
+        asyncio.run(play([b"a" * 10]))
+        process = sandbox.MPVProcessSingleton().process
+        asyncio.run(play([b"b" * 10]))
+        self.assertIs(sandbox.MPVProcessSingleton().process, process)
+        self.assertIsNone(process.poll())
+
+        sandbox.PERSISTENT_PLAYER = False
+        asyncio.run(play([b"c" * 10]))
+        self.assertIsNone(sandbox.MPVProcessSingleton().process)
+        self.assertEqual(process.returncode, 0)
+
+    def test_restart_dead_player(self):
+        """ Test that a player that exits mid-turn is restarted. """
+        sandbox.PERSISTENT_PLAYER = True
+        sandbox.AUDIO_PLAYER_COMMAND = CRASHING_PLAYER_COMMAND
+
+        async def run():
+            turn = metrics.start_turn()
+            chunks = [b"a" * 100] * 3
+            audio_queue = asyncio.Queue()
+            task = asyncio.create_task(sandbox.stream(audio_queue))
+            for chunk in chunks:
+                await audio_queue.put(chunk)
+                await asyncio.sleep(0.5)    # Let the player read it and exit
+            await audio_queue.put(None)
+            await task
+            return turn
+
+        turn = asyncio.run(run())
+        self.assertEqual(turn.counts['bytes_written'], 300)
+        self.assertGreaterEqual(turn.counts['player_restart'], 1)
+        self.assertEqual(turn.counts['player_start'], turn.counts['player_restart'] + 1)
+        self.assertEqual(turn.tags['player'], 'persistent')
+
+    def test_write_after_interrupt(self):
+        """ Test that a write reaching the player after it was killed is dropped, until the next turn starts it. """
+        player = sandbox.MPVProcessSingleton()
+        sink = PlayerSink(player)
+        sink.start()
+        sink.interrupt()
+        sink.write(b"a" * 10)     # Scheduled before the interruption, run after it
+        self.assertIsNone(player.process)
+
+        sink.start()
+        sink.write(b"b" * 10)
+        self.assertIsNone(player.process.poll())
+
+    def test_slow_player(self):
+        """ Test that writes blocked by a slow player don't stall the event loop. """
+        sandbox.PERSISTENT_PLAYER = False
+        sandbox.AUDIO_PLAYER_COMMAND = SLOW_PLAYER_COMMAND
+
+        async def run():
+            turn = metrics.start_turn()
+            lags = []
+
+            async def ticker():
+                while True:
+                    start = time.perf_counter()
+                    await asyncio.sleep(0.01)
+                    lags.append(time.perf_counter() - start - 0.01)
+
+            task = asyncio.create_task(ticker())
+            await asyncio.sleep(0.02)
+            await play([b"a" * 16384] * 12)
+            task.cancel()
+            return turn, lags
+
+        turn, lags = asyncio.run(run())
+        self.assertEqual(turn.counts['bytes_written'], 16384 * 12)
+        self.assertGreater(turn.counts['write_blocked_ms'], 500)   # ~200 KB through a 64 KB pipe at ~80 KB/s
+        self.assertLess(max(lags), 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,14 @@
 import sys
 import json
+import random
 import logging
 import asyncio
 import unittest
 
 sys.path.append('../../../')  # Add the parent directory to the Python path
 from sandbox import setup_logger, multi_log  # Import the text_chunker function
+import sandbox
+import chunking
 
 # Setup individual loggers for specific functions
 app_logger = setup_logger('app')
@@ -69,5 +72,77 @@ class TestTextChunker(unittest.TestCase):
     def test_01(self):
         asyncio.run(self.async_test_text_chunker_01())
 
+    async def run_chunker(self, chunker, texts):
+        input_queue = asyncio.Queue()
+        output_queue = asyncio.Queue()
+        for text in texts:
+            await input_queue.put(text)
+        await input_queue.put(None)
+
+        await chunker(input_queue, output_queue)
+
+        chunks = []
+        while not output_queue.empty():
+            chunks.append(output_queue.get_nowait())
+        return chunks
+
+    def test_02(self):
+        """ Test that sandbox.text_chunker produces the same chunks as the per-char chunker above. """
+        with open('inputs/01.json', 'r') as f:
+            texts = json.load(f)
+
+        rng = random.Random(0)
+        cases = [texts, ["", "Hello", "\n", "World"], ["Hello", "...", "World"], ["  a  ", " ", "b", "\t\t", " c"]]
+        for _ in range(50):
+            cases.append([''.join(rng.choice("ab .\n") for _ in range(rng.randint(0, 8))) for _ in range(rng.randint(0, 20))])
+
+        for case in cases:
+            expected = asyncio.run(self.run_chunker(text_chunker, case))
+            self.assertEqual(asyncio.run(self.run_chunker(sandbox.text_chunker, case)), expected, repr(case))
+
+    def test_03(self):
+        """ Test that the adaptive chunker groups the same words into chunks that follow the schedule. """
+        with open('inputs/01.json', 'r') as f:
+            texts = json.load(f)
+        schedule = (20, 60, 120)
+
+        words = asyncio.run(self.run_chunker(sandbox.text_chunker, texts))[:-1]
+        adaptive = lambda i, o: sandbox.text_chunker(i, o, chunking.AdaptiveChunker(schedule, idle_timeout=None))
+        chunks = asyncio.run(self.run_chunker(adaptive, texts))
+
+        self.assertIsNone(chunks.pop())
+        self.assertEqual(''.join(chunks), ''.join(words))
+        self.assertIsInstance(chunks[0], chunking.Flush)
+        self.assertEqual(chunks[0], "In an alive, ")    # Cut at the first clause boundary
+        for i, chunk in enumerate(chunks[1:-1], start=1):
+            size = schedule[min(i, len(schedule) - 1)]
+            self.assertNotIsInstance(chunk, chunking.Flush)
+            self.assertGreaterEqual(len(chunk), size)
+            self.assertLess(len(chunk) - len(chunk[:-1].rsplit(" ", 1)[-1]) - 1, size)    # Cut at the first word past size
+
+    async def async_test_idle_flush(self):
+        input_queue = asyncio.Queue()
+        output_queue = asyncio.Queue()
+        chunker = chunking.AdaptiveChunker((5, 100), idle_timeout=0.05)
+        task = asyncio.create_task(sandbox.text_chunker(input_queue, output_queue, chunker))
+
+        for text in ["Hello", " there", " my", " friend"]:
+            await input_queue.put(text)
+        self.assertEqual(await output_queue.get(), "Hello ")
+
+        # Stalled mid-word: the complete words are flushed, the partial one waits
+        chunk = await asyncio.wait_for(output_queue.get(), 1)
+        self.assertEqual(chunk, "there my ")
+        self.assertIsInstance(chunk, chunking.Flush)
+
+        await input_queue.put("ly")
+        await input_queue.put(None)
+        await task
+        self.assertEqual([output_queue.get_nowait() for _ in range(2)], ["friendly ", None])
+
+    def test_04(self):
+        """ Test that buffered words are flushed when no text arrives for idle_timeout. """
+        asyncio.run(self.async_test_idle_flush())
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,311 @@
+import time
+import wave
+import asyncio
+import logging
+import argparse
+import threading
+
+import numpy as np
+import speech_recognition as sr
+
+import metrics
+
+
+# Capture format: 16 kHz mono 16-bit PCM, what speech recognition services expect
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+# Length of the frames voice activity is decided on
+FRAME_MS = 30
+
+# Frames louder than this (dBFS), and DEFAULT_NOISE_MARGIN_DB above the noise floor, can be speech
+DEFAULT_ENERGY_THRESHOLD_DB = -45.0
+DEFAULT_NOISE_MARGIN_DB = 10.0
+
+# Frames crossing zero more often than this (crossings per sample) are noise, not speech. White noise is ~0.5.
+DEFAULT_MAX_ZCR = 0.35
+
+# Speech needed to start an utterance, and silence after it that ends the utterance
+DEFAULT_MIN_SPEECH_MS = 90
+DEFAULT_HANGOVER_MS = 500
+
+# Audio kept from before the start of speech, so the first syllable isn't clipped
+DEFAULT_PRE_ROLL_MS = 300
+
+# Longest utterance. It is endpointed once this long even if the speaker hasn't paused.
+DEFAULT_MAX_UTTERANCE_MS = 15000
+
+
+def frame_features(frames):
+    """
+    Returns (energy in dBFS, zero-crossing rate) of each row of frames, a 2D array of int16 samples.
+    Computed for all frames at once.
+    """
+    samples = frames.astype(np.float32) / 32768
+    rms = np.sqrt(np.mean(samples ** 2, axis=1))
+    energy_db = 20 * np.log10(np.maximum(rms, 1e-10))
+    zcr = np.mean(np.signbit(samples[:, 1:]) != np.signbit(samples[:, :-1]), axis=1)
+    return energy_db, zcr
+
+
+class Utterance:
+    """
+    Endpointed speech: 16-bit mono PCM and where it lies in the captured stream.
+
+    Attributes:
+        pcm (bytes): Audio from the pre-roll before speech started to the endpoint.
+        sample_rate (int): Samples per second.
+        speech_start_ms (float): Stream time speech started at.
+        speech_end_ms (float): Stream time of the end of the last speech frame.
+        endpoint_ms (float): Stream time the utterance was endpointed at.
+        endpoint_latency_ms (float): Time from the end of speech to handing the audio on: the hangover, plus processing
+            time if it was captured by capture().
+    """
+
+    sample_width = SAMPLE_WIDTH
+
+    def __init__(self, pcm, sample_rate, speech_start_ms, speech_end_ms, endpoint_ms):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.speech_start_ms = speech_start_ms
+        self.speech_end_ms = speech_end_ms
+        self.endpoint_ms = endpoint_ms
+        self.endpoint_latency_ms = endpoint_ms - speech_end_ms
+
+    @property
+    def duration_ms(self):
+        return len(self.pcm) / self.sample_width / self.sample_rate * 1000
+
+    def audio_data(self):
+        """Returns the utterance as speech_recognition AudioData, for recognition."""
+        return sr.AudioData(self.pcm, self.sample_rate, self.sample_width)
+
+
+class Endpointer:
+    """
+    Streaming voice activity detector that endpoints one utterance.
+
+    Audio is fed as it is captured and split into FRAME_MS frames. A frame is speech if it is loud enough, both in
+    absolute terms and above the noise floor estimated from the non-speech frames, and its zero-crossing rate is low
+    enough. An utterance starts after min_speech_ms of speech, and is endpointed after hangover_ms of silence.
+
+    Args:
+        sample_rate (int): Samples per second of the fed audio, 16-bit mono.
+        hangover_ms (float): Silence after speech that ends the utterance.
+        min_speech_ms (float): Speech that starts an utterance. Shorter noises are ignored.
+        pre_roll_ms (float): Audio kept from before the start of speech.
+        max_utterance_ms (float): Longest utterance.
+        energy_threshold_db (float): Quietest frame that can be speech, in dBFS.
+        noise_margin_db (float): How far above the noise floor a frame has to be to be speech.
+        max_zcr (float): Highest zero-crossing rate of a speech frame.
+    """
+
+    def __init__(self, sample_rate=SAMPLE_RATE, hangover_ms=DEFAULT_HANGOVER_MS, min_speech_ms=DEFAULT_MIN_SPEECH_MS,
+                 pre_roll_ms=DEFAULT_PRE_ROLL_MS, max_utterance_ms=DEFAULT_MAX_UTTERANCE_MS,
+                 energy_threshold_db=DEFAULT_ENERGY_THRESHOLD_DB, noise_margin_db=DEFAULT_NOISE_MARGIN_DB,
+                 max_zcr=DEFAULT_MAX_ZCR):
+        self.sample_rate = sample_rate
+        self.frame_samples = sample_rate * FRAME_MS // 1000
+        self.hangover_frames = max(1, round(hangover_ms / FRAME_MS))
+        self.min_speech_frames = max(1, round(min_speech_ms / FRAME_MS))
+        self.pre_roll_frames = round(pre_roll_ms / FRAME_MS)
+        self.max_frames = round(max_utterance_ms / FRAME_MS)
+        self.energy_threshold_db = energy_threshold_db
+        self.noise_margin_db = noise_margin_db
+        self.max_zcr = max_zcr
+
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.frames = []            # Frames kept for the utterance: the pre-roll, then everything once speech starts
+        self.position = 0           # Frames processed
+        self.noise_db = None        # Noise floor, a moving average of the energy of non-speech frames
+        self.run = 0                # Consecutive speech frames before the utterance starts
+        self.start = None           # Frame speech started at
+        self.last_speech = None     # Last speech frame
+
+    def is_speech(self, energy_db, zcr):
+        floor = self.energy_threshold_db
+        if self.noise_db is not None:
+            floor = max(floor, self.noise_db + self.noise_margin_db)
+        speech = energy_db > floor and zcr <= self.max_zcr
+        if not speech:
+            self.noise_db = energy_db if self.noise_db is None else 0.95 * self.noise_db + 0.05 * energy_db
+        return speech
+
+    def feed(self, pcm):
+        """Processes captured audio. Returns the Utterance once it is endpointed, else None."""
+        samples = np.concatenate([self.remainder, np.frombuffer(pcm, dtype=np.int16)])
+        count = len(samples) // self.frame_samples
+        frames = samples[:count * self.frame_samples].reshape(count, self.frame_samples)
+        self.remainder = samples[count * self.frame_samples:]
+        energy_db, zcr = frame_features(frames)
+
+        for frame, energy, crossings in zip(frames, energy_db.tolist(), zcr.tolist()):
+            speech = self.is_speech(energy, crossings)
+            self.frames.append(frame)
+            self.position += 1
+
+            if self.start is None:
+                self.run = self.run + 1 if speech else 0
+                if self.run >= self.min_speech_frames:
+                    self.start = self.position - self.run
+                    self.last_speech = self.position - 1
+                else:
+                    del self.frames[:-(self.pre_roll_frames + self.run) or len(self.frames)]
+                continue
+
+            if speech:
+                self.last_speech = self.position - 1
+            silence = self.position - 1 - self.last_speech
+            if silence >= self.hangover_frames or self.position - self.start >= self.max_frames:
+                return self.utterance()
+        return None
+
+    def finish(self):
+        """Ends the stream. Returns the Utterance if speech had started, else None."""
+        return self.utterance() if self.start is not None else None
+
+    def utterance(self):
+        return Utterance(np.concatenate(self.frames).tobytes(), self.sample_rate,
+                         speech_start_ms=self.start * FRAME_MS,
+                         speech_end_ms=(self.last_speech + 1) * FRAME_MS,
+                         endpoint_ms=self.position * FRAME_MS)
+
+
+class WavSource:
+    """
+    Reads a 16-bit WAV file in FRAME_MS chunks, standing in for the microphone. Stereo files are mixed down to mono.
+
+    Args:
+        path (str): WAV file to read.
+        realtime (bool): Return each chunk when it would have been captured, like a microphone, instead of at once.
+    """
+
+    def __init__(self, path, realtime=True):
+        self.wav = wave.open(path, 'rb')
+        if self.wav.getsampwidth() != SAMPLE_WIDTH:
+            raise ValueError(f"{path} has {8 * self.wav.getsampwidth()}-bit samples. Expected 16-bit")
+        self.sample_rate = self.wav.getframerate()
+        self.channels = self.wav.getnchannels()
+        self.chunk_frames = self.sample_rate * FRAME_MS // 1000
+        self.realtime = realtime
+        self.started = None
+        self.read_frames = 0
+
+    def read(self):
+        """Returns the next chunk of 16-bit mono PCM, or b'' at the end of the file."""
+        if self.realtime:
+            self.started = self.started or time.perf_counter()
+            delay = self.started + self.read_frames / self.sample_rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        data = self.wav.readframes(self.chunk_frames)
+        self.read_frames += self.chunk_frames
+        if self.channels > 1 and data:
+            samples = np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels)
+            data = samples.mean(axis=1).astype(np.int16).tobytes()
+        return data
+
+    def close(self):
+        self.wav.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MicrophoneSource:
+    """Reads the default microphone in FRAME_MS chunks of 16-bit mono PCM. Opened for the whole session."""
+
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.microphone = sr.Microphone(sample_rate=sample_rate, chunk_size=sample_rate * FRAME_MS // 1000)
+
+    def open(self):
+        self.microphone.__enter__()
+
+    def read(self):
+        return self.microphone.stream.read(self.microphone.CHUNK)
+
+    def close(self):
+        self.microphone.__exit__(None, None, None)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+async def capture(source, endpointer=None, on_speech=None):
+    """
+    Captures one utterance from source (a WavSource or MicrophoneSource). Returns the Utterance, or None if the source
+    ended without speech. on_speech() is called as soon as speech starts, before the utterance is endpointed.
+
+    Chunks are read in a background thread and endpointed on the event loop as they arrive, so the utterance is handed
+    on as soon as the hangover has passed. Endpointing latency is recorded in the vad.endpoint_latency_ms histogram.
+    """
+    logger = logging.getLogger('vad')
+    endpointer = endpointer or Endpointer(source.sample_rate)
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    stop = threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                chunk = source.read()
+                loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            loop.call_soon_threadsafe(chunks.put_nowait, e)
+
+    thread = threading.Thread(target=reader, name='vad-reader', daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = await chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            received = time.perf_counter()
+            utterance = endpointer.feed(chunk) if chunk else endpointer.finish()
+            if on_speech is not None and endpointer.start is not None:
+                on_speech()
+                on_speech = None
+            if utterance is not None or not chunk:
+                break
+    finally:
+        stop.set()
+        await asyncio.to_thread(thread.join)    # A later capture mustn't read alongside this one
+
+    if utterance is not None:
+        utterance.endpoint_latency_ms += (time.perf_counter() - received) * 1000
+        metrics.observe('vad.endpoint_latency_ms', utterance.endpoint_latency_ms)
+        metrics.observe('vad.utterance_ms', utterance.duration_ms)
+        logger.debug(f"Endpointed {utterance.duration_ms:.0f}ms utterance {utterance.endpoint_latency_ms:.0f}ms after speech ended")
+    return utterance
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Endpoint the utterances in WAV files.")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--hangover-ms', type=float, default=DEFAULT_HANGOVER_MS)
+    parser.add_argument('--realtime', action='store_true', help="Read the files at the pace they would be spoken")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        with WavSource(path, realtime=args.realtime) as source:
+            utterance = await capture(source, Endpointer(source.sample_rate, hangover_ms=args.hangover_ms))
+        if utterance is None:
+            print(f"{path}: no speech")
+        else:
+            print(f"{path}: speech {utterance.speech_start_ms:.0f}-{utterance.speech_end_ms:.0f}ms, "
+                  f"endpointed at {utterance.endpoint_ms:.0f}ms, latency {utterance.endpoint_latency_ms:.1f}ms")
+
+
+# Main execution
+if __name__ == "__main__":
+    asyncio.run(main())